@@ -0,0 +1,81 @@
+# Adaptive population size (--adaptive_tolerance): instead of simulating a
+# fixed number of users per topic, users are simulated in batches until the
+# standard errors of the topic's mean gain and mean pain are both within the
+# tolerance, or the maximum number of users (num_users) has been simulated.
+# Users are drawn from keyed random streams [see RandomStreams], so the users of
+# a topic are always the first users of the fixed-size population: an
+# adaptive evaluation that runs to the maximum scores as the fixed one does.
+#
+# reported per topic (and for the AVG of a run):
+#   users            users simulated (summed over the topics for AVG)
+#   gain_ci_width    width of the confidence interval of the mean gain
+#   pain_ci_width    width of the confidence interval of the mean pain
+# The AVG of a run is the mean of its topic means [see
+# ModeledStreamUtility._aggregate_adaptive_population_MSU()], so its standard
+# error combines the (independent) topic standard errors.
+
+import numpy as np
+
+# normal quantile of two-sided 95% confidence intervals
+CONFIDENCE_Z = 1.96
+
+
+def standard_error(values):
+    """
+    :return: standard error of the mean of values (inf for fewer than 2 values)
+    """
+    if len(values) < 2:
+        return float('inf')
+    return np.std(values, ddof=1) / np.sqrt(len(values))
+
+
+class AdaptiveSampling(object):
+    """
+    batches of users simulated for a topic, and when to stop
+    - tolerance: standard error of the mean gain and pain to reach
+    - batch_users: users simulated between convergence checks
+    - max_users: users simulated at most
+    """
+
+    def __init__(self, tolerance, batch_users, max_users, z=CONFIDENCE_Z):
+        if batch_users < 2:
+            raise ValueError('batches need at least 2 users for a standard error')
+        self.tolerance = tolerance
+        self.batch_users = batch_users
+        self.max_users = max_users
+        self.z = z
+
+    def batches(self):
+        """
+        :return: user indices of the successive batches (xranges); the last
+        one is cut at max_users
+        """
+        return [ xrange(first, min(first + self.batch_users, self.max_users))
+            for first in xrange(0, self.max_users, self.batch_users) ]
+
+    def converged(self, user_msus, user_pains):
+        return standard_error(user_msus) <= self.tolerance and \
+            standard_error(user_pains) <= self.tolerance
+
+    def ci_width(self, se):
+        return 2 * self.z * se
+
+    def topic_report(self, user_msus, user_pains):
+        """
+        :return: users, gain_ci_width and pain_ci_width of a topic's simulated users
+        """
+        return dict(users=len(user_msus),
+            gain_ci_width=self.ci_width(standard_error(user_msus)),
+            pain_ci_width=self.ci_width(standard_error(user_pains)))
+
+    def average_report(self, topic_users, num_topics):
+        """
+        :param topic_users: (user_msus, user_pains) of every topic of a run
+        :param num_topics: topics the AVG is taken over
+        :return: users, gain_ci_width and pain_ci_width of the AVG of a run
+        """
+        gain_var = sum( standard_error(user_msus) ** 2 for user_msus, _ in topic_users )
+        pain_var = sum( standard_error(user_pains) ** 2 for _, user_pains in topic_users )
+        return dict(users=sum( len(user_msus) for user_msus, _ in topic_users ),
+            gain_ci_width=self.ci_width(np.sqrt(gain_var) / num_topics),
+            pain_ci_width=self.ci_width(np.sqrt(pain_var) / num_topics))
@@ -0,0 +1,201 @@
+# Times the MSU engines on a synthetic track [see synthetic_track.py], end to
+# end and per stage:
+#   judgments   reading the judgments and update lengths, and building their
+#               tables (once)
+#   load        parsing a run and attaching gain
+#   presort     initialize_structures_for_topic (presorting the updates)
+#   users       sample_users_from_population (user parameters; the session
+#               trails too for the reverse chronological engines)
+#   trails      session trails (push-ranked; the other engines generate them
+#               while simulating)
+#   simulation  gain and pain of every user
+#   aggregation averaging over users and topics
+# Results (with the scale, the environment and the commit) are written as json,
+# to compare across commits. Runs offline; nothing but the synthetic track is read.
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import importlib
+import subprocess
+import logging
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import judgment_bundle
+import update_lengths
+import run_loader
+from modeled_stream_utility import MSUReverseChronoOrder, MSUVectorizedReverseChronoOrder
+from modeled_stream_utility_ranked_order import MSURankedOrder
+push_ranked = importlib.import_module('modeled_stream_utility_push-ranked_order')
+
+from synthetic_track import TrackScale, generate_track
+
+ENGINES = ['reverse_chrono', 'reverse_chrono_vectorized', 'ranked', 'push_ranked']
+
+
+def msu_engine(name, args):
+    """
+    :return: MSU engine called name, with the population parameters of the
+    evaluation scripts' examples
+    """
+    if name == 'reverse_chrono':
+        return MSUReverseChronoOrder(args.users, 120.0, 60.0, 3600.0, 1800.0, 0.5, args.rng)
+    if name == 'reverse_chrono_vectorized':
+        return MSUVectorizedReverseChronoOrder(args.users, 120.0, 60.0, 3600.0, 1800.0, 0.5, args.rng)
+    if name == 'ranked':
+        return MSURankedOrder(args.users, [2.0, 2.0], 3600.0, 1800.0, 0.5, 86400, None, args.rng)
+    if name == 'push_ranked':
+        push_args = push_ranked.argument_parser().parse_args(['ts13', args.interaction_mode, 'run',
+            '-u', str(args.users), '--user_persistence', '0.5', '--user_reading_mean', '4.25',
+            '--user_time_away_mean', '3600', '--rng', args.rng, '--threads', str(args.threads)])
+        return push_ranked.msu_evaluator(push_args)
+
+
+class Timer(object):
+    """
+    accumulates wall time per stage
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, stage, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.stages[stage] = self.stages.get(stage, 0.0) + time.time() - start
+        return result
+
+
+def staged_population_MSU(MSU, run, query_durns, num_topics, timer):
+    """
+    compute_population_MSU() of MSU, one stage at a time
+    """
+    qids = sorted(run.keys())
+    msu_user_topic = np.zeros( (MSU.num_users, num_topics), dtype=float)
+    pain_user_topic = np.zeros( (MSU.num_users, num_topics), dtype=float)
+    for t, qid in enumerate(qids):
+        MSU.population_model.reset_random_seed()
+        timer.time('users', MSU.sample_users_from_population, query_durns[qid][1] - query_durns[qid][0], qid)
+        timer.time('presort', MSU.initialize_structures_for_topic, run[qid])
+        if hasattr(MSU, 'generate_population_trails'):
+            trails = timer.time('trails', MSU.generate_population_trails)
+            user_msus, user_pains = timer.time('simulation', MSU._compute_population_trails_MSU, run[qid], trails)
+        else:
+            user_msus, user_pains = timer.time('simulation', MSU._compute_population_user_MSU, run[qid])
+        msu_user_topic[:, t] = user_msus
+        pain_user_topic[:, t] = user_pains
+    return timer.time('aggregation', MSU._aggregate_population_MSU, run, msu_user_topic, pain_user_topic)
+
+
+def benchmark_engine(name, args, judgments, runfiles):
+    """
+    :return: one result per run file: best end to end and per stage times of
+    args.repeat repetitions, and the run's AVG gain and pain
+    """
+    query_durns, pool, matches, nuggets, updlens, judgment_tables = judgments
+    results = []
+    for runfile in runfiles:
+        best_total, best_stages = None, None
+        for _ in xrange(args.repeat):
+            # a fresh engine for every repetition (no trails cached by a previous one)
+            MSU = msu_engine(name, args)
+            load = lambda: MSU.load_run_and_attach_gain(runfile, updlens, nuggets, matches, True, 'ts13', query_durns, pool,
+                judgment_tables=judgment_tables)
+
+            start = time.time()
+            run = load()
+            run_msu, run_pain = MSU.compute_population_MSU(run, query_durns, len(matches))
+            total = time.time() - start
+
+            MSU = msu_engine(name, args)
+            timer = Timer()
+            run = timer.time('load', load)
+            staged_msu, staged_pain = staged_population_MSU(MSU, run, query_durns, len(matches), timer)
+            if staged_msu != run_msu or staged_pain != run_pain:
+                raise AssertionError('staged evaluation of {} differs from compute_population_MSU'.format(name))
+
+            if best_total is None or total < best_total:
+                best_total = total
+            if best_stages is None:
+                best_stages = timer.stages
+            else:
+                best_stages = dict( (stage, min(t, best_stages[stage])) for stage, t in timer.stages.iteritems() )
+        results.append({'engine': name, 'run': os.path.basename(runfile), 'end_to_end': best_total,
+            'stages': best_stages, 'avg_gain': run_msu['AVG'], 'avg_pain': run_pain['AVG']})
+        logging.warning('{} {}: {:.3f}s {}'.format(name, os.path.basename(runfile), best_total,
+            ' '.join('{} {:.3f}s'.format(stage, t) for stage, t in sorted(best_stages.iteritems()))))
+    return results
+
+
+def environment():
+    """
+    :return: python, numpy, platform and git commit of the benchmark
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+        'platform': platform.platform(), 'commit': commit}
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="times the MSU engines end to end and per stage on a synthetic track")
+    ap.add_argument("--output", help="json file for the results (printed to stdout without it)")
+    ap.add_argument("--engines", nargs="+", choices=ENGINES, default=ENGINES)
+    ap.add_argument("--track_folder", help="folder of the synthetic track (generated there if missing; a temporary folder without it)")
+    ap.add_argument("--topics", type=int, default=10)
+    ap.add_argument("--updates", type=int, default=500, help="updates per topic per run")
+    ap.add_argument("--nuggets", type=int, default=50, help="nuggets per topic")
+    ap.add_argument("--runs", type=int, default=2)
+    ap.add_argument("--users", type=int, default=20, help="users sampled per topic")
+    ap.add_argument("--seed", type=int, default=1234, help="seed of the synthetic track")
+    ap.add_argument("--repeat", type=int, default=1, help="times each measurement is repeated (the best is kept)")
+    ap.add_argument("--interaction_mode", choices=['only.push', 'only.pull', 'push.pull'], default='push.pull', help="of the push-ranked engine")
+    ap.add_argument("--rng", choices=["legacy", "keyed"], default="legacy")
+    ap.add_argument("--threads", type=int, default=1, help="of the push-ranked engine")
+    args = ap.parse_args()
+    print >> sys.stderr, args
+
+    # the engines log every topic
+    for module in ['modeled_stream_utility', 'modeled_stream_utility_ranked_order', push_ranked.__name__]:
+        logging.getLogger(module).setLevel(logging.ERROR)
+
+    scale = TrackScale(args.topics, args.updates, args.nuggets, args.runs)
+    folder = args.track_folder or tempfile.mkdtemp(prefix='msu-bench-')
+    try:
+        if not os.path.exists(os.path.join(folder, 'topics.xml')):
+            generate_track(folder, scale, args.seed)
+
+        start = time.time()
+        query_durns, pool, matches, nuggets = judgment_bundle.read_judgments('ts13',
+            os.path.join(folder, 'matches.tsv'), os.path.join(folder, 'nuggets.tsv'),
+            os.path.join(folder, 'pool.tsv'), os.path.join(folder, 'topics.xml'))
+        updlens = update_lengths.load_update_lengths(os.path.join(folder, 'lens'), 'ts13')
+        judgments = (query_durns, pool, matches, nuggets, updlens, run_loader.JudgmentTables(pool, matches, nuggets))
+        judgments_time = time.time() - start
+
+        runfiles = sorted(os.path.join(folder, 'runs', f) for f in os.listdir(os.path.join(folder, 'runs')))
+        results = []
+        for name in args.engines:
+            results.extend(benchmark_engine(name, args, judgments, runfiles))
+    finally:
+        if not args.track_folder:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    report = {'scale': scale.as_dict(), 'users': args.users, 'seed': args.seed, 'repeat': args.repeat,
+        'interaction_mode': args.interaction_mode, 'rng': args.rng, 'threads': args.threads,
+        'environment': environment(), 'judgments': judgments_time, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as of:
+            json.dump(report, of, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
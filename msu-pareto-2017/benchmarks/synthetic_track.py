@@ -0,0 +1,127 @@
+# Generates a synthetic Temporal Summarization (TS 2013 format) track: topics
+# xml, pool, matches, nuggets, update length files and runs, at a configurable
+# scale. Everything is drawn from a seeded numpy RandomState, so a scale and
+# seed always give the same files.
+
+import os
+import sys
+import argparse
+import numpy as np
+
+# topic query durations
+TOPIC_START = 1330000000
+TOPIC_DURATION = 10*24*3600
+
+
+class TrackScale(object):
+    """
+    scale of a synthetic track
+    - topics: number of topics
+    - updates: updates submitted per topic by every run
+    - nuggets: nuggets per topic
+    - runs: number of run files
+    - relevant: fraction of a topic's candidate updates that match nuggets
+    - duplicates: fraction of a topic's pooled updates that duplicate another
+    """
+
+    def __init__(self, topics=10, updates=500, nuggets=50, runs=4, relevant=0.2, duplicates=0.05):
+        self.topics = topics
+        self.updates = updates
+        self.nuggets = nuggets
+        self.runs = runs
+        self.relevant = relevant
+        self.duplicates = duplicates
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def _update_ids(random_state, num_updates):
+    """
+    :return: docid, sentid and update times of num_updates candidate updates
+    of a topic (docids as in TS 2013: <epoch>-<32 hex digits>)
+    """
+    times = np.sort(random_state.randint(0, TOPIC_DURATION, num_updates))
+    hashes = random_state.randint(0, 16, (num_updates, 32))
+    docids = ['{}-{}'.format(TOPIC_START + t, ''.join('%x' % h for h in row)) for t, row in zip(times, hashes)]
+    sentids = random_state.randint(0, 40, num_updates)
+    return docids, sentids, times
+
+
+def generate_track(folder, scale, seed=1234):
+    """
+    writes the synthetic track into folder:
+      topics.xml, pool.tsv, matches.tsv, nuggets.tsv, lens/<qid>.len, runs/run<i>
+    """
+    random_state = np.random.RandomState(seed)
+    for sub in ['lens', 'runs']:
+        if not os.path.isdir(os.path.join(folder, sub)):
+            os.makedirs(os.path.join(folder, sub))
+
+    run_lines = [[] for _ in xrange(scale.runs)]
+    with open(os.path.join(folder, 'topics.xml'), 'w') as tf, \
+            open(os.path.join(folder, 'pool.tsv'), 'w') as pf, \
+            open(os.path.join(folder, 'matches.tsv'), 'w') as mf, \
+            open(os.path.join(folder, 'nuggets.tsv'), 'w') as nf:
+        print >> tf, '<?xml version="1.0" encoding="UTF-8" ?>\n<events>'
+        print >> pf, '\t'.join(['query_id', 'update_id', 'doc_id', 'sentence_id', 'update_len', 'duplicate_of_id', 'update_text'])
+        print >> mf, '\t'.join(['query_id', 'update_id', 'nugget_id', 'match_start', 'match_end', 'auto_p'])
+        print >> nf, '\t'.join(['query_id', 'nugget_id', 'timestamp', 'importance', 'nugget_len', 'nugget_text'])
+
+        for qid in map(str, xrange(1, scale.topics + 1)):
+            start = TOPIC_START + int(qid)*3600
+            print >> tf, '<event>\n\t<id>{}</id>\n\t<start>{}</start>\n\t<end>{}</end>\n</event>'.format(
+                qid, start, start + TOPIC_DURATION)
+
+            # candidate updates: runs submit overlapping samples of them
+            num_candidates = 2*scale.updates
+            docids, sentids, times = _update_ids(random_state, num_candidates)
+            updids = ['{}-{}'.format(docid, sentid) for docid, sentid in zip(docids, sentids)]
+            wlens = random_state.randint(5, 60, num_candidates)
+
+            ngtids = ['VMTS13.{:02d}.{:03d}'.format(int(qid), n) for n in xrange(scale.nuggets)]
+            ngt_times = np.sort(random_state.randint(0, TOPIC_DURATION, scale.nuggets))
+            for ngtid, ngt_time, importance in zip(ngtids, ngt_times, random_state.randint(1, 4, scale.nuggets)):
+                print >> nf, '\t'.join(map(str, [qid, ngtid, start + ngt_time, importance, 5, 'nugget text']))
+
+            relevant = random_state.rand(num_candidates) < scale.relevant
+            for i in np.flatnonzero(relevant):
+                for n in random_state.choice(scale.nuggets, random_state.randint(1, 4), replace=False):
+                    print >> mf, '\t'.join(map(str, [qid, updids[i], ngtids[n], 0, 10, 0]))
+
+            duplicate_of = np.where(random_state.rand(num_candidates) < scale.duplicates,
+                random_state.randint(0, num_candidates, num_candidates), -1)
+            for i in xrange(num_candidates):
+                duplicate = updids[duplicate_of[i]] if duplicate_of[i] not in (-1, i) else 'NULL'
+                print >> pf, '\t'.join(map(str, [qid, updids[i], docids[i], sentids[i], wlens[i], duplicate, 'text']))
+
+            with open(os.path.join(folder, 'lens', qid + '.len'), 'w') as lf:
+                for updid, wlen in zip(updids, wlens):
+                    print >> lf, qid, updid, 6*wlen, wlen
+
+            for lines in run_lines:
+                submitted = random_state.choice(num_candidates, scale.updates, replace=False)
+                delays = random_state.exponential(600.0, scale.updates)
+                confs = random_state.rand(scale.updates)
+                for i, delay, conf in zip(submitted, delays, confs):
+                    lines.append(' '.join(map(str, [qid, 'team', 'run', docids[i], sentids[i],
+                        start + times[i] + int(delay), round(conf, 3)])))
+        print >> tf, '</events>'
+
+    for r, lines in enumerate(run_lines):
+        with open(os.path.join(folder, 'runs', 'run{}'.format(r)), 'w') as rf:
+            rf.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="generates a synthetic TS 2013 style track")
+    ap.add_argument("folder")
+    ap.add_argument("--topics", type=int, default=10)
+    ap.add_argument("--updates", type=int, default=500, help="updates per topic per run")
+    ap.add_argument("--nuggets", type=int, default=50, help="nuggets per topic")
+    ap.add_argument("--runs", type=int, default=4)
+    ap.add_argument("--seed", type=int, default=1234)
+    args = ap.parse_args()
+    print >> sys.stderr, args
+
+    generate_track(args.folder, TrackScale(args.topics, args.updates, args.nuggets, args.runs), args.seed)
@@ -0,0 +1,48 @@
+# Compiles the judgments of a track into a single bundle file, loaded by the
+# evaluation scripts with --judgments <bundle> in place of the judgment files
+# [see judgment_bundle.py]. Compile the bundle again when the judgment files
+# change.
+
+import sys
+import argparse
+
+import judgment_bundle
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="compiles the judgments of a track (query durations, pool, matches with duplicates expanded, nuggets) into a single bundle file")
+    ap.add_argument("track", choices=["ts13", "ts14", "mb15", "rts16"])
+    ap.add_argument("bundle", help="the bundle file to write")
+    ap.add_argument("-m", "--matchesFile", required=True, help="the qrel file (for tweets) or the matches file (for updates)")
+    ap.add_argument("-n", "--nuggetsFile", required=True, help="the clusters file (for tweets) or the nuggets file (for updates)")
+    ap.add_argument("--poolFile", help="pool of the TS tracks (for tracking duplicates)")
+    ap.add_argument("-t", "--track_topics_file", help="topics of the TS tracks (for query durations)")
+    ap.add_argument("--tweetEpochFile", help="tweet2dayepoch file (for emit times of tweets)")
+
+    args = ap.parse_args()
+    print >> sys.stderr, args
+
+    if args.track in ['ts13', 'ts14'] and None in [args.poolFile, args.track_topics_file]:
+        logger.error('arguments --poolFile -t are needed with track {}'.format(args.track))
+        sys.exit()
+    if args.track in ['mb15', 'rts16'] and args.tweetEpochFile is None:
+        logger.error('argument --tweetEpochFile is needed with track {}'.format(args.track))
+        sys.exit()
+
+    logger.warning('reading in the judgments of track {}'.format(args.track))
+    query_durns, pool, matches, nuggets = judgment_bundle.read_judgments(args.track,
+        args.matchesFile, args.nuggetsFile, args.poolFile, args.track_topics_file, args.tweetEpochFile)
+
+    judgment_bundle.save_bundle(args.bundle, args.track, query_durns, pool, matches, nuggets)
+    logger.warning('judgments of {} topics written to {}'.format(len(matches), args.bundle))
@@ -1,12 +1,15 @@
 # distutils: language=c++
 
 cimport cython
+from cython.parallel cimport prange, threadid
 import array
 from collections import defaultdict
 import bisect
 import heapq
 import operator
-from libc.stdlib cimport malloc, free
+from libc.stdlib cimport malloc, calloc, realloc, free
+from libc.math cimport fabs, pow
+from libc.string cimport memset
 from cpython.mem cimport PyMem_Malloc, PyMem_Realloc, PyMem_Free
 from libcpp.vector cimport vector
 
@@ -27,6 +30,13 @@ from sys import maxint
 # ch.setFormatter(formatter)
 # logger.addHandler(ch)
 
+# Profiling: built with MSU_CYTHON_PROFILE=1 [see setup.py] the functions of
+# this module show up in cProfile (--profile) next to the python frames, and
+# their lines can be traced. The small heap and bitset helpers are left out
+# (@cython.profile(False), @cython.linetrace(False)): tracing them would cost
+# more than they do. Only calls made by the main thread are traced (evaluate
+# with --threads 1).
+
 
 cdef struct UpdateData:
     double conf
@@ -36,383 +46,644 @@ cdef struct UpdateData:
 
   
 
-cdef class UpdateHeap:
-    # sourced from https://interactivepython.org/runestone/static/pythonds/Trees/BinaryHeapImplementation.html
-    cdef vector[UpdateData] minheap
-    cdef vector[UpdateData] maxheap
-    cdef int heap_size
-    cdef int max_heap_size    
-    cdef int topkcount
-
-    def __init__(self, int heap_size_limit):
-        
-        for i in xrange(2*heap_size_limit):
-            self.minheap.push_back(UpdateData(float("inf"),float("inf"), 2**31-1,float("inf")))
-            self.maxheap.push_back(UpdateData(float("-inf"), float("-inf"), -(2**31-1), float("-inf")))
-        self.heap_size = 0
-        self.topkcount = 0 
-        self.max_heap_size = 0
-
-
-    cdef int update_topkcount(self, int incr):
-        self.topkcount += incr
-        return self.topkcount
-
-    cdef bint is_key_smaller(self, UpdateData A, UpdateData B):
-        if A.conf < B.conf:
+# UpdateHeap keeps the top-k (by (conf, time, index)) updates available to a
+# user. At a session the user reads the available updates in ranked order
+# (greatest first) and, at the end of the session, updates older than the
+# next session's window expire.
+# The available updates are held in three binary heaps with lazy deletion: a
+# min-heap on the key (to replace the least update of the top-k), a max-heap
+# on the key (to read in ranked order) and a min-heap on the time (to expire
+# updates). state[] records whether an update is available (LIVE) or was
+# read/replaced/expired (REMOVED); entries of removed updates are dropped when
+# they reach the top of a heap. Every operation is O(log n), so a session
+# costs O(reads log n) instead of rebuilding the heaps.
+# It is a plain C struct (and the heap functions below do not need the GIL)
+# so that users can be simulated with the GIL released.
+# sourced from https://interactivepython.org/runestone/static/pythonds/Trees/BinaryHeapImplementation.html
+cdef enum:
+    ABSENT = 0
+    LIVE = 1
+    REMOVED = 2
+
+cdef struct UpdateHeap:
+    UpdateData* minheap # 1-based
+    UpdateData* maxheap # 1-based
+    UpdateData* timeheap # 1-based
+    unsigned char* state # per update index
+    int capacity # of each of the heap arrays
+    int state_capacity
+    int min_size
+    int max_size
+    int time_size
+    int heap_size # number of LIVE updates
+    int topkcount
+    bint failed # an insert could not grow the heap arrays
+    long operations # pushes and pops of the heap arrays (since the last reset)
+
+
+# the heap arrays start small and double when full: a user's heap grows to
+# its largest window of updates, not to the number of updates of the topic
+DEF INITIAL_HEAP_CAPACITY = 64
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline int grown_capacity(int capacity, int needed) nogil:
+    return needed if needed > 2*capacity else 2*capacity
+
+cdef int heap_reserve(UpdateHeap* heap, int num_updates) nogil:
+    """
+    (re)allocates the heap for the updates 0..num_updates-1; storage is kept
+    when it is large enough, so a heap can be reused for every user of a topic
+    :return: 0 if the heap could not be allocated
+    """
+    cdef unsigned char* state
+    cdef int capacity
+    if heap.minheap == NULL:
+        if not heap_grow(heap, INITIAL_HEAP_CAPACITY):
+            return 0
+    if heap.state_capacity < num_updates + 1:
+        capacity = grown_capacity(heap.state_capacity, num_updates + 1)
+        state = <unsigned char*> realloc(heap.state, capacity)
+        if state == NULL:
+            return 0
+        heap.state = state
+        heap.state_capacity = capacity
+    return 1
+
+
+cdef int heap_grow(UpdateHeap* heap, int capacity) nogil:
+    """
+    grows the heap arrays to hold capacity updates
+    :return: 0 if the arrays could not be grown (the heap is unchanged)
+    """
+    cdef UpdateData* items
+    items = <UpdateData*> realloc(heap.minheap, (capacity + 1) * sizeof(UpdateData))
+    if items == NULL:
+        return 0
+    heap.minheap = items
+    items = <UpdateData*> realloc(heap.maxheap, (capacity + 1) * sizeof(UpdateData))
+    if items == NULL:
+        return 0
+    heap.maxheap = items
+    items = <UpdateData*> realloc(heap.timeheap, (capacity + 1) * sizeof(UpdateData))
+    if items == NULL:
+        return 0
+    heap.timeheap = items
+    heap.capacity = capacity
+    return 1
+
+
+cdef void heap_reset(UpdateHeap* heap, int num_updates) nogil:
+    """
+    empties the heap (for the next user)
+    """
+    heap.min_size = 0
+    heap.max_size = 0
+    heap.time_size = 0
+    heap.heap_size = 0
+    heap.topkcount = 0 
+    heap.failed = False
+    heap.operations = 0
+    memset(heap.state, ABSENT, num_updates + 1)
+
+
+cdef void heap_free(UpdateHeap* heap) nogil:
+    free(heap.minheap)
+    free(heap.maxheap)
+    free(heap.timeheap)
+    free(heap.state)
+    memset(heap, 0, sizeof(UpdateHeap))
+
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline int update_topkcount(UpdateHeap* heap, int incr) nogil:
+    heap.topkcount += incr
+    return heap.topkcount
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline bint is_key_smaller(UpdateData A, UpdateData B) nogil:
+    if A.conf < B.conf:
+        return True
+    if fabs(A.conf - B.conf) < 1e-8:
+        if A.time < B.time:
             return True
-        if abs(A.conf - B.conf) < 1e-8:
-            if A.time < B.time:
-                return True
-            if abs(A.time - B.time) < 1e-8:
-                return A.index < B.index
-        return False
-
-    cdef percUp(self, int i):
-        cdef UpdateData tmp
-        while i // 2 > 0:
-            if self.is_key_smaller(self.minheap[i], self.minheap[i//2]):
-                tmp = self.minheap[i//2]
-                self.minheap[i//2] = self.minheap[i]
-                self.minheap[i] = tmp
-            i = i//2
-    
-    cdef insert(self, UpdateData upd_data):
-        # logger.debug('UpdateHeap: inserting {}'.format(upd_data))
-        self.heap_size += 1
-        self.minheap[self.heap_size] = upd_data
-        self.percUp(self.heap_size)
-
-    cdef int get_smaller_child(self, int i):
-        if i*2 + 1 > self.heap_size:
-            return i*2
-        else:
-            if self.is_key_smaller(self.minheap[i*2],self.minheap[i*2 +1]):
-                return i*2
-            else:
-                return i*2+1
-
-    cdef percDown(self, int i):
-        cdef UpdateData tmp
-        while (i*2) < self.heap_size:
-            sc = self.get_smaller_child(i)
-            if not self.is_key_smaller(self.minheap[i], self.minheap[sc]):
-                tmp = self.minheap[i]
-                self.minheap[i] = self.minheap[sc]
-                self.minheap[sc] = tmp
-            i = sc
-
-    cdef push_into_topk(self, UpdateData upd_data):
-        self.minheap[1] = upd_data
-        self.percDown(1)        
-
-    cdef re_minheapify(self, double time_filter):
-        self.heap_size = 0        
-        cdef num_filtered = 0
-        for i in xrange(1, self.max_heap_size+1):
-            if self.maxheap[i].time > time_filter:                
-                self.insert(self.maxheap[i])
-            else:
-                num_filtered += 1
-                
-        self.max_heap_size = 0
-        # logger.debug('UpdateHeap: re_minheapify: num_filtered {}'.format(num_filtered))
-
-    # max heap functions --------------
-    cdef bint is_key_greater(self, UpdateData A, UpdateData B):
-        if A.conf > B.conf:
+        if fabs(A.time - B.time) < 1e-8:
+            return A.index < B.index
+    return False
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline bint is_key_greater(UpdateData A, UpdateData B) nogil:
+    if A.conf > B.conf:
+        return True
+    if fabs(A.conf - B.conf) < 1e-8:
+        if A.time > B.time:
             return True
-        if abs(A.conf - B.conf) < 1e-8:
-            if A.time > B.time:
-                return True
-            if abs(A.time - B.time) < 1e-8:
-                return A.index > B.index
-        return False
-
-    cdef _percUp_max(self, int i):
-        cdef UpdateData tmp
-        while i // 2 > 0:
-            if self.is_key_greater(self.maxheap[i], self.maxheap[i//2]):
-                tmp = self.maxheap[i//2]
-                self.maxheap[i//2] = self.maxheap[i]
-                self.maxheap[i] = tmp
-            i = i//2
-    
-    cdef _insert_max(self, UpdateData upd_data):
-        self.max_heap_size += 1
-        self.maxheap[self.max_heap_size] = upd_data
-        self._percUp_max(self.max_heap_size)
-
-    cdef int _get_greater_child_max(self, int i):
-        if i*2 + 1 > self.max_heap_size:
-            return i*2
-        else:
-            if self.is_key_greater(self.maxheap[i*2], self.maxheap[i*2 +1]):
-                return i*2
-            else:
-                return i*2+1
-
-    cdef _percDown_max(self, int i):
-        cdef UpdateData tmp
-        while (i*2) < self.max_heap_size:
-            sc = self._get_greater_child_max(i)
-            if not self.is_key_greater(self.maxheap[i], self.maxheap[sc]):
-                tmp = self.maxheap[i]
-                self.maxheap[i] = self.maxheap[sc]
-                self.maxheap[sc] = tmp
-            i = sc
-
-    cdef maxheapify(self):        
-        for i in xrange(1, self.heap_size+1):
-            self._insert_max(self.minheap[i])
-        # assert(self.heap_size == self.max_heap_size)
-
-    cdef UpdateData removemax(self):
-        cdef UpdateData ret = self.maxheap[1]
-        self.maxheap[1] = self.maxheap[self.max_heap_size]
-        self.heap_size -= 1
-        self.max_heap_size -= 1
-        
-        self._percDown_max(1) 
-        
-        return ret       
-    
-    cdef bint heap_top_is_smaller(self, double upd_time, double upd_conf, int upd_idx):        
-        if not self.minheap.size():
-            return True        
-        if self.minheap[1].conf < upd_conf:
+        if fabs(A.time - B.time) < 1e-8:
+            return A.index > B.index
+    return False
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline bint is_time_smaller(UpdateData A, UpdateData B) nogil:
+    return A.time < B.time
+
+# binary heap over one of the arrays, ordered by is_higher (the top is the
+# element no other element is higher than)
+ctypedef bint (*heap_order)(UpdateData, UpdateData) nogil
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef void _heap_push(UpdateData* items, int* size, UpdateData upd_data, heap_order is_higher) nogil:
+    cdef int i
+    size[0] += 1
+    i = size[0]
+    while i // 2 > 0 and is_higher(upd_data, items[i//2]):
+        items[i] = items[i//2]
+        i = i//2
+    items[i] = upd_data
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef void _heap_pop(UpdateData* items, int* size, heap_order is_higher) nogil:
+    cdef UpdateData last = items[size[0]]
+    cdef int i = 1
+    cdef int c
+    size[0] -= 1
+    while i*2 <= size[0]:
+        c = i*2
+        if c + 1 <= size[0] and is_higher(items[c+1], items[c]):
+            c += 1
+        if not is_higher(items[c], last):
+            break
+        items[i] = items[c]
+        i = c
+    items[i] = last
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline void _drop_removed(UpdateHeap* heap, UpdateData* items, int* size, heap_order is_higher) nogil:
+    while size[0] > 0 and heap.state[items[1].index] != LIVE:
+        _heap_pop(items, size, is_higher)
+        heap.operations += 1
+
+cdef void insert(UpdateHeap* heap, UpdateData upd_data) nogil:
+    if heap.min_size == heap.capacity or heap.max_size == heap.capacity or heap.time_size == heap.capacity:
+        if not heap_grow(heap, 2*heap.capacity):
+            heap.failed = True
+            return
+    heap.state[upd_data.index] = LIVE
+    heap.heap_size += 1
+    heap.operations += 3
+    _heap_push(heap.minheap, &heap.min_size, upd_data, is_key_smaller)
+    _heap_push(heap.maxheap, &heap.max_size, upd_data, is_key_greater)
+    _heap_push(heap.timeheap, &heap.time_size, upd_data, is_time_smaller)
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline UpdateData heap_min(UpdateHeap* heap) nogil:
+    # heap.heap_size must be > 0
+    _drop_removed(heap, heap.minheap, &heap.min_size, is_key_smaller)
+    return heap.minheap[1]
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline UpdateData heap_max(UpdateHeap* heap) nogil:
+    # heap.heap_size must be > 0
+    _drop_removed(heap, heap.maxheap, &heap.max_size, is_key_greater)
+    return heap.maxheap[1]
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef void remove(UpdateHeap* heap, int upd_idx) nogil:
+    heap.state[upd_idx] = REMOVED
+    heap.heap_size -= 1
+
+cdef void push_into_topk(UpdateHeap* heap, UpdateData upd_data) nogil:
+    # replace the least update
+    remove(heap, heap_min(heap).index)
+    insert(heap, upd_data)
+
+cdef UpdateData removemax(UpdateHeap* heap) nogil:
+    cdef UpdateData ret = heap_max(heap)
+    remove(heap, ret.index)
+    _heap_pop(heap.maxheap, &heap.max_size, is_key_greater)
+    heap.operations += 1
+    return ret       
+
+cdef void expire(UpdateHeap* heap, double time_filter) nogil:
+    """
+    removes the updates with time <= time_filter
+    """
+    cdef UpdateData upddata
+    while heap.time_size > 0 and not heap.timeheap[1].time > time_filter:
+        upddata = heap.timeheap[1]
+        if heap.state[upddata.index] == LIVE:
+            remove(heap, upddata.index)
+        _heap_pop(heap.timeheap, &heap.time_size, is_time_smaller)
+        heap.operations += 1
+
+cdef bint heap_top_is_smaller(UpdateHeap* heap, double upd_time, double upd_conf, int upd_idx) nogil:        
+    if heap.heap_size == 0:
+        return True        
+    cdef UpdateData top = heap_min(heap)
+    if top.conf < upd_conf:
+        return True
+    if fabs(top.conf - upd_conf) < 1e-8:
+        if top.time < upd_time:
             return True
-        if abs(self.minheap[1].conf - upd_conf) < 1e-8:
-            if self.minheap[1].time < upd_time:
-                return True
-            if abs(self.minheap[1].time - upd_time) < 1e-8:
-                return self.minheap[1].index < upd_idx
-        return False
-
-    cdef void add_to_heap(self, int upd_idx, double upd_time, double upd_conf, double upd_wlen):
-        if self.heap_size < self.topkcount:            
-            self.insert( UpdateData(upd_conf, upd_time, upd_idx, upd_wlen) )            
-            # logger.debug('UpdateHeap: add_to_heap: default insert')
-        elif self.topkcount >0 and self.heap_size == self.topkcount and self.heap_top_is_smaller(upd_time, upd_conf, upd_idx) :
-            self.push_into_topk(UpdateData(upd_conf, upd_time, upd_idx, upd_wlen) )        
-            # logger.debug('UpdateHeap: add_to_heap: topk insert')
+        if fabs(top.time - upd_time) < 1e-8:
+            return top.index < upd_idx
+    return False
+
+cdef void add_to_heap(UpdateHeap* heap, int upd_idx, double upd_time, double upd_conf, double upd_wlen) nogil:
+    cdef UpdateData upd_data
+    upd_data.conf = upd_conf
+    upd_data.time = upd_time
+    upd_data.index = upd_idx
+    upd_data.wlen = upd_wlen
+    if heap.heap_size < heap.topkcount:            
+        insert(heap, upd_data)
+    elif heap.topkcount >0 and heap.heap_size == heap.topkcount and heap_top_is_smaller(heap, upd_time, upd_conf, upd_idx) :
+        push_into_topk(heap, upd_data)
     
 
-#@cython.profile(True)
+# per-user state of the ranked kernels, indexed by update (a bitset of the
+# updates read) and by nugget (whether the nugget was seen)
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline bint is_read(const unsigned char* updates_read, int upd_idx) nogil:
+    return updates_read[upd_idx >> 3] & (1 << (upd_idx & 7))
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline void set_read(unsigned char* updates_read, int upd_idx) nogil:
+    updates_read[upd_idx >> 3] |= (1 << (upd_idx & 7))
+
+
+# work done by user simulations, in the order of
+# evaluation_stats.SIMULATION_COUNTERS
+cdef struct SimulationCounts:
+    long sessions # sessions simulated
+    long updates_read
+    long heap_operations
+    long nuggets_credited
+
+cdef void add_counts(long[:] counts, SimulationCounts* user_counts):
+    counts[0] += user_counts.sessions
+    counts[1] += user_counts.updates_read
+    counts[2] += user_counts.heap_operations
+    counts[3] += user_counts.nuggets_credited
+
+
+# heap and per-user state of one user simulation; a pool of these is kept by
+# the module and reused for every user (and topic) evaluated, one per thread
+cdef struct UserScratch:
+    UpdateHeap heap
+    SimulationCounts counts # of the users simulated with this scratch
+    unsigned char* updates_read
+    int read_bytes_capacity
+    unsigned char* already_seen_ngts
+    int* ngt_sessions # number of sessions started by each nugget's time
+    int ngts_capacity
+    double* lateness # L ** alpha for alpha = 0, 1, ... (one per session)
+    int lateness_capacity
+
+
+cdef int scratch_reserve(UserScratch* scratch, int num_updates, int num_ngts) nogil:
+    """
+    grows the scratch storage (geometrically) for a topic with num_updates
+    updates and num_ngts nuggets
+    :return: 0 if the storage could not be allocated
+    """
+    cdef unsigned char* buf
+    cdef int* sessions
+    cdef int capacity
+    cdef int read_bytes = num_updates // 8 + 1
+    if not heap_reserve(&scratch.heap, num_updates):
+        return 0
+    if scratch.read_bytes_capacity < read_bytes:
+        capacity = grown_capacity(scratch.read_bytes_capacity, read_bytes)
+        buf = <unsigned char*> realloc(scratch.updates_read, capacity)
+        if buf == NULL:
+            return 0
+        scratch.updates_read = buf
+        scratch.read_bytes_capacity = capacity
+    if scratch.ngts_capacity < num_ngts + 1:
+        capacity = grown_capacity(scratch.ngts_capacity, num_ngts + 1)
+        buf = <unsigned char*> realloc(scratch.already_seen_ngts, capacity)
+        if buf == NULL:
+            return 0
+        scratch.already_seen_ngts = buf
+        sessions = <int*> realloc(scratch.ngt_sessions, capacity * sizeof(int))
+        if sessions == NULL:
+            return 0
+        scratch.ngt_sessions = sessions
+        scratch.ngts_capacity = capacity
+    return 1
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef tuple process_session(updates_read, already_seen_ngts, updates, 
-                double user_reading_speed, double user_latency_tolerance,
-                double ssn_start, int ssn_reads, int uti,
+cdef int user_lateness(UserScratch* scratch, const double* ssn_starts, int num_sessions,
+            const double* ngt_times, const long* ngt_order, int num_ngts,
+            double user_latency_tolerance) nogil:
+    """
+    precomputes the lateness of a user's nuggets: the number of sessions
+    started at each nugget's time (bisect.bisect(ssn_starts, ngt_time), in one
+    merge of the sessions and the nuggets in time order ngt_order) and the
+    lateness decay L ** alpha for alpha = 0 .. num_sessions-1
+    :return: 0 if the lateness table could not be allocated
+    """
+    cdef int capacity
+    cdef double* lateness
+    cdef int si = 0
+    cdef int k
+    cdef long ngt
+    if scratch.lateness_capacity < num_sessions + 1:
+        capacity = grown_capacity(scratch.lateness_capacity, num_sessions + 1)
+        lateness = <double*> realloc(scratch.lateness, capacity * sizeof(double))
+        if lateness == NULL:
+            return 0
+        scratch.lateness = lateness
+        scratch.lateness_capacity = capacity
+
+    for k in xrange(num_ngts):
+        ngt = ngt_order[k]
+        while si < num_sessions and not ngt_times[ngt] < ssn_starts[si]:
+            si += 1
+        scratch.ngt_sessions[ngt] = si
+
+    for k in xrange(num_sessions + 1):
+        scratch.lateness[k] = pow(user_latency_tolerance, <double> k)
+    return 1
+
+
+cdef void scratch_reset(UserScratch* scratch, int num_updates, int num_ngts) nogil:
+    heap_reset(&scratch.heap, num_updates)
+    memset(scratch.updates_read, 0, num_updates // 8 + 1)
+    memset(scratch.already_seen_ngts, 0, num_ngts + 1)
+
+
+cdef void scratch_free(UserScratch* scratch) nogil:
+    heap_free(&scratch.heap)
+    free(scratch.updates_read)
+    free(scratch.already_seen_ngts)
+    free(scratch.ngt_sessions)
+    free(scratch.lateness)
+    memset(scratch, 0, sizeof(UserScratch))
+
+
+cdef UserScratch* scratch_pool = NULL
+cdef int scratch_pool_size = 0
+cdef bint scratch_pool_busy = False
+
+cdef UserScratch* acquire_scratch(int num_scratches, int num_updates, int num_ngts, bint* pooled) except NULL:
+    """
+    :return: num_scratches scratches reserved for the topic, from the module
+    pool (pooled[0] is set) unless the pool is in use by another thread
+    """
+    global scratch_pool, scratch_pool_size, scratch_pool_busy
+    cdef UserScratch* scratches
+    cdef int i
+    cdef bint reserved = True
+    pooled[0] = not scratch_pool_busy
+    if pooled[0]:
+        if scratch_pool_size < num_scratches:
+            scratches = <UserScratch*> realloc(scratch_pool, num_scratches * sizeof(UserScratch))
+            if scratches == NULL:
+                raise MemoryError()
+            memset(&scratches[scratch_pool_size], 0, (num_scratches - scratch_pool_size) * sizeof(UserScratch))
+            scratch_pool = scratches
+            scratch_pool_size = num_scratches
+        scratches = scratch_pool
+        scratch_pool_busy = True
+    else:
+        scratches = <UserScratch*> calloc(num_scratches, sizeof(UserScratch))
+        if scratches == NULL:
+            raise MemoryError()
+    for i in xrange(num_scratches):
+        reserved = scratch_reserve(&scratches[i], num_updates, num_ngts) and reserved
+    if not reserved:
+        release_scratch(scratches, num_scratches, pooled[0])
+        raise MemoryError()
+    return scratches
+
+
+cdef void release_scratch(UserScratch* scratches, int num_scratches, bint pooled):
+    global scratch_pool_busy
+    cdef int i
+    if pooled:
+        scratch_pool_busy = False
+    else:
+        for i in xrange(num_scratches):
+            scratch_free(&scratches[i])
+        free(scratches)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void process_session(UpdateHeap* topkqueue,
+                unsigned char* updates_read, int* num_updates_read, unsigned char* already_seen_ngts, int* num_ngts_credited,
+                const long* ngt_offsets, const long* ngt_indices,
+                const int* ngt_sessions, const double* lateness, # needed for alpha computation [see user_lateness]
+                double user_reading_speed,
+                int ssn_reads, int uti,
                 double next_ssn_start, double next_ssn_window_start,
-                ssn_starts, # needed for alpha computation
-                UpdateHeap topkqueue,
-                ignore_verbosity = False):
+                bint ignore_verbosity,
+                double* session_msu, double* session_pain) nogil:
     
-    cdef double session_msu = 0.0
-    cdef double session_pain = 0.0
+    session_msu[0] = 0.0
+    session_pain[0] = 0.0
     cdef double current_time = 0.0
 
-    # logger.debug('session {}: start {}; reads {}'.format(uti, ssn_start, ssn_reads))
-
-    topkqueue.update_topkcount(-ssn_reads)
+    update_topkcount(topkqueue, -ssn_reads)
     if topkqueue.heap_size == 0:
-        # logger.debug('nothing in heap. return 0.0')
-        return 0.0, 0.0
-
-    topkqueue.maxheapify()              
-            
-    # logger.debug('topk count {}: maxqueue {} {}'.format(topkqueue.topkcount, topkqueue.max_heap_size, [ (e.conf, e.index) for e in topkqueue.maxheap][:topkqueue.max_heap_size+1]))
+        return
 
-    cdef double read_update_wlen = 0.0
+    cdef UpdateData upddata
     cdef double upd_time_to_read = 0.0
     cdef double read_update_msu = 0.0
 
     cdef int alpha = 0
-    cdef int ngt_after = 0
-    cdef double ngt_msu = 0.0
+    cdef long ni = 0
+    cdef long ngt = 0
 
-    #for ai in xrange(len(available_updates)): # for num_reads
-    while ssn_reads >0 and topkqueue.max_heap_size > 0:
-        # logger.debug('starting to read {}; max_heap_size {}'.format(ssn_reads, topkqueue.max_heap_size))
+    while ssn_reads >0 and topkqueue.heap_size > 0:
         ssn_reads -= 1
         
-        upddata = topkqueue.maxheap[1]
-        # logger.debug(upddata)
+        upddata = heap_max(topkqueue)
 
-        read_update_wlen = upddata.wlen
-        
-        upd_time_to_read = (float(read_update_wlen) / user_reading_speed)
+        upd_time_to_read = upddata.wlen / user_reading_speed
         current_time += upd_time_to_read
 
         if current_time > next_ssn_start and not ignore_verbosity:
             # user persisted in reading upto the start of the next session
-            # logger.debug('user persisted in reading upto the start of the next session')
-            #print 'not ignoring verbosity'
             break
         
-        updates_read[upddata.index] = True
-        # logger.debug('before removemax')
-        topkqueue.removemax()        
-        # logger.debug('removed maxtop. maxqueue {} {}'.format(topkqueue.max_heap_size, [ (e.conf, e.index) for e in topkqueue.maxheap]))
+        if not is_read(updates_read, upddata.index):
+            set_read(updates_read, upddata.index)
+            num_updates_read[0] += 1
+        removemax(topkqueue)        
         
-        read_update = updates[upddata.index]
-        # logger.debug('read update {}'.format(read_update))
         read_update_msu = 0.0
         # check for nuggets and update user msu
-        for ngt in read_update.nuggets:
-            if ngt.ngtid in already_seen_ngts:
+        for ni in xrange(ngt_offsets[upddata.index], ngt_offsets[upddata.index+1]):
+            ngt = ngt_indices[ni]
+            if already_seen_ngts[ngt]:
                 continue
-            ngt_after = bisect.bisect(ssn_starts, ngt.time)                
-            alpha = uti - ngt_after
-            already_seen_ngts[ngt.ngtid] = alpha
+            already_seen_ngts[ngt] = 1
+            num_ngts_credited[0] += 1
+            alpha = uti - ngt_sessions[ngt]
             alpha = 0 if alpha < 0 else alpha
-            ngt_msu = (user_latency_tolerance ** alpha)
-            # logger.debug('ngt {} alpha {} msu {}'.format(ngt, alpha, ngt_msu))
-            read_update_msu += ngt_msu
+            read_update_msu += lateness[alpha]
         
-        session_msu += read_update_msu
+        session_msu[0] += read_update_msu
 
-        if not read_update.nuggets:
-            session_pain += 1.0
-    # logger.debug('processed session msu ={}'.format(session_msu))
+        if ngt_offsets[upddata.index] == ngt_offsets[upddata.index+1]:
+            session_pain[0] += 1.0
 
-    topkqueue.re_minheapify(next_ssn_window_start)
-    # logger.debug('after re-minheap {} {}'.format(topkqueue.heap_size, [ (e.conf, e.index) for e in topkqueue.minheap][:topkqueue.heap_size+1]))
-    return session_msu, session_pain
+    expire(topkqueue, next_ssn_window_start)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef int find_max_heap_size(user_trail, window_starts, int num_sessions):    
-    cdef int wi = 0
-    cdef int ci = 0
-    cdef int heap_size = 0
-    cdef int max_heap_size = 0
-    # # logger.debug('num_sessions {}'.format(num_sessions))
-    for wi in xrange(num_sessions):
-        # # logger.debug('{}, w {}, s {}, check {} {}'.format(wi, window_starts[wi], user_trail[wi], ci, user_trail[ci]))
-        heap_size += user_trail[wi][1]
-        if max_heap_size < heap_size:
-            max_heap_size = heap_size
-        
-        while window_starts[wi] > user_trail[ci][0]:
-            heap_size -= user_trail[ci][1]
-            ci+=1
-        # # logger.debug('heap_size {} {}'.format(heap_size, max_heap_size))
-        
-    return max_heap_size
-
-
-
-#@cython.profile(True)
-@cython.boundscheck(False)
-@cython.wraparound(False)
-def _compute_ranked_user_MSU(user_trail, window_starts, ssn_starts, 
-            update_times, update_confidences, update_lengths, updates,
-            double user_reading_speed, double user_latency_tolerance,
-            double query_duration):
-    
-    # if user_index == 23:
-    #     logger.setLevel(logging.DEBUG)
-
-    user_topic_msu = 0.0
-    updates_read = {}
-    already_seen_ngts = {}        
-    
-    cdef int num_updates = len(update_times)    
-    cdef int num_sessions = len(user_trail)
-            
-    #topkqueue = []
-    #cdef int topkcount = 0
+cdef void ranked_user_MSU(const int* session_reads, const double* window_starts, const double* ssn_starts, int num_sessions,
+            const double* update_times, const double* update_confidences, const double* update_lengths, int num_updates,
+            const long* ngt_offsets, const long* ngt_indices,
+            const int* ngt_sessions, const double* lateness,
+            double user_reading_speed,
+            double query_duration,
+            UpdateHeap* topkqueue, unsigned char* updates_read, unsigned char* already_seen_ngts,
+            double* user_topic_msu, double* user_topic_pain, SimulationCounts* counts) nogil:
+    """
+    MSU of a user reading updates in ranked order [see _compute_ranked_user_MSU]
+    - topkqueue, updates_read (a bitset over updates) and already_seen_ngts
+      (one entry per nugget) must be reset for the user (scratch_reset)
+    - ngt_sessions and lateness are the user's lateness tables [see user_lateness]
+    - the work done is added to counts
+    """
+    user_topic_msu[0] = 0.0
+    user_topic_pain[0] = 0.0
     
-    heap_size_limit = find_max_heap_size(user_trail, window_starts, num_sessions)
-    # logger.debug('heap_size_limit {}'.format(heap_size_limit))    
-    cdef UpdateHeap topkqueue = UpdateHeap(heap_size_limit);
-    # logger.debug('made the queue')
-        
+    cdef int num_updates_read = 0
+    cdef int num_ngts_credited = 0
+    cdef int num_sessions_simulated = 0
     cdef int uti = 0
     cdef int wsi = 0
     cdef int upd_idx = 0
 
     cdef:
-        double ssn_start = 0.0
         double next_ssn_start = 0.0
         double next_ssn_window_start = 0.0
         double session_msu = 0.0
-        int ssn_reads = 0
+        double session_pain = 0.0
 
     while upd_idx < num_updates:
-        # update = updates[upd_idx]
-        
-        # logger.debug('-------')
-        # logger.debug('update {}: {}'.format(upd_idx, updates[upd_idx]))
-
 
         # check for window starts
         while wsi < num_sessions and window_starts[wsi] < update_times[upd_idx]:
-            #topkcount += user_trail[wsi][1]
-            topkqueue.update_topkcount(user_trail[wsi][1])
-            # logger.debug('window {} started; needs {} '.format(wsi, user_trail[wsi][1]))
+            update_topkcount(topkqueue, session_reads[wsi])
             wsi += 1
-        # logger.debug('topkcount {}'.format(topkqueue.topkcount))
 
         while uti < num_sessions and ssn_starts[uti] < update_times[upd_idx]:    
             # this is the first update beyond a session start
             # --> process this session
-            ssn_start = user_trail[uti][0]
-            ssn_reads = user_trail[uti][1]
             next_ssn_start = ssn_starts[uti+1] if uti +1 != num_sessions else query_duration            
             next_ssn_window_start = window_starts[uti+1] if uti +1 != num_sessions else query_duration
             
-            
-            session_msu, session_pain = process_session(updates_read, already_seen_ngts, updates,
-                                                    user_reading_speed, user_latency_tolerance,
-                                                    ssn_start, ssn_reads, uti,
-                                                    next_ssn_start, next_ssn_window_start,
-                                                    ssn_starts,
-                                                    topkqueue)
-            user_topic_msu += session_msu
+            process_session(topkqueue, updates_read, &num_updates_read, already_seen_ngts, &num_ngts_credited,
+                            ngt_offsets, ngt_indices, ngt_sessions, lateness,
+                            user_reading_speed,
+                            session_reads[uti], uti,
+                            next_ssn_start, next_ssn_window_start,
+                            False,
+                            &session_msu, &session_pain)
+            num_sessions_simulated += 1
+            user_topic_msu[0] += session_msu
             uti += 1
 
         if uti == num_sessions:
-            # logger.debug('all sessions processed')
+            # all sessions processed
             break
 
-        topkqueue.add_to_heap(upd_idx,
+        add_to_heap(topkqueue, upd_idx,
             update_times[upd_idx], update_confidences[upd_idx], update_lengths[upd_idx])
-        # logger.debug('checking/added update {} to queue {} {}'.format(upd_idx, topkqueue.heap_size, [(e.conf, e.index) for e in topkqueue.minheap][:topkqueue.heap_size+1]))
         
         upd_idx += 1            
 
     # handle sessions beyond the last update
-    if upd_idx >= len(updates):
-        # logger.debug('all updates processed.')        
-        pass
     while uti < num_sessions:
-        # logger.debug('processing leftover session')
-        ssn_start = user_trail[uti][0]
-        ssn_reads = user_trail[uti][1]
         next_ssn_start = ssn_starts[uti+1] if uti +1 != num_sessions else query_duration            
         next_ssn_window_start = window_starts[uti+1] if uti +1 != num_sessions else query_duration
         
-        session_msu, session_pain = process_session(updates_read, already_seen_ngts, updates,
-                                                user_reading_speed, user_latency_tolerance,
-                                                ssn_start, ssn_reads, uti,
-                                                next_ssn_start, next_ssn_window_start,
-                                                ssn_starts,
-                                                topkqueue)
-        user_topic_msu += session_msu
-        user_topic_pain += session_pain
-        if len(updates_read) == num_updates:
-            # logger.debug('read all updates')
+        process_session(topkqueue, updates_read, &num_updates_read, already_seen_ngts, &num_ngts_credited,
+                        ngt_offsets, ngt_indices, ngt_sessions, lateness,
+                        user_reading_speed,
+                        session_reads[uti], uti,
+                        next_ssn_start, next_ssn_window_start,
+                        False,
+                        &session_msu, &session_pain)
+        num_sessions_simulated += 1
+        user_topic_msu[0] += session_msu
+        user_topic_pain[0] += session_pain
+        if num_updates_read == num_updates:
+            # read all updates
             break
         if topkqueue.topkcount < 0:
-            # logger.debug('no more updates left to satisfy user needs')
+            # no more updates left to satisfy user needs
             break
         uti += 1
+
+    counts.sessions += num_sessions_simulated
+    counts.updates_read += num_updates_read
+    counts.heap_operations += topkqueue.operations
+    counts.nuggets_credited += num_ngts_credited
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _compute_ranked_user_MSU(const int[:] session_reads, const double[:] window_starts, const double[:] ssn_starts, 
+            const double[:] update_times, const double[:] update_confidences, const double[:] update_lengths, updates,
+            double user_reading_speed, double user_latency_tolerance,
+            double query_duration, long[:] counts=None):
     
-    # logger.debug('user_topic_msu {}'.format(user_topic_msu))
+    cdef const long[:] ngt_offsets = updates.ngt_offsets
+    cdef const long[:] ngt_indices = updates.ngt_indices
+    cdef const double[:] ngt_times = updates.ngt_times
+    cdef const long[:] ngt_order = updates.nugget_time_order()
+    cdef int num_updates = len(update_times)    
+    cdef int num_sessions = len(ssn_starts)
+    cdef double user_topic_msu = 0.0
+    cdef double user_topic_pain = 0.0
+
+    cdef int num_ngts = len(ngt_times)
+    cdef bint pooled
+    cdef UserScratch* scratch = acquire_scratch(1, num_updates, num_ngts, &pooled)
+
+    with nogil:
+        scratch_reset(scratch, num_updates, num_ngts)
+        memset(&scratch.counts, 0, sizeof(SimulationCounts))
+        if not user_lateness(scratch, &ssn_starts[0], num_sessions,
+                &ngt_times[0], &ngt_order[0], num_ngts, user_latency_tolerance):
+            scratch.heap.failed = True
+        else:
+            ranked_user_MSU(&session_reads[0], &window_starts[0], &ssn_starts[0], num_sessions,
+                &update_times[0], &update_confidences[0], &update_lengths[0], num_updates,
+                &ngt_offsets[0], &ngt_indices[0], scratch.ngt_sessions, scratch.lateness,
+                user_reading_speed, query_duration,
+                &scratch.heap, scratch.updates_read, scratch.already_seen_ngts,
+                &user_topic_msu, &user_topic_pain, &scratch.counts)
+
+    if counts is not None:
+        add_counts(counts, &scratch.counts)
+    cdef bint failed = scratch.heap.failed
+    release_scratch(scratch, 1, pooled)
+    if failed:
+        raise MemoryError()
 
     return user_topic_msu, user_topic_pain
 
@@ -464,115 +735,222 @@ def _compute_ranked_user_MSU(user_trail, window_starts, ssn_starts,
 #     return sessions
 
     
+
+    
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def _compute_push_ranked_user_MSU(user_trail, window_starts, ssn_starts, 
-            update_times, update_confidences, update_lengths, updates,
-            double user_reading_speed, double user_latency_tolerance,
+cdef void push_ranked_user_MSU(const int* session_reads, const double* window_starts, const double* ssn_starts, int num_sessions,
+            const double* update_times, const double* update_confidences, const double* update_lengths, int num_updates,
+            const long* ngt_offsets, const long* ngt_indices,
+            const int* ngt_sessions, const double* lateness,
+            double user_reading_speed,
             double query_duration,
-            bint ignore_verbosity):
-    
-    # if user_index == 23:
-    #     logger.setLevel(logging.DEBUG)
-
-    cdef double user_topic_msu = 0.0
-    cdef double user_topic_pain = 0.0
-    updates_read = {}
-    already_seen_ngts = {}        
+            bint ignore_verbosity,
+            UpdateHeap* topkqueue, unsigned char* updates_read, unsigned char* already_seen_ngts,
+            double* user_topic_msu, double* user_topic_pain, SimulationCounts* counts) nogil:
+    """
+    MSU (gain and pain) of a user reading updates in ranked order at every
+    (push or pull) session [see _compute_push_ranked_user_MSU]
+    - topkqueue, updates_read (a bitset over updates) and already_seen_ngts
+      (one entry per nugget) must be reset for the user (scratch_reset)
+    - ngt_sessions and lateness are the user's lateness tables [see user_lateness]
+    - the work done is added to counts
+    """
+    user_topic_msu[0] = 0.0
+    user_topic_pain[0] = 0.0
     
-    cdef int num_updates = len(update_times)    
-    cdef int num_sessions = len(user_trail)
-            
-    cdef int heap_size_limit = find_max_heap_size(user_trail, window_starts, num_sessions)
-    # logger.debug('heap_size_limit {}'.format(heap_size_limit))    
-    cdef UpdateHeap topkqueue = UpdateHeap(heap_size_limit);
-    # logger.debug('made the queue')
-        
+    cdef int num_updates_read = 0
+    cdef int num_ngts_credited = 0
+    cdef int num_sessions_simulated = 0
     cdef int uti = 0
     cdef int wsi = 0
     cdef int upd_idx = 0
 
     cdef:
-        double ssn_start = 0.0
         double next_ssn_start = 0.0
         double next_ssn_window_start = 0.0
         double session_msu = 0.0
-        int ssn_reads = 0
+        double session_pain = 0.0
 
     while upd_idx < num_updates:
-        # update = updates[upd_idx]
-        
-        # logger.debug('-------')
-        # logger.debug('update {}: {}'.format(upd_idx, updates[upd_idx]))
 
-        topkqueue.add_to_heap(upd_idx,
+        add_to_heap(topkqueue, upd_idx,
             update_times[upd_idx], update_confidences[upd_idx], update_lengths[upd_idx])
-        # logger.debug('checking/added update {} to queue {} {}'.format(upd_idx, topkqueue.heap_size, [(e.conf, e.index) for e in topkqueue.minheap][:topkqueue.heap_size+1]))
-
 
         # check for window starts
-        while wsi < num_sessions and (abs(window_starts[wsi] - update_times[upd_idx]) < 1e-8 or window_starts[wsi] - update_times[upd_idx] < 1e-8):
-            #topkcount += user_trail[wsi][1]
-            topkqueue.update_topkcount(user_trail[wsi][1])
-            # logger.debug('window {} started; needs {} '.format(wsi, user_trail[wsi][1]))
+        while wsi < num_sessions and (fabs(window_starts[wsi] - update_times[upd_idx]) < 1e-8 or window_starts[wsi] - update_times[upd_idx] < 1e-8):
+            update_topkcount(topkqueue, session_reads[wsi])
             wsi += 1
-        # logger.debug('topkcount {}'.format(topkqueue.topkcount))
 
-        while uti < num_sessions and (abs(ssn_starts[uti] - update_times[upd_idx]) < 1e-8 or ssn_starts[uti] - update_times[upd_idx] < 1e-8):    
+        while uti < num_sessions and (fabs(ssn_starts[uti] - update_times[upd_idx]) < 1e-8 or ssn_starts[uti] - update_times[upd_idx] < 1e-8):    
             # this is the first update beyond a session start
             # --> process this session
-            ssn_start = user_trail[uti][0]
-            ssn_reads = user_trail[uti][1]
             next_ssn_start = ssn_starts[uti+1] if uti +1 != num_sessions else query_duration            
             next_ssn_window_start = window_starts[uti+1] if uti +1 != num_sessions else query_duration
             
-            
-            session_msu, session_pain = process_session(updates_read, already_seen_ngts, updates,
-                                                    user_reading_speed, user_latency_tolerance,
-                                                    ssn_start, ssn_reads, uti,
-                                                    next_ssn_start, next_ssn_window_start,
-                                                    ssn_starts,
-                                                    topkqueue,
-                                                    ignore_verbosity)
-            user_topic_msu += session_msu
-            user_topic_pain += session_pain
+            process_session(topkqueue, updates_read, &num_updates_read, already_seen_ngts, &num_ngts_credited,
+                            ngt_offsets, ngt_indices, ngt_sessions, lateness,
+                            user_reading_speed,
+                            session_reads[uti], uti,
+                            next_ssn_start, next_ssn_window_start,
+                            ignore_verbosity,
+                            &session_msu, &session_pain)
+            num_sessions_simulated += 1
+            user_topic_msu[0] += session_msu
+            user_topic_pain[0] += session_pain
             uti += 1
 
         if uti == num_sessions:
-            # logger.debug('all sessions processed')
+            # all sessions processed
             break
 
         upd_idx += 1            
 
     # handle sessions beyond the last update
-    if upd_idx >= len(updates):
-        # logger.debug('all updates processed.')        
-        pass
     while uti < num_sessions:
-        # logger.debug('processing leftover session')
-        ssn_start = user_trail[uti][0]
-        ssn_reads = user_trail[uti][1]
         next_ssn_start = ssn_starts[uti+1] if uti +1 != num_sessions else query_duration            
         next_ssn_window_start = window_starts[uti+1] if uti +1 != num_sessions else query_duration
         
-        session_msu, session_pain = process_session(updates_read, already_seen_ngts, updates,
-                                               user_reading_speed, user_latency_tolerance,
-                                                ssn_start, ssn_reads, uti,
-                                                next_ssn_start, next_ssn_window_start,
-                                                ssn_starts,
-                                                topkqueue,
-                                                ignore_verbosity)
-        user_topic_msu += session_msu
-        user_topic_pain += session_pain
-        if len(updates_read) == num_updates:
-            # logger.debug('read all updates')
+        process_session(topkqueue, updates_read, &num_updates_read, already_seen_ngts, &num_ngts_credited,
+                        ngt_offsets, ngt_indices, ngt_sessions, lateness,
+                        user_reading_speed,
+                        session_reads[uti], uti,
+                        next_ssn_start, next_ssn_window_start,
+                        ignore_verbosity,
+                        &session_msu, &session_pain)
+        num_sessions_simulated += 1
+        user_topic_msu[0] += session_msu
+        user_topic_pain[0] += session_pain
+        if num_updates_read == num_updates:
+            # read all updates
             break
         if topkqueue.topkcount < 0:
-            # logger.debug('no more updates left to satisfy user needs')
+            # no more updates left to satisfy user needs
             break
         uti += 1
+
+    counts.sessions += num_sessions_simulated
+    counts.updates_read += num_updates_read
+    counts.heap_operations += topkqueue.operations
+    counts.nuggets_credited += num_ngts_credited
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _compute_push_ranked_user_MSU(const int[:] session_reads, const double[:] window_starts, const double[:] ssn_starts, 
+            const double[:] update_times, const double[:] update_confidences, const double[:] update_lengths, updates,
+            double user_reading_speed, double user_latency_tolerance,
+            double query_duration,
+            bint ignore_verbosity, long[:] counts=None):
     
-    # logger.debug('user_topic_msu {}'.format(user_topic_msu))
+    cdef const long[:] ngt_offsets = updates.ngt_offsets
+    cdef const long[:] ngt_indices = updates.ngt_indices
+    cdef const double[:] ngt_times = updates.ngt_times
+    cdef const long[:] ngt_order = updates.nugget_time_order()
+    cdef int num_updates = len(update_times)    
+    cdef int num_sessions = len(ssn_starts)
+    cdef double user_topic_msu = 0.0
+    cdef double user_topic_pain = 0.0
+
+    cdef int num_ngts = len(ngt_times)
+    cdef bint pooled
+    cdef UserScratch* scratch = acquire_scratch(1, num_updates, num_ngts, &pooled)
+
+    with nogil:
+        scratch_reset(scratch, num_updates, num_ngts)
+        memset(&scratch.counts, 0, sizeof(SimulationCounts))
+        if not user_lateness(scratch, &ssn_starts[0], num_sessions,
+                &ngt_times[0], &ngt_order[0], num_ngts, user_latency_tolerance):
+            scratch.heap.failed = True
+        else:
+            push_ranked_user_MSU(&session_reads[0], &window_starts[0], &ssn_starts[0], num_sessions,
+                &update_times[0], &update_confidences[0], &update_lengths[0], num_updates,
+                &ngt_offsets[0], &ngt_indices[0], scratch.ngt_sessions, scratch.lateness,
+                user_reading_speed, query_duration,
+                ignore_verbosity,
+                &scratch.heap, scratch.updates_read, scratch.already_seen_ngts,
+                &user_topic_msu, &user_topic_pain, &scratch.counts)
+
+    if counts is not None:
+        add_counts(counts, &scratch.counts)
+    cdef bint failed = scratch.heap.failed
+    release_scratch(scratch, 1, pooled)
+    if failed:
+        raise MemoryError()
 
     return user_topic_msu, user_topic_pain
 
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _compute_push_ranked_population_MSU(const long[:] trail_offsets, const int[:] session_reads, const double[:] window_starts, const double[:] ssn_starts, 
+            const double[:] update_times, const double[:] update_confidences, const double[:] update_lengths, updates,
+            const double[:] user_reading_speeds, const double[:] user_latency_tolerances,
+            double query_duration,
+            bint ignore_verbosity,
+            int num_threads=1, long[:] counts=None):
+    """
+    MSU (gain, pain) of every user of a population [see _compute_push_ranked_user_MSU]
+    - the (push and pull) session trails of all users are concatenated; user
+      i's sessions are ssn_starts[trail_offsets[i]:trail_offsets[i+1]]
+      (likewise session_reads and window_starts)
+    - users are evaluated in parallel by num_threads OpenMP threads (serially
+      if the module was built without OpenMP); every thread owns a heap and
+      the per-user state
+    - the work done by the simulations is added to counts, if given
+      [see evaluation_stats.SIMULATION_COUNTERS]
+    :return: gain and pain arrays, one entry per user
+    """
+    cdef const long[:] ngt_offsets = updates.ngt_offsets
+    cdef const long[:] ngt_indices = updates.ngt_indices
+    cdef const double[:] ngt_times = updates.ngt_times
+    cdef const long[:] ngt_order = updates.nugget_time_order()
+    cdef int num_updates = len(update_times)    
+    cdef int num_ngts = len(ngt_times)
+    cdef int num_users = len(trail_offsets) - 1
+    
+    user_topic_msus = numpy.zeros(num_users, dtype=float)
+    user_topic_pains = numpy.zeros(num_users, dtype=float)
+    cdef double[:] msus = user_topic_msus
+    cdef double[:] pains = user_topic_pains
+    if num_users == 0:
+        return user_topic_msus, user_topic_pains
+
+    cdef int i, ui, ti, first, num_sessions
+
+    # per-thread heaps and scratch state
+    num_threads = max(1, min(num_threads, num_users))
+    cdef bint pooled
+    cdef UserScratch* scratches = acquire_scratch(num_threads, num_updates, num_ngts, &pooled)
+    cdef int num_failed = 0
+    for i in xrange(num_threads):
+        memset(&scratches[i].counts, 0, sizeof(SimulationCounts))
+
+    for ui in prange(num_users, nogil=True, schedule='dynamic', num_threads=num_threads):
+        ti = threadid()
+        first = trail_offsets[ui]
+        num_sessions = trail_offsets[ui+1] - first
+
+        scratch_reset(&scratches[ti], num_updates, num_ngts)
+        if not user_lateness(&scratches[ti], &ssn_starts[first], num_sessions,
+                &ngt_times[0], &ngt_order[0], num_ngts, user_latency_tolerances[ui]):
+            scratches[ti].heap.failed = True
+        else:
+            push_ranked_user_MSU(&session_reads[first], &window_starts[first], &ssn_starts[first], num_sessions,
+                &update_times[0], &update_confidences[0], &update_lengths[0], num_updates,
+                &ngt_offsets[0], &ngt_indices[0], scratches[ti].ngt_sessions, scratches[ti].lateness,
+                user_reading_speeds[ui], query_duration,
+                ignore_verbosity,
+                &scratches[ti].heap, scratches[ti].updates_read, scratches[ti].already_seen_ngts,
+                &msus[ui], &pains[ui], &scratches[ti].counts)
+        # (a reduction: failed heaps are counted over all threads)
+        num_failed += scratches[ti].heap.failed
+
+    if counts is not None:
+        for i in xrange(num_threads):
+            add_counts(counts, &scratches[i].counts)
+    release_scratch(scratches, num_threads, pooled)
+    if num_failed:
+        raise MemoryError()
+
+    return user_topic_msus, user_topic_pains
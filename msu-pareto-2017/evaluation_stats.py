@@ -0,0 +1,158 @@
+# Opt-in instrumentation of an evaluation (--stats): wall time of the stages of
+# the MSU computation and counts of the work done by the user simulations, per
+# topic and per run, written to a json sidecar file.
+#
+# stages (seconds):
+#   load                             parsing a run and attaching gain (per run)
+#   compute_population_MSU           the whole MSU computation of a run (per run)
+#   sample_users_from_population     sampling a topic's users (and their sessions)
+#   initialize_structures_for_topic  presorting a topic's updates
+#   compute_user_MSU                 simulating the users over a topic's updates
+#                                    (_compute_user_MSU, or a population kernel)
+# counters:
+#   users, sessions (simulated), updates_read, heap_operations (pushes and pops
+#   of the ranked interfaces' heaps), nuggets_credited
+# adaptive evaluations (--adaptive_tolerance) also record the users and
+# confidence interval widths of every topic and of the AVG under "sampling"
+# [see adaptive_sampling.py]
+
+import time
+import json
+import contextlib
+import collections
+import numpy as np
+
+import utils
+
+RUN_STAGES = ['load', 'compute_population_MSU']
+TOPIC_STAGES = ['sample_users_from_population', 'initialize_structures_for_topic', 'compute_user_MSU']
+# in the order of SimulationCounts [see cython_computations.pyx]
+SIMULATION_COUNTERS = ['sessions', 'updates_read', 'heap_operations', 'nuggets_credited']
+
+
+def simulation_counts():
+    """
+    :return: zeroed counts of SIMULATION_COUNTERS, for the engines to add to
+    """
+    return np.zeros(len(SIMULATION_COUNTERS), dtype=np.int64)
+
+
+def _topic_totals():
+    totals = collections.OrderedDict( (stage, 0.0) for stage in TOPIC_STAGES )
+    totals['users'] = 0
+    totals.update( (counter, 0) for counter in SIMULATION_COUNTERS )
+    return totals
+
+
+def _run_totals():
+    totals = collections.OrderedDict( (stage, 0.0) for stage in RUN_STAGES )
+    totals.update(_topic_totals())
+    return totals
+
+
+def _add_totals(totals, other):
+    for name, value in other.iteritems():
+        totals[name] += value
+
+
+@contextlib.contextmanager
+def timed(stats, stage, qid=None):
+    """
+    times the enclosed block as stage (of topic qid) into stats; nothing is
+    timed when stats is None (instrumentation off)
+    """
+    if stats is None:
+        yield
+    else:
+        start = time.time()
+        yield
+        stats.add_time(stage, time.time() - start, qid)
+
+
+class EvaluationStats(object):
+    """
+    stage times and simulation counts of the runs of an evaluation, one record
+    per run: {"run", "labels", "totals", "topics": {qid: totals}} (and
+    "sampling" for adaptive evaluations)
+    """
+
+    def __init__(self):
+        self.runs = []
+        self.current = None
+
+    def start_run(self, runfile, **labels):
+        """
+        starts the record of runfile; labels tell apart records of the same
+        run (e.g. the grid cells of parameter_sweep.py)
+        """
+        self.current = collections.OrderedDict([('run', runfile), ('labels', labels),
+            ('totals', _run_totals()), ('topics', collections.OrderedDict())])
+
+    def finish_run(self):
+        """
+        adds the current record to the runs
+        """
+        if self.current is not None:
+            self.runs.append(self.current)
+            self.current = None
+
+    def _record(self, qid=None):
+        """
+        :return: totals of topic qid (of the run without qid) of the current record
+        """
+        if self.current is None:
+            self.start_run(None)
+        if qid is None:
+            return self.current['totals']
+        if qid not in self.current['topics']:
+            self.current['topics'][qid] = _topic_totals()
+        return self.current['topics'][qid]
+
+    def add_time(self, stage, seconds, qid=None):
+        totals = self._record(qid)
+        totals[stage] += seconds
+        if qid is not None:
+            self.current['totals'][stage] += seconds
+
+    def add_counts(self, qid, counts, num_users):
+        """
+        adds the simulation counts (in SIMULATION_COUNTERS order) of num_users
+        users of topic qid
+        """
+        totals = self._record(qid)
+        topic_counts = [('users', num_users)] + zip(SIMULATION_COUNTERS, map(int, counts))
+        _add_totals(totals, dict(topic_counts))
+        _add_totals(self.current['totals'], dict(topic_counts))
+
+    def add_sampling_report(self, report):
+        """
+        records the users and confidence interval widths of an adaptive
+        evaluation of the current run (qid --> values, with "AVG")
+        """
+        self._record()
+        self.current['sampling'] = collections.OrderedDict(
+            (qid, report[qid]) for qid in sorted(report.keys()) )
+
+    def topic_totals(self, qid):
+        return self._record(qid)
+
+    def merge_topic(self, qid, totals):
+        """
+        adds the totals of topic qid recorded by a forked worker
+        """
+        _add_totals(self._record(qid), totals)
+        _add_totals(self.current['totals'], totals)
+
+    def totals(self):
+        totals = _run_totals()
+        for record in self.runs:
+            _add_totals(totals, record['totals'])
+        return totals
+
+    def write(self, path):
+        """
+        writes the records of the finished runs, with their totals, to the
+        json file path
+        """
+        with utils.replaced_file(path) as sf:
+            json.dump(collections.OrderedDict([('totals', self.totals()), ('runs', self.runs)]), sf, indent=2)
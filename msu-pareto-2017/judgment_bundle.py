@@ -0,0 +1,193 @@
+# Compiled judgments of a track.
+# Reading the judgments (topic query durations, pool, matches with the
+# duplicates of the pool expanded, nuggets; qrels, tweet epochs and clusters
+# for the microblog tracks) parses XML, TSV and JSON files on every start of an
+# evaluation script. compile-qrels.py reads them once and writes them as
+# columns into a single versioned bundle file, which the evaluation scripts
+# (--judgments) memory-map and turn back into the same dictionaries.
+#
+# Bundle file: MAGIC, the length of a json header (8 bytes, little-endian), the
+# json header (version, track, nugget id type, and name --> [dtype, shape,
+# offset] of every column), then the columns, each aligned to ALIGNMENT bytes.
+
+import json
+import struct
+import itertools
+import numpy as np
+
+import utils
+
+MAGIC = 'MSUQRELS'
+# bump when the bundle format (or what is compiled into it) changes
+BUNDLE_VERSION = 1
+ALIGNMENT = 64
+
+
+def read_judgments(track, matches_file, nuggets_file, pool_file=None, topics_file=None, tweet_epoch_file=None):
+    """
+    reads the judgments of track from their files
+    :return: query_durns, pool, matches, nuggets (pool is None for the
+    microblog tracks)
+    """
+    pool = None
+    if track in ['ts13', 'ts14']:
+        # timestamps start from 0 at the topic's query start
+        query_durns = utils.get_topic_query_durations(topics_file, track)
+        # all duplicates have the same relevance judgement.
+        pool, duplicates = utils.read_in_pool_file(pool_file)
+        # ignored topics in the pool
+        if track == "ts13":
+            duplicates['7'] = {}
+            duplicates['9911'] = {}
+        # relevant updates (and their duplicates) with the nuggets they contain
+        matches = utils.read_in_matches_track_duplicates(matches_file, duplicates)
+        nuggets = utils.read_in_nuggets(nuggets_file, query_durns)
+    elif track in ['mb15', 'rts16']:
+        matches = utils.microblog_read_in_qrels(matches_file)
+        query_durns = utils.microblog_set_topic_query_durations(matches.keys(), track)
+        tweet_emit_times = utils.microblog_read_int_tweet_epochs(tweet_epoch_file)
+        # clusters with their earliest timestamp; matches of clustered tweets
+        # become their cluster ids
+        nuggets = utils.microblog_read_in_clusters(nuggets_file, query_durns, matches, tweet_emit_times, track)
+    return query_durns, pool, matches, nuggets
+
+
+def _topic_columns(topics):
+    """
+    :param topics: dictionary of qid --> dictionary (or set) of topic entries
+    :return: qids, CSR offsets of the topics' entries, and their keys, in
+    iteration order
+    """
+    qids = list(topics)
+    counts = [len(topics[qid]) for qid in qids]
+    offsets = np.zeros(len(qids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    keys = [str(key) for qid in qids for key in topics[qid]]
+    return np.array(qids, dtype=str), offsets, np.array(keys, dtype=str)
+
+
+def save_bundle(path, track, query_durns, pool, matches, nuggets):
+    """
+    writes the judgments read by read_judgments() into the bundle file path
+    """
+    columns = {}
+    qids = list(query_durns)
+    columns['durn_qids'] = np.array(qids, dtype=str)
+    columns['durn_starts'] = np.array([query_durns[qid][0] for qid in qids], dtype=float)
+    columns['durn_ends'] = np.array([query_durns[qid][1] for qid in qids], dtype=float)
+
+    if pool is not None:
+        columns['pool_qids'], columns['pool_offsets'], columns['pool_updids'] = _topic_columns(pool)
+
+    columns['match_qids'], columns['match_offsets'], columns['match_updids'] = _topic_columns(matches)
+    match_values = [matches[qid][updid] for qid in matches for updid in matches[qid]]
+    if track in ['ts13', 'ts14']:
+        # nugget ids of every matching update
+        counts = map(len, match_values)
+        columns['match_ngt_offsets'] = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=columns['match_ngt_offsets'][1:])
+        columns['match_ngtids'] = np.array(list(itertools.chain.from_iterable(match_values)), dtype=str)
+    else:
+        # relevance grades (ints) or cluster ids (ints for mb15, strings for rts16)
+        columns['match_values'] = np.array(map(str, match_values), dtype=str)
+        columns['match_value_is_int'] = np.array([isinstance(v, (int, long)) for v in match_values], dtype=bool)
+
+    columns['nugget_qids'], columns['nugget_offsets'], columns['nugget_ids'] = _topic_columns(nuggets)
+    nugget_values = [nuggets[qid][ngtid] for qid in nuggets for ngtid in nuggets[qid]]
+    columns['nugget_gains'] = np.array([v[0] for v in nugget_values], dtype=np.int64)
+    columns['nugget_times'] = np.array([v[1] for v in nugget_values], dtype=float)
+    nugget_ids_are_int = all(isinstance(ngtid, (int, long)) for qid in nuggets for ngtid in nuggets[qid])
+
+    header = {'version': BUNDLE_VERSION, 'track': track,
+        'nugget_id_type': 'int' if nugget_ids_are_int and nugget_values else 'str', 'columns': {}}
+    names = sorted(columns)
+    # column offsets depend on the header length, which depends on them;
+    # reserve room for offsets of up to 20 digits
+    for name in names:
+        header['columns'][name] = [columns[name].dtype.str, list(columns[name].shape), 10**19]
+    offset = _aligned(len(MAGIC) + 8 + len(json.dumps(header)))
+    for name in names:
+        header['columns'][name][2] = offset
+        offset = _aligned(offset + columns[name].nbytes)
+    header_json = json.dumps(header)
+
+    with utils.replaced_file(path, 'wb') as bf:
+        bf.write(MAGIC)
+        bf.write(struct.pack('<Q', len(header_json)))
+        bf.write(header_json)
+        for name in names:
+            bf.write('\0' * (header['columns'][name][2] - bf.tell()))
+            bf.write(columns[name].tobytes())
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _map_columns(path):
+    """
+    :return: header and name --> memory-mapped column of a bundle file
+    """
+    with open(path, 'rb') as bf:
+        if bf.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a judgment bundle (see compile-qrels.py)'.format(path))
+        header_length, = struct.unpack('<Q', bf.read(8))
+        header = json.loads(bf.read(header_length))
+    if header['version'] != BUNDLE_VERSION:
+        raise ValueError('judgment bundle {} has version {} (expected {}); compile it again with compile-qrels.py'.format(
+            path, header['version'], BUNDLE_VERSION))
+    columns = {}
+    for name, (dtype, shape, offset) in header['columns'].iteritems():
+        dtype = np.dtype(str(dtype))
+        if np.prod(shape) == 0 or dtype.itemsize == 0:
+            columns[name] = np.zeros(shape, dtype=dtype)
+        else:
+            columns[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+    return header, columns
+
+
+def _topic_slices(qids, offsets):
+    """
+    yields (qid, start, end) of every topic's entries
+    """
+    offsets = offsets.tolist()
+    return itertools.izip(qids.tolist(), offsets[:-1], offsets[1:])
+
+
+def load_bundle(path, track):
+    """
+    loads the judgments of a bundle file written by save_bundle() for track
+    :return: query_durns, pool, matches, nuggets (as read_judgments() returns them)
+    """
+    header, columns = _map_columns(path)
+    if header['track'] != track:
+        raise ValueError('judgment bundle {} is for track {}, not {}'.format(path, header['track'], track))
+
+    query_durns = dict( (qid, (start, end)) for qid, start, end in itertools.izip(
+        columns['durn_qids'].tolist(), columns['durn_starts'].tolist(), columns['durn_ends'].tolist()) )
+
+    pool = None
+    if 'pool_qids' in columns:
+        updids = columns['pool_updids'].tolist()
+        pool = dict( (qid, set(updids[start:end]))
+            for qid, start, end in _topic_slices(columns['pool_qids'], columns['pool_offsets']) )
+
+    updids = columns['match_updids'].tolist()
+    if 'match_ngtids' in columns:
+        ngtids = columns['match_ngtids'].tolist()
+        ngt_offsets = columns['match_ngt_offsets'].tolist()
+        match_values = [ngtids[start:end] for start, end in itertools.izip(ngt_offsets[:-1], ngt_offsets[1:])]
+    else:
+        match_values = [int(value) if is_int else value for value, is_int in itertools.izip(
+            columns['match_values'].tolist(), columns['match_value_is_int'].tolist())]
+    matches = dict( (qid, dict(itertools.izip(updids[start:end], match_values[start:end])))
+        for qid, start, end in _topic_slices(columns['match_qids'], columns['match_offsets']) )
+
+    ngtids = columns['nugget_ids'].tolist()
+    if header['nugget_id_type'] == 'int':
+        ngtids = map(int, ngtids)
+    nugget_values = zip(columns['nugget_gains'].tolist(), columns['nugget_times'].tolist())
+    nuggets = dict( (qid, dict(itertools.izip(ngtids[start:end], nugget_values[start:end])))
+        for qid, start, end in _topic_slices(columns['nugget_qids'], columns['nugget_offsets']) )
+
+    return query_durns, pool, matches, nuggets
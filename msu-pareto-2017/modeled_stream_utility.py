@@ -3,20 +3,33 @@
 import sys
 import os
 import gc
+import time
 import argparse
 import numpy as np
 import bisect 
 from collections import defaultdict
+import itertools
 import array
 import gzip
+import multiprocessing
 
 from update import Update
+from update import TopicUpdates
 from nugget import Nugget
 
 from population_model import LognormalPopulationModel
 from user_model import UserModel
+from user_model import UserPopulationArrays
 from user_interface_model import ReverseChronologicalInterfaceMixin
-import utils
+from vectorized_computations import _compute_reverse_chrono_population_MSU
+import judgment_bundle
+import update_lengths
+import run_cache
+import run_loader
+import evaluation_stats
+import profiling
+import adaptive_sampling
+import paired_comparison
 
 import logging
 logger = logging.getLogger(__name__)
@@ -37,6 +50,20 @@ def logargs(func):
     return inner
 
 
+# (evaluator, run, query_durns) set by compute_population_MSU() right before
+# forking topic workers; the workers inherit them copy-on-write
+_forked_topic_evaluation = None
+
+def _compute_forked_topic_MSU(qid):
+    evaluator, run, query_durns = _forked_topic_evaluation
+    user_msus, user_pains = evaluator._compute_topic_MSU(qid, run[qid], query_durns[qid][1] - query_durns[qid][0])
+    # the worker's stats are lost with it: the topic's are sent back
+    topic_stats = None
+    if evaluator.stats is not None:
+        topic_stats = evaluator.stats.topic_totals(qid)
+    return user_msus, user_pains, topic_stats
+
+
 class ModeledStreamUtility(object):
     """
     Modeled Stream Utility evaluates systems that produce streams of updates.
@@ -49,67 +76,43 @@ class ModeledStreamUtility(object):
         super(ModeledStreamUtility, self).__init__()
         self.num_users = num_users
         self.track = ""
+        # number of processes computing topics in parallel
+        self.topic_workers = 1
+        # stage times and simulation counts, when instrumented (--stats)
+        # [see evaluation_stats.py]; the engines add the counts of a topic's
+        # simulations to topic_counts
+        self.stats = None
+        self.topic_counts = None
+        # batches of users simulated until the topic means converge, when
+        # adaptive (--adaptive_tolerance) [see adaptive_sampling.py]; users,
+        # gain_ci_width and pain_ci_width per topic (and "AVG") of the last
+        # run in sampling_report
+        self.adaptive = None
+        self.sampling_report = None
+        # gain and pain of every (user, topic) of the runs compared pairwise,
+        # when recorded (--paired) [see paired_comparison.py]
+        self.paired = None
     
     @staticmethod
-    def load_run_and_attach_gain(runfile, updlens, nuggets, matches, useAverageLengths, track, query_durns, pool, restrict_to_pool = False):
+    def load_run_and_attach_gain(runfile, updlens, nuggets, matches, useAverageLengths, track, query_durns, pool, restrict_to_pool = False,
+            judgment_tables=None):
         """
         This function attaches gain (nuggets) to sentences of a run, on the fly
+        (streaming the run file a chunk of lines at a time [see run_loader.load_run])
+        judgment_tables: run_loader.JudgmentTables shared by the runs loaded
+        with the same judgments
+        :return: dictionary of qid --> TopicUpdates
         """
 
-        run = {}        
-        with open(runfile) as rf:
-            for line in rf:
-                if len(line.strip()) == 0: continue
-                qid, teamid, runid, docid, sentid, updtime, confidence = line.strip().split() 
-                if track == 'ts14':
-                    qid = 'TS14.'+qid
-                updid = docid + '-' + sentid
-                
-                if qid not in pool:
-                    continue
-
-                if restrict_to_pool and updid not in pool[qid] :                    
-                    continue
-
-                updtime = float(updtime) - query_durns[qid][0] # timestamps to start from 0               
-                confidence = float(confidence)
-                updlen = 30 if not useAverageLengths else updlens[qid]["topic.avg.update.length"]     #default updlen is 30
-                if updid in updlens[qid]:
-                    updlen = updlens[qid][updid]
-                else:
-                    pass
-                    #print >> sys.stderr, 'no length for ', updid
-                
-                if qid not in run:
-                    run[qid] = []
-                    
-                    
-                #gain for update
-                ngtstr = ""
-                num_ngts = 0
-                matching_nuggets = []
-                if updid in matches[qid]:  #update is relevant                
-                    ngts_in_upd = matches[qid][updid]                
-                    for ngtid in ngts_in_upd:
-                        if ngtid not in nuggets[qid]: # there are 2 nuggets not in nuggets.tsv
-                            continue
-                        num_ngts += 1
-                        ngt_gain, ngt_time = nuggets[qid][ngtid]      
-                        # ngtstr += ','.join([ str(s) for s in [ngtid, ngt_gain, ngt_time] ])
-                        # ngtstr += ' '
-                        matching_nuggets.append(Nugget(ngtid, ngt_gain, ngt_time))              
-                
-                #run[qid].append( [updtime, confidence, updid, updlen, num_ngts, ngtstr] )
-                updobj = Update(qid, updid, updtime, confidence, updlen, num_ngts, ngtstr)
-                updobj.nuggets = matching_nuggets
-                if qid not in run:
-                    run[qid] = []
-                run[qid].append(updobj)                
-        return run
+        return run_loader.load_run(runfile, updlens, nuggets, matches, useAverageLengths,
+            track, query_durns, pool, restrict_to_pool, judgment_tables=judgment_tables)
 
     @staticmethod
-    def microblog_load_run_and_attach_gain(runfile, nuggets, matches, track, query_durns):
+    def microblog_load_run_and_attach_gain(runfile, nuggets, matches, track, query_durns, judgment_tables=None):
         run = {}
+        if judgment_tables is None:
+            judgment_tables = run_loader.JudgmentTables(None, matches, nuggets)
+        topic_nuggets = judgment_tables.topic_nuggets
         qids_matched = defaultdict(int)
         qids_ignored = defaultdict(int)
         with gzip.open(runfile) as rf:
@@ -137,14 +140,11 @@ class ModeledStreamUtility(object):
                     mc = matches[qid][tweet]                    
                     if qid in nuggets and mc in nuggets[qid]:
                         mcgain, mctime = nuggets[qid][mc]                
-                        matching_nuggets.append(Nugget(mc, mcgain, mctime))                
+                        matching_nuggets.append((mc, mcgain, mctime))
         
-                updobj = Update(qid, tweet, epoch, 1.0, 140/5.1, len(matching_nuggets), "")
-                updobj.nuggets = matching_nuggets
-
                 if qid not in run:
-                    run[qid] = []
-                run[qid].append(updobj) 
+                    run[qid] = TopicUpdates(qid, topic_nuggets.get(qid))
+                run[qid].append(tweet, epoch, 1.0, 140/5.1, matching_nuggets)
 
         # print len(qids_matched),qids_matched
         # print len(qids_ignored),qids_ignored
@@ -172,7 +172,7 @@ class ModeledStreamUtility(object):
         ```
         - [see also] trec_tst_2013_preprocessing.py
         :param run_gain_file: file path to the gain-attached-run
-        :param run: [out] dictionary that is populated with the data from the file
+        :param run: [out] dictionary (qid --> TopicUpdates) that is populated with the data from the file
         """
         logger.warning( 'loading gain attached run ' + run_gain_file)
         
@@ -184,10 +184,10 @@ class ModeledStreamUtility(object):
                     fields += [""]        
                 qid, updtime, updconf, updid, updlen, numngts, ngtstr = fields
                 # NOTE: updid comes after confidence in gain attached runs
-                upd = Update(qid, updid, updtime, updconf, updlen, numngts, ngtstr)
-                if upd.qid not in run:
-                    run[upd.qid] = []
-                run[upd.qid].append(upd)
+                if qid not in run:
+                    run[qid] = TopicUpdates(qid)
+                run[qid].append(updid, updtime, updconf, updlen,
+                    [ngt.split(',') for ngt in ngtstr.split()])
 
     #def update_presentation_order(self, oldest_available_update_index, most_recent_update_index,
     #    updates):
@@ -200,10 +200,12 @@ class ModeledStreamUtility(object):
     #    # class MSUReverseChronoOrder]
     #    raise NotImplementedError
     
-    def sample_users_from_population(self, query_duration):
+    def sample_users_from_population(self, query_duration, qid=None, users=None):
         """
         The compute_population_MSU() method calls this method to re-sample population for every query.
         This is sometimes useful when we are modifying user sims data during MSU computation.
+        qid keys the users' random streams [see PopulationModel.user_random_state]
+        users are the indices of the users to sample (all num_users by default)
         """
         raise NotImplementedError    
 
@@ -216,6 +218,33 @@ class ModeledStreamUtility(object):
         # NOTE: this function needs to be implemented based on the user
         # interface model [see class MSUReverseChronoOrder]
         raise NotImplementedError 
+
+    def _compute_population_user_MSU(self, updates):
+        """
+        simulate all sampled users over the given set of updates. [called for
+        each topic's updates]
+        Engines that can evaluate the whole population in one call override
+        this; by default each user is simulated with _compute_user_MSU()
+        :return: arrays of gain and pain, one entry per sampled user
+        """
+        num_users = len(self.sampled_users)
+        user_msus = np.zeros(num_users, dtype=float)
+        user_pains = np.zeros(num_users, dtype=float)
+
+        usercount = 0
+        while usercount < num_users:
+            logger.info('user ' + str(usercount))
+
+            # simulate user
+            user_sim = self.sampled_users[usercount]
+
+            # compute MSU for this user_sim for this topic
+            user_msus[usercount], user_pains[usercount] = self._compute_user_MSU(user_sim, updates)
+            logger.debug('user {} {} gain {} pain {}'.format(usercount, user_sim, user_msus[usercount], user_pains[usercount]))
+
+            usercount += 1
+
+        return user_msus, user_pains
     
     def initialize_structures_for_topic(self, topic_updates):
         """
@@ -223,6 +252,70 @@ class ModeledStreamUtility(object):
         """
         raise NotImplementedError
 
+    def _compute_topic_MSU(self, qid, topic_updates, query_duration):
+        """
+        samples the user population and computes the gain and pain of every
+        user for a single topic's updates
+        :return: arrays of gain and pain, one entry per sampled user
+        """
+        logger.warning('topic ' + str(qid) + '----------')
+        stats = self.stats
+        if stats is not None:
+            self.topic_counts = evaluation_stats.simulation_counts()
+
+        if self.adaptive is not None:
+            return self._compute_adaptive_topic_MSU(qid, topic_updates, query_duration)
+
+        # reset the seed so that the same users are
+        # generated every time sample_users_from_population() function is called
+        self.population_model.reset_random_seed()
+        with evaluation_stats.timed(stats, 'sample_users_from_population', qid):
+            self.sample_users_from_population(query_duration, qid)
+
+        logger.info('presorting/initializing updates')
+        with evaluation_stats.timed(stats, 'initialize_structures_for_topic', qid):
+            self.initialize_structures_for_topic(topic_updates)
+
+        # for users in population
+        with evaluation_stats.timed(stats, 'compute_user_MSU', qid):
+            user_msus, user_pains = self._compute_population_user_MSU(topic_updates)
+
+        if stats is not None:
+            stats.add_counts(qid, self.topic_counts, self.num_users)
+            self.topic_counts = None
+
+        return user_msus, user_pains
+
+    def _compute_adaptive_topic_MSU(self, qid, topic_updates, query_duration):
+        """
+        simulates batches of a topic's users until the standard errors of the
+        topic's mean gain and pain are within the tolerance of self.adaptive
+        [see _compute_topic_MSU()]
+        :return: arrays of gain and pain, one entry per simulated user
+        """
+        stats = self.stats
+        logger.info('presorting/initializing updates')
+        with evaluation_stats.timed(stats, 'initialize_structures_for_topic', qid):
+            self.initialize_structures_for_topic(topic_updates)
+
+        user_msus = np.zeros(0, dtype=float)
+        user_pains = np.zeros(0, dtype=float)
+        for users in self.adaptive.batches():
+            with evaluation_stats.timed(stats, 'sample_users_from_population', qid):
+                self.sample_users_from_population(query_duration, qid, users)
+            with evaluation_stats.timed(stats, 'compute_user_MSU', qid):
+                batch_msus, batch_pains = self._compute_population_user_MSU(topic_updates)
+            user_msus = np.concatenate((user_msus, batch_msus))
+            user_pains = np.concatenate((user_pains, batch_pains))
+            if self.adaptive.converged(user_msus, user_pains):
+                break
+
+        if stats is not None:
+            stats.add_counts(qid, self.topic_counts, len(user_msus))
+            self.topic_counts = None
+
+        return user_msus, user_pains
+
     def compute_population_MSU(self, run, query_durns, num_topics):
         """
         computes MSU for each user in specified population and returns the
@@ -235,67 +328,69 @@ class ModeledStreamUtility(object):
         # if not self.sampled_users:
         #     self.sample_users_from_population()
 
+        global _forked_topic_evaluation
+
+        start = time.time()
         gc.collect()
         
-        # intermediate MSUs for users and topics
+        # intermediate MSUs for users and topics (for adaptive evaluations,
+        # the users of each topic)
+        topic_users = {}
         msu_user_topic = np.zeros( (self.num_users, num_topics), dtype=float)
         pain_user_topic = np.zeros( (self.num_users, num_topics), dtype=float)
         tpc_idx = dict( [ (t, i) for i, t in enumerate(sorted(run.keys())) ] )
 
-        # for each topic
-        for qid in sorted(run.keys()):
+        if self.topic_workers > 1:
+            # every topic reseeds the population model, so topics can be
+            # computed independently by forked workers
+            _forked_topic_evaluation = (self, run, query_durns)
+            workers = multiprocessing.Pool(self.topic_workers)
+            topic_results = workers.imap(_compute_forked_topic_MSU, sorted(run.keys()))
+        else:
+            topic_results = ( self._compute_topic_MSU(qid, run[qid], query_durns[qid][1] - query_durns[qid][0]) + (None,)
+                for qid in sorted(run.keys()) )
 
-            logger.warning('topic ' + str(qid) + '----------')
-            
-            # reset the seed so that the same users are
-            # generated every time sample_users_from_population() function is called
-            self.population_model.reset_random_seed()
-            self.sample_users_from_population(query_durns[qid][1] - query_durns[qid][0])
-            
-            topic_updates = []
-            gc.collect()
-            
-            topic_updates = run[qid]
+        # for each topic
+        for qid, (user_msus, user_pains, forked_topic_stats) in itertools.izip(sorted(run.keys()), topic_results):
+            if forked_topic_stats is not None:
+                self.stats.merge_topic(qid, forked_topic_stats)
 
-            logger.info('presorting/initializing updates')
-            self.initialize_structures_for_topic(topic_updates)
+            if self.adaptive is not None:
+                topic_users[qid] = (user_msus, user_pains)
+                continue
 
-            
-            #self.presort_updates(topic_updates)
-            
-            # time stamps of updates are stored separately for efficient searching
-            # bisect on objects works [NO] 
-            # TODO: try with numpy.searchsorted on an array of  timestamps in
-            # an array; also TODO: how to clear and delete numpy vars
-            # extracting update times for faster search
-            
-                            
-            # for users in population
-            usercount = 0
-            while usercount < self.num_users:
-                logger.info('user ' + str(usercount))
-                
-                # simulate user
-                user_sim = self.sampled_users[usercount]
-                
-                # compute MSU for this user_sim for this topic qid
-                user_msu, user_pain = self._compute_user_MSU(user_sim, topic_updates)
-                logger.debug('user {} {} gain {} pain {}'.format(usercount, user_sim, user_msu, user_pain))
+            # store for each user and topic
+            msu_user_topic[:, tpc_idx[qid]] = user_msus
+            pain_user_topic[:, tpc_idx[qid]] = user_pains
                 
-                # store for each user and topic
-                msu_user_topic[usercount][tpc_idx[qid]] = user_msu
-                pain_user_topic[usercount][tpc_idx[qid]] = user_pain
-                #logger.debug('{0} {1}'.format(user_sim, user_msu))                
-                #logger.debug('USERMSU:\t{}\t{}\t{}'.format(usercount+1, qid, user_msu))
-                
-                usercount += 1
-                
-            self.update_emit_times == []
-            
             # #logger.debug('Breaking here just to check on generated user ssn and away times')
             # if qid > 1:
             #     break
 
+        if self.topic_workers > 1:
+            workers.close()
+            workers.join()
+            _forked_topic_evaluation = None
+
+        if self.adaptive is not None:
+            run_msu, run_pain = self._aggregate_adaptive_population_MSU(topic_users, num_topics)
+        else:
+            run_msu, run_pain = self._aggregate_population_MSU(run, msu_user_topic, pain_user_topic)
+            if self.paired is not None:
+                self.paired.add_user_scores(sorted(run.keys()), msu_user_topic, pain_user_topic)
+        if self.stats is not None:
+            self.stats.add_time('compute_population_MSU', time.time() - start)
+        return run_msu, run_pain
+
+    def _aggregate_population_MSU(self, run, msu_user_topic, pain_user_topic):
+        """
+        averages the gain and pain of every (user, topic) of a run [see
+        compute_population_MSU()]
+        :return: dictionaries of mean MSU and pain per topic, with their mean
+        across topics as "AVG"
+        """
+        tpc_idx = dict( [ (t, i) for i, t in enumerate(sorted(run.keys())) ] )
+
         logger.info('user topic msu')
         logger.info('\n' + '\n'.join([str(m) for m in msu_user_topic]))
 
@@ -332,6 +427,35 @@ class ModeledStreamUtility(object):
         #return msu_per_user
         return run_msu, run_pain
 
+    def _aggregate_adaptive_population_MSU(self, topic_users, num_topics):
+        """
+        averages the gain and pain of the users of every topic, which may
+        differ in number (adaptive evaluations [see
+        _compute_adaptive_topic_MSU()]); the AVG is the mean of the topic means
+        over num_topics topics, as in _aggregate_population_MSU(). The users
+        and confidence interval widths are kept in sampling_report
+        :return: dictionaries of mean MSU and pain per topic, with their mean
+        across topics as "AVG"
+        """
+        run_msu = {}
+        run_pain = {}
+        self.sampling_report = {}
+        for qid, (user_msus, user_pains) in topic_users.iteritems():
+            run_msu[qid] = np.mean(user_msus, dtype=float)
+            run_pain[qid] = np.mean(user_pains, dtype=float)
+            self.sampling_report[qid] = self.adaptive.topic_report(user_msus, user_pains)
+        run_msu["AVG"] = sum(run_msu.values()) / num_topics
+        run_pain["AVG"] = sum(run_pain.values()) / num_topics
+        self.sampling_report["AVG"] = self.adaptive.average_report(topic_users.values(), num_topics)
+
+        for qid in sorted(topic_users.keys()) + ["AVG"]:
+            report = self.sampling_report[qid]
+            logger.warning('topic {} users {} gain {} (CI width {:.4f}) pain {} (CI width {:.4f})'.format(qid,
+                report['users'], run_msu[qid], report['gain_ci_width'], run_pain[qid], report['pain_ci_width']))
+        if self.stats is not None:
+            self.stats.add_sampling_report(self.sampling_report)
+        return run_msu, run_pain
+
 
 class MSUReverseChronoOrder(ModeledStreamUtility, \
     ReverseChronologicalInterfaceMixin):
@@ -340,7 +464,7 @@ class MSUReverseChronoOrder(ModeledStreamUtility, \
     """
 
     def __init__(self, num_users, pop_session_durn_mean, pop_session_durn_stddev,
-        pop_time_away_mean, pop_time_away_stddev, pop_lateness_decay):
+        pop_time_away_mean, pop_time_away_stddev, pop_lateness_decay, rng_mode='legacy'):
         # TODO: population models can be mixins for future versions of MSU.
         # i.e. we may have population distribution specific
         # ModeledStreamUtility evaluation classes
@@ -349,7 +473,7 @@ class MSUReverseChronoOrder(ModeledStreamUtility, \
 
         self.population_model = LognormalPopulationModel(self.seed,
             pop_time_away_mean, pop_time_away_stddev, pop_session_durn_mean,
-            pop_session_durn_stddev, pop_lateness_decay)
+            pop_session_durn_stddev, pop_lateness_decay, rng_mode)
         
         #self.num_users = num_users
         logger.warning("num users %d" % (self.num_users,))
@@ -359,8 +483,12 @@ class MSUReverseChronoOrder(ModeledStreamUtility, \
 
     def initialize_structures_for_topic(self, topic_updates):
         self.presort_updates(topic_updates)
+        self.update_emit_times = topic_updates.times.tolist()
+        self.update_lengths = topic_updates.wlens.tolist()
+        self.ngt_offsets = topic_updates.ngt_offsets.tolist()
+        self.ngt_indices = topic_updates.ngt_indices.tolist()
 
-    def sample_users_from_population(self, query_duration):
+    def sample_users_from_population(self, query_duration, qid=None, users=None):
         if self.sampled_users:
             self.sampled_users = []
         
@@ -369,9 +497,10 @@ class MSUReverseChronoOrder(ModeledStreamUtility, \
         self.population_model.reset_random_seed()
             
         # sampling user params for one user at a time
-        for ui in xrange(self.num_users):
-            A, D, V, L = self.population_model.generate_user_params()
-            self.sampled_users.append(UserModel(A,D,V,L))         
+        for ui in (users if users is not None else xrange(self.num_users)):
+            random_state = self.population_model.user_random_state(qid, ui)
+            A, D, V, L = self.population_model.generate_user_params(random_state=random_state)
+            self.sampled_users.append(UserModel(A,D,V,L, random_state))         
             # with open('debugging/py.all.users', 'w') as utf:
             #     for A,D,V,L in self.sampled_users:
             #         print >> utf, '\t'.join(map(str,[D,A,V]))
@@ -394,9 +523,9 @@ class MSUReverseChronoOrder(ModeledStreamUtility, \
             #user.generate_session_away_lengths(240*3600, True)
             user.generate_session_away_lengths(query_duration, True)
             
-            # #logger.debug(str(len(user.session_away_durations)))
+            # #logger.debug(str(len(user.session_durations)))
             # with open('debugging/py.ssn.away.times.user-{}'.format(useri+1), 'w') as utf:
-            #     for ssn, away in user.session_away_durations:
+            #     for ssn, away in zip(user.session_durations, user.away_durations):
             #         print >> utf, '\t'.join(map(str,[ssn, away]))
             useri += 1
             # if useri == 2:
@@ -412,21 +541,34 @@ class MSUReverseChronoOrder(ModeledStreamUtility, \
         #logger.debug('user session and away times:')
 
         user_topic_msu = 0.0
+        user_topic_pain = 0.0
         current_time = 0.0
         oldest_available_update_idx = 0
 
         updates_read = defaultdict(bool)
         #updates_read = set()
         already_seen_ngts = {}
-        ssn_starts = [0.0]
         num_updates = len(updates)
+
+        # lateness lookups for this user: the number of sessions started at
+        # each nugget's time (bisect.bisect(ssn_starts, ngt.time)) and
+        # L ** alpha for alpha = 0 .. num sessions - 1
+        # session starts accumulate exactly as current_time does below
+        steps = np.empty(2*len(user_instance.session_durations), dtype=float)
+        steps[0::2] = user_instance.session_durations
+        steps[1::2] = user_instance.away_durations
+        ssn_starts = np.concatenate(([0.0], np.cumsum(steps)[1:-1:2]))
+        ngt_sessions = np.searchsorted(ssn_starts, updates.ngt_times, side='right').tolist()
+        lateness = (self.population_model.L ** np.arange(len(ssn_starts), dtype=float)).tolist()
+        ssn_idx = 0
         
         # for writing individual session away times to file
         #ssn_durns = []
         #away_durns = []
 
         for session_duration, time_away in \
-            user_instance.session_away_durations:
+            itertools.izip(user_instance.session_durations.tolist(),
+                user_instance.away_durations.tolist()):
             #user_instance.generate_session_away_lengths(864000):
             
             #logger.debug('NEW SSN: current: %f session.length: %f time.away: %f' % (current_time, session_duration, time_away))
@@ -455,8 +597,7 @@ class MSUReverseChronoOrder(ModeledStreamUtility, \
                 self.update_presentation_order(oldest_available_update_idx,
                     latest_update_idx, updates): 
 
-                update = updates[upd_idx]
-                #logger.debug('upd_idx = {0}, {1}'.format(upd_idx, str(update)))
+                #logger.debug('upd_idx = {0}, {1}'.format(upd_idx, str(updates[upd_idx])))
                 #logger.debug('upd_idx {}, upd_id {}'.format(upd_idx, update.updid))
 
                 if upd_idx in updates_read:
@@ -468,7 +609,7 @@ class MSUReverseChronoOrder(ModeledStreamUtility, \
                     #logger.debug('update already read')
                     break 
 
-                upd_time_to_read = ( float(update.wlen) / user_instance.V)
+                upd_time_to_read = ( self.update_lengths[upd_idx] / user_instance.V)
                 #logger.debug('upd_time_to_read = {0}, time_remaining = {1}'.format(upd_time_to_read, time_remaining))
                 if upd_time_to_read > time_remaining:
                     # user could not completely read update
@@ -496,39 +637,77 @@ class MSUReverseChronoOrder(ModeledStreamUtility, \
                 update_msu = 0.0
                 
                 # check for gain
-                for ngt in update.nuggets:
-                    if ngt.ngtid in already_seen_ngts: 
+                first_ngt = self.ngt_offsets[upd_idx]
+                last_ngt = self.ngt_offsets[upd_idx+1]
+                for ngt in self.ngt_indices[first_ngt:last_ngt]:
+                    if ngt in already_seen_ngts: 
                         continue
-                    ngt_after = bisect.bisect(ssn_starts, ngt.time)
-                    alpha = (len(ssn_starts)-1) - ngt_after
-                    #logger.debug('alpha {} = {} - {}'.format(alpha, (len(ssn_starts)-1), ngt_after)) 
-                    already_seen_ngts[ngt.ngtid] = alpha                        
+                    alpha = ssn_idx - ngt_sessions[ngt]
+                    #logger.debug('alpha {} = {} - {}'.format(alpha, ssn_idx, ngt_sessions[ngt])) 
+                    already_seen_ngts[ngt] = alpha                        
                     alpha = 0 if alpha < 0 else alpha                    
-                    ngt_msu = (self.population_model.L ** alpha)
+                    ngt_msu = lateness[alpha]
                     # TODO: ^^ non binary gain flag 
                     #logger.debug(' '.join(map(str, ['ngt gain = ', len(ssn_starts), ngt_after, alpha, ngt_msu, ngt])))
                     update_msu += ngt_msu
                     
                 user_topic_msu += update_msu
+
+                if first_ngt == last_ngt:
+                    user_topic_pain += 1.0
                 #logger.debug('msu = {}'.format(user_topic_msu))
                 #logger.debug(' '.join(map(str, ['MSU++:', update_msu, user_topic_msu])))
 
             current_time += session_duration
             current_time += time_away
-            ssn_starts.append(current_time)
+            ssn_idx += 1
+
+        if self.topic_counts is not None:
+            # (no heap in reverse chronological order)
+            self.topic_counts += (ssn_idx, len(updates_read), 0, len(already_seen_ngts))
          
-        return user_topic_msu #, ssn_durns, away_durns
+        return user_topic_msu, user_topic_pain #, ssn_durns, away_durns
+
+
+class MSUVectorizedReverseChronoOrder(MSUReverseChronoOrder):
+    """
+    Simulates the same users as MSUReverseChronoOrder, but the whole
+    population is evaluated in one call with numpy operations over per-topic
+    columns of updates [see vectorized_computations.py]
+    """
+
+    def sample_users_from_population(self, query_duration, qid=None, users=None):
+        super(MSUVectorizedReverseChronoOrder, self).sample_users_from_population(query_duration, qid, users)
+        self.sampled_population = UserPopulationArrays(self.sampled_users)
+
+    def initialize_structures_for_topic(self, topic_updates):
+        self.presort_updates(topic_updates)
+        self.update_emit_times = topic_updates.times
+        self.update_lengths = topic_updates.wlens
+        self.ngt_offsets = topic_updates.ngt_offsets
+        self.ngt_indices = topic_updates.ngt_indices
+        self.ngt_times = topic_updates.ngt_times
+
+    def _compute_population_user_MSU(self, updates):
+        population = self.sampled_population
+        return _compute_reverse_chrono_population_MSU(population.trail_offsets,
+            population.ssn_durations, population.away_durations,
+            population.V, population.L,
+            self.update_emit_times, self.update_lengths,
+            self.ngt_offsets, self.ngt_indices, self.ngt_times, self.topic_counts)
 
 
 if __name__ == "__main__":
     
     ap = argparse.ArgumentParser(description="computes Modeled Stream Utility for input system")
     ap.add_argument("track", choices=["ts13", "ts14"])
-    ap.add_argument("matches")
-    ap.add_argument("nuggets")
-    ap.add_argument("pool") #add duplicates from pool to the update --> nugget map
+    # the judgment files (as in modeled_stream_utility_push-ranked_order.py)
+    # can be left out with --judgments
+    ap.add_argument("-m", "--matchesFile", dest="matches", help="the matches file")
+    ap.add_argument("-n", "--nuggetsFile", dest="nuggets", help="the nuggets file")
+    ap.add_argument("--poolFile", dest="pool", help="the pool file (for tracking duplicates)") #add duplicates from pool to the update --> nugget map
     #ap.add_argument("topic_query_durns") # to set time to begin at 0 seconds
-    ap.add_argument("track_topics_xml") # to set time to begin at 0 seconds   
+    ap.add_argument("-t", "--track_topics_file", dest="track_topics_xml", help="the topics xml file (query durations)") # to set time to begin at 0 seconds   
     ap.add_argument("update_lengths_folder", help="should contain \"<qid>*.len\" files containing (qid, updid, charlen, wordlen) columns per line") # update lengths are required for each update
     #ap.add_argument("--useAverageLengths", action="store_true", help="user average topic lengths for updates for which lengths are unavailable")
     #NOTE: this^^ flag is removed since there is no significant change (only 4 changes in scores and all of which were after the 3rd decimal point)
@@ -539,46 +718,67 @@ if __name__ == "__main__":
     ap.add_argument("population_time_away_stddev", type=float)
     ap.add_argument("lateness_decay", type=float)
     ap.add_argument("runfiles", nargs="+", help="all the run with gain attached files")
+    ap.add_argument("--engine", choices=["loop", "vectorized"], default="loop", help="loop: walk updates one at a time; vectorized: numpy operations over per-topic columns (same scores)")
+    ap.add_argument("--rng", choices=["legacy", "keyed"], default="legacy", help="legacy: users drawn from the global numpy random state (reproduces earlier scores); keyed: each user drawn from its own stream keyed by (seed, topic, user)")
+    ap.add_argument("--judgments", help="judgments bundle compiled by compile-qrels.py, in place of the matches, nuggets, pool and track_topics_xml files")
+    ap.add_argument("--run_cache", help="folder caching the gain-attached runs; runs loaded before with the same judgment files are memory-mapped from here instead of being parsed")
+    ap.add_argument("--stats", help="json file for the stage times and simulation counts of every run and topic [see evaluation_stats.py]")
+    ap.add_argument("--profile", help="pstats file for a cProfile profile of the evaluation (the Cython kernels too, when built with MSU_CYTHON_PROFILE=1) [see profiling.py]")
+    ap.add_argument("--adaptive_tolerance", type=float, help="simulate users in batches until the standard errors of every topic's mean gain and pain are within this tolerance (at most num_users users per topic; needs --rng keyed) [see adaptive_sampling.py]")
+    ap.add_argument("--batch_users", type=int, default=50, help="users simulated between the convergence checks of --adaptive_tolerance")
+    ap.add_argument("--paired", help="tsv file for the per-user gain and pain differences (mean, variance, standard error) of every pair of runs, per topic and for the AVG [see paired_comparison.py]")
   
     # NOTE: population reading speed parameters drawn from [Time Well Spent,
     # Clarke and Smucker, 2014]
     
     args = ap.parse_args()
     print >> sys.stderr, args
+    if args.profile:
+        profiling.start_profile(args.profile)
+    judgment_files = [args.matches, args.nuggets, args.pool, args.track_topics_xml]
+    if args.judgments:
+        judgment_files = [args.judgments]
+    elif None in judgment_files:
+        ap.error('-m, -n, --poolFile and -t are needed without --judgments')
+    if args.adaptive_tolerance is not None and args.rng != 'keyed':
+        ap.error('--adaptive_tolerance needs --rng keyed (batches of users are drawn from their own streams)')
+    if args.paired and args.adaptive_tolerance is not None:
+        ap.error('--paired needs the same users for every run (not --adaptive_tolerance)')
     
-    # load query durations.
-    # this helps to start every duration with 0                
-    logger.warning('getting topic query durations')
-    query_durns = utils.get_topic_query_durations(args.track_topics_xml, args.track)
+    if args.judgments:
+        logger.warning('loading the judgments bundle ' + args.judgments)
+        query_durns, pool, matches, nuggets = judgment_bundle.load_bundle(args.judgments, args.track)
+    else:
+        # query durations (timestamps start from 0), pool, matches with the
+        # duplicates of the pool and nuggets with their timestamp and importance
+        logger.warning('reading in topic query durations, pool, matches (tracking duplicates) and nuggets')
+        query_durns, pool, matches, nuggets = judgment_bundle.read_judgments(args.track,
+            args.matches, args.nuggets, args.pool, args.track_topics_xml)
     for topic, durn in query_durns.iteritems():
         print >> sys.stderr, topic, float(durn[1] - durn[0])
-    #sys.exit()
-        
-    logger.warning('identify duplicate updates from the pool')
-    # all duplicates have the same relevance judgement.
-    duplicates = utils.read_in_pool_file(args.pool)
-    
-    # ignored topics in the pool
-    if args.track == "ts13":
-        duplicates['7'] = {} 
-        duplicates['9911'] = {} 
-                    
-    # note relevant updates (and their duplicates)
-    # keep track of nuggets present in each relevant update 
-    logger.warning('reading in matches, tracking duplicates')
-    matches = utils.read_in_matches_track_duplicates(args.matches, duplicates)
-    
-    logger.warning('load nuggets and their timestamp and importance')
-    nuggets = utils.read_in_nuggets(args.nuggets, query_durns)    
        
     logger.warning('reading in update lengths')
-    updlens = utils.read_in_update_lengths(args.update_lengths_folder, args.track)    
+    updlens = update_lengths.load_update_lengths(args.update_lengths_folder, args.track)    
+    # judgment tables shared by all the runs
+    judgment_tables = run_loader.JudgmentTables(pool, matches, nuggets)
     
-    MSU = MSUReverseChronoOrder(args.num_users,
+    MSUEngine = MSUReverseChronoOrder
+    if args.engine == "vectorized":
+        MSUEngine = MSUVectorizedReverseChronoOrder
+
+    MSU = MSUEngine(args.num_users,
             args.population_session_duration_mean,
             args.population_session_duration_stddev,
             args.population_time_away_mean, args.population_time_away_stddev,
-            args.lateness_decay)
+            args.lateness_decay, args.rng)
+    stats = None
+    if args.stats:
+        stats = MSU.stats = evaluation_stats.EvaluationStats()
+    if args.adaptive_tolerance is not None:
+        MSU.adaptive = adaptive_sampling.AdaptiveSampling(args.adaptive_tolerance, args.batch_users, args.num_users)
+    paired = None
+    if args.paired:
+        paired = MSU.paired = paired_comparison.PairedComparison()
 
     run = {}
     for runfile in args.runfiles:
@@ -586,8 +786,19 @@ if __name__ == "__main__":
         run = {}
         gc.collect()        
         logger.warning('loading runfile ' + runfile )
+        if stats is not None:
+            stats.start_run(runfile)
+        if paired is not None:
+            paired.start_run(os.path.basename(runfile))
         try: 
-            run = MSU.load_run_and_attach_gain(runfile, updlens, nuggets, matches, True, args.track, query_durns) #args.useAverageLengths)
+            load_run = lambda: MSU.load_run_and_attach_gain(runfile, updlens, nuggets, matches, True, args.track, query_durns, pool,
+                judgment_tables=judgment_tables) #args.useAverageLengths)
+            with evaluation_stats.timed(stats, 'load'):
+                if args.run_cache:
+                    run = run_cache.load_cached_run(args.run_cache, runfile,
+                        judgment_files + [args.update_lengths_folder], [args.track], load_run)
+                else:
+                    run = load_run()
             ignored_qid = "7" if args.track == "ts13" else ""
             if ignored_qid in run:
                 run.pop(ignored_qid)
@@ -597,7 +808,7 @@ if __name__ == "__main__":
             exit(0)
 
         logger.warning('computing MSU...')
-        run_msu = MSU.compute_population_MSU(run, query_durns)
+        run_msu, run_pain = MSU.compute_population_MSU(run, query_durns, len(matches.keys()))
         # TODO: keep track of all the nuggets found
         
         printkeys = None
@@ -610,7 +821,17 @@ if __name__ == "__main__":
         
         for topic in printkeys:
             msu = run_msu[topic]
-            print '%s\t%s\t%s' % (os.path.basename(runfile), str(topic), str(msu))
+            pain = run_pain[topic]
+            print '%s\t%s\t%s\t%s' % (os.path.basename(runfile), str(topic), str(msu), str(pain))
+
+        if stats is not None:
+            stats.finish_run()
+            stats.write(args.stats)
+        if paired is not None:
+            paired.finish_run()
+
+    if paired is not None:
+        paired.write(args.paired)
 
 
 
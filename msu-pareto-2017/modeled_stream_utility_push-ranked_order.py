@@ -10,8 +10,11 @@ import operator
 import heapq
 import array
 import re
+import itertools
+import multiprocessing
+import numpy as np
 
-from cython_computations import _compute_push_ranked_user_MSU
+from cython_computations import _compute_push_ranked_user_MSU, _compute_push_ranked_population_MSU
 
 from update import Update
 from nugget import Nugget
@@ -20,8 +23,15 @@ from user_model import LognormalAwayRBPPersistenceUserModel
 from user_interface_model import PushRankedInterfaceMixin
 
 from modeled_stream_utility import ModeledStreamUtility
+import run_cache
+import run_loader
 
-import utils
+import judgment_bundle
+import update_lengths
+import evaluation_stats
+import profiling
+import adaptive_sampling
+import paired_comparison
 
 # logging setup
 import logging
@@ -45,6 +55,14 @@ def logargs(func):
     return inner
 
 
+# stage times and simulation counts (--stats) [see evaluation_stats.py]; set
+# up in __main__ (or by parameter_sweep.py)
+stats = None
+# gain and pain of every (user, topic) of the runs (--paired) [see
+# paired_comparison.py]; set up in __main__
+paired = None
+
+
 class MSUPushRankedOrder(ModeledStreamUtility, PushRankedInterfaceMixin):
     """
     Simulates users reading updates in ranked order at every session.
@@ -59,7 +77,8 @@ class MSUPushRankedOrder(ModeledStreamUtility, PushRankedInterfaceMixin):
         fix_away_mean, 
         fix_reading_mean, 
         push_threshold, 
-        interaction_mode):
+        interaction_mode,
+        rng_mode='legacy'):
 
         super(MSUPushRankedOrder, self).__init__(num_users)
 
@@ -67,9 +86,11 @@ class MSUPushRankedOrder(ModeledStreamUtility, PushRankedInterfaceMixin):
                                 population_time_away_mean, \
                                 population_time_away_stddev, \
                                 RBP_persistence_params, \
-                                lateness_decay, )
+                                lateness_decay, \
+                                rng_mode)
 
         self.sampled_users = []
+        self.sampled_user_indices = []
         self.update_emit_times = []
         self.update_confidences = []
         self.update_lengths = []                                                                                                    
@@ -81,43 +102,51 @@ class MSUPushRankedOrder(ModeledStreamUtility, PushRankedInterfaceMixin):
         self.interaction_mode = interaction_mode 
         self.user_counter = 0
         self.ignore_verbosity = False
+        self.threads = 1
+        # (qid, user index) --> pull trail [see cached_pull_trail()]
+        self.pull_trail_cache = {}
 
     def normalize_confidences(self):
         #logger.warning(self.update_confidences)
-        maxconf = max(self.update_confidences)
-        minconf = min(self.update_confidences)
+        maxconf = self.update_confidences.max()
+        minconf = self.update_confidences.min()
         if maxconf == minconf:
             maxconf = 1.0
             minconf = 0.0
-        self.update_confidences = array.array('d', map(lambda x: (x - minconf)/(maxconf - minconf), self.update_confidences))
+        self.update_confidences = (self.update_confidences - minconf)/(maxconf - minconf)
         #logger.warning(self.update_confidences)
 
     def initialize_structures_for_topic(self, topic_updates):
         self.presort_updates(topic_updates)
-        self.update_emit_times = array.array('d', [ upd.time for upd in topic_updates ])
-        self.update_confidences = array.array('d', [ upd.conf for upd in topic_updates ] )
+        self.update_emit_times = topic_updates.times
+        self.update_confidences = topic_updates.confs
         self.normalize_confidences()
-        self.update_lengths = array.array('d', [upd.wlen for upd in topic_updates])
+        self.update_lengths = topic_updates.wlens
 
-    def sample_users_from_population(self, query_duration):
+    def sample_users_from_population(self, query_duration, qid=None, users=None):
         if self.sampled_users:
             self.sampled_users = []
 
         self.query_duration = query_duration
+        self.qid = qid
+        # user indices of the sampled users (key their cached pull trails)
+        self.sampled_user_indices = list(users if users is not None else xrange(self.num_users))
 
         # reset the seed so that the same users are
         # generated every time this function is called
         self.population_model.reset_random_seed()
 
-        for ui in xrange(self.num_users):
-            A, P, V, L = self.population_model.generate_user_params()
+        for ui in self.sampled_user_indices:
+            random_state = self.population_model.user_random_state(qid, ui)
+            A, P, V, L = self.population_model.generate_user_params(random_state=random_state)
             if self.fix_persistence:
                 P = self.fix_persistence            
             if self.fix_away_mean:
                 A = self.fix_away_mean
             if self.fix_reading_mean:
                 V = self.fix_reading_mean
-            self.sampled_users.append(LognormalAwayRBPPersistenceUserModel(A, P, V, L))
+            self.sampled_users.append(LognormalAwayRBPPersistenceUserModel(A, P, V, L, random_state,
+                self.population_model.random_streams.mode == 'keyed'))
 
     
     def _compute_user_MSU(self, user_instance, updates):
@@ -138,30 +167,224 @@ class MSUPushRankedOrder(ModeledStreamUtility, PushRankedInterfaceMixin):
             #logger.setLevel(logging.DEBUG)
         #logger.warning('user {}'.format(user_instance))
 
-        user_trail = self.generate_user_trail(user_instance, self.update_confidences, self.update_emit_times, self.query_duration, self.push_threshold, self.interaction_mode)
-        # logger.debug('user_trail {}'.format(user_trail))        
-        window_starts = array.array('d', map(lambda x: x[0] - self.window_size if x[0] - self.window_size >= 0.0 else 0.0, user_trail))
+        ssn_starts, ssn_reads, ssn_is_push = self.generate_user_trail(user_instance, self.update_confidences, self.update_emit_times, self.query_duration, self.push_threshold, self.interaction_mode)
+        # logger.debug('ssn_starts {} ssn_reads {}'.format(ssn_starts, ssn_reads))
         if self.window_size == -1:
-            window_starts = array.array('d', [0.0]*len(user_trail)) 
+            window_starts = np.zeros(len(ssn_starts))
+        else:
+            window_starts = np.maximum(ssn_starts - self.window_size, 0.0)
         # logger.debug('window_starts {}'.format(str(window_starts)))
-        ssn_starts = array.array('d', [s for s,r,t in user_trail])
-        # logger.debug('ssn_starts {}'.format(str(ssn_starts)))
-        num_sessions = len(user_trail)
 
         
         # logger.debug('----------- user {} {}-------------------'.format(self.user_counter, user_instance))
         
-        user_topic_msu, user_topic_pain = _compute_push_ranked_user_MSU(user_trail, window_starts, ssn_starts, 
+        user_topic_msu, user_topic_pain = _compute_push_ranked_user_MSU(ssn_reads, window_starts, ssn_starts, 
             self.update_emit_times, self.update_confidences, self.update_lengths, updates,
-            user_instance.V, user_instance.L, self.query_duration, self.ignore_verbosity)
+            user_instance.V, user_instance.L, self.query_duration, self.ignore_verbosity, self.topic_counts)
         # logger.debug(' user {} done'.format(self.user_counter))
         
         return user_topic_msu, user_topic_pain
 
-       
+    def pull_trails_are_cacheable(self):
+        """
+        pull (regular) sessions do not depend on the run. They can be reused by
+        every run unless they share a random stream with the push sessions
+        of other users (legacy random streams with push notifications)
+        """
+        if self.interaction_mode == 'only.push':
+            return False
+        return self.interaction_mode == 'only.pull' or self.population_model.random_streams.mode == 'keyed'
+
+    def cached_pull_trail(self, ui, user_instance):
+        """
+        :return: pull trail (session starts, reads) of sampled user ui for the
+        current topic; generated once per (topic, user) and reused for every
+        run. The user's random stream is left where generating the trail
+        leaves it, so that push sessions draw the same reads.
+        """
+        key = (self.qid, ui)
+        if key in self.pull_trail_cache:
+            ssn_starts, ssn_reads, random_state = self.pull_trail_cache[key]
+            if random_state is not None:
+                user_instance.random_state.set_state(random_state)
+            return ssn_starts, ssn_reads
+        ssn_starts, ssn_reads = user_instance.generate_user_trail(self.query_duration)
+        random_state = None
+        if self.interaction_mode == 'push.pull':
+            random_state = user_instance.random_state.get_state()
+        self.pull_trail_cache[key] = (ssn_starts, ssn_reads, random_state)
+        return ssn_starts, ssn_reads
+
+    def generate_population_trails(self):
+        """
+        generates the session trails of all sampled users for the current
+        topic, in user order (as _compute_user_MSU() would)
+        :return: trail_offsets, ssn_reads, window_starts, ssn_starts, where user
+        i's sessions are ssn_starts[trail_offsets[i]:trail_offsets[i+1]] (likewise
+        ssn_reads, window_starts)
+        """
+        cache_pull_trails = self.pull_trails_are_cacheable()
+        trails = [ self.generate_user_trail(user_instance, self.update_confidences, self.update_emit_times, self.query_duration, self.push_threshold, self.interaction_mode,
+                self.cached_pull_trail(ui, user_instance) if cache_pull_trails else None)
+            for ui, user_instance in itertools.izip(self.sampled_user_indices, self.sampled_users) ]
+        trail_offsets = np.zeros(len(self.sampled_users) + 1, dtype=np.int64)
+        np.cumsum([len(ssn_starts) for ssn_starts, _, _ in trails], out=trail_offsets[1:])
+        ssn_starts = np.concatenate([np.zeros(0)] + [ssn_starts for ssn_starts, _, _ in trails])
+        ssn_reads = np.concatenate([np.zeros(0, dtype=np.intc)] + [ssn_reads for _, ssn_reads, _ in trails])
+        if self.window_size == -1:
+            window_starts = np.zeros(len(ssn_starts))
+        else:
+            window_starts = np.maximum(ssn_starts - self.window_size, 0.0)
+        return trail_offsets, ssn_reads, window_starts, ssn_starts
+
+    def _compute_population_trails_MSU(self, updates, trails):
+        """
+        evaluates all sampled users over their trails (generated by
+        generate_population_trails()) in one (multi-threaded) call
+        """
+        trail_offsets, ssn_reads, window_starts, ssn_starts = trails
+        return _compute_push_ranked_population_MSU(trail_offsets, ssn_reads, window_starts, ssn_starts,
+            self.update_emit_times, self.update_confidences, self.update_lengths, updates,
+            np.array([user_instance.V for user_instance in self.sampled_users], dtype=float),
+            np.array([user_instance.L for user_instance in self.sampled_users], dtype=float),
+            self.query_duration, self.ignore_verbosity, self.threads, self.topic_counts)
+
+    def _compute_population_user_MSU(self, updates):
+        return self._compute_population_trails_MSU(updates, self.generate_population_trails())
 
-if __name__ == '__main__':
 
+def ignored_runfile(runfile):
+    """
+    :return: True for run files that are known to be bad for evaluation
+    """
+    if args.track == 'rts16' and os.path.splitext(os.path.basename(runfile))[0] in ['iitbhu-15']:
+        logger.warning('ignoring bad run {}. See TREC-RTS-Tracks/2016/scenarioA/eval-scripts/README.txt'.format(runfile))
+        return True
+    if args.track == 'mb15' and  os.path.splitext(os.path.basename(runfile))[0] in ['DALTRECAA1', 'DALTRECMA1', 'DALTRECMA2']:
+        logger.warning('ignoring bad run {}. Run has too many tweets --> bad for analysis'.format(runfile))
+        return True
+    return False
+
+
+def load_runfile(runfile):
+    """
+    loads a run file and attaches gain to its updates, using the judgments
+    set up in __main__ (or by parameter_sweep.py) [see load_judgments()]
+    :return: dictionary of qid --> TopicUpdates; None if the run could not be
+    loaded
+    """
+    logger.warning('loading runfile ' + runfile )
+    try:            
+        run = None
+        if args.track in ['ts13', 'ts14']:
+            load_run = lambda: MSUPushRankedOrder.load_run_and_attach_gain(runfile, updlens, nuggets, matches, True, args.track, query_durns, pool, args.restrict_runs_to_pool,
+                judgment_tables) 
+        elif args.track in ['mb15', 'rts16']:
+            load_run = lambda: MSUPushRankedOrder.microblog_load_run_and_attach_gain(runfile, nuggets, matches, args.track, query_durns,
+                judgment_tables)
+
+        with evaluation_stats.timed(stats, 'load'):
+            if args.run_cache:
+                run = run_cache.load_cached_run(args.run_cache, runfile, judgment_files,
+                    [args.track, args.restrict_runs_to_pool], load_run)
+            else:
+                run = load_run()
+        
+        logger.warning('run total updates {} in {} topics'.format(sum([len(v) for v in run.values()]), len(run)))
+        ignored_qid = "7" if args.track == "ts13" else ""
+        if ignored_qid in run:
+            run.pop(ignored_qid)
+    except Exception, e:
+        logger.error('ERROR: could not load runfile ' + runfile)
+        logger.error('EXCEPTION: ' + str(e))
+        return None
+
+    return run
+
+
+def output_run_name(runfile):
+    """
+    :return: name of a run file in the output rows
+    """
+    runname = os.path.basename(runfile)
+    if args.track == 'ts13':
+        runname = runname.replace("input.", '')
+    if args.track in ['mb15', 'rts16']:
+        runname = os.path.splitext(runname)[0]
+    return runname
+
+
+def evaluate_run(runfile, run):
+    """
+    computes MSU for a loaded run, using the MSU evaluator set up in __main__
+    (or by parameter_sweep.py)
+    :return: list of tab-separated output rows for the run
+    """
+    rows = []
+    logger.warning('computing MSU... for {} topics'.format(len(matches.keys())))
+    run_msu, run_pain = MSU.compute_population_MSU(run, query_durns, len(matches.keys()))
+    # TODO: keep track of all the nuggets found
+    
+    printkeys = None
+    if args.track in ["ts13", "mb15"]:
+        # print in sorted qid order when topic ids are numeric
+        keys = filter(lambda x: x.isdigit(), run_msu.keys())
+        printkeys = map(str,sorted(map(int, keys))) + ["AVG"]
+    elif args.track in ['ts14', 'rts16']:
+        # print in sorted qid order when topic ids are strings
+        keys = filter(lambda x: x != 'AVG' , run_msu.keys())
+        printkeys = sorted(keys, key=lambda x: int(re.findall(r'\d+', x)[0]) ) + ['AVG']
+    
+    
+    for topic in printkeys:
+        msu = run_msu[topic]
+        pain = run_pain[topic]
+        runname = output_run_name(runfile)
+            
+        rows.append('{}\t{}\t{:.3f}\t{:.3f}'.format(runname, topic, msu, pain))
+
+    return rows
+
+
+def evaluate_runfile(runfile):
+    """
+    computes MSU for a single run file, using the judgments and the MSU
+    evaluator set up in __main__ (forked workers inherit them)
+    :return: list of tab-separated output rows for the run; None if the run
+    could not be loaded
+    """
+    gc.collect()   
+    if ignored_runfile(runfile):
+        return []
+    if stats is not None:
+        stats.start_run(runfile)
+    if paired is not None:
+        paired.start_run(output_run_name(runfile))
+    run = load_runfile(runfile)
+    if run is None:
+        return None
+    rows = evaluate_run(runfile, run)
+    if stats is not None:
+        stats.finish_run()
+    if paired is not None:
+        paired.finish_run()
+    return rows
+
+
+def evaluate_forked_runfile(runfile):
+    """
+    evaluate_runfile() in a forked worker
+    :return: the run's output rows, its stats records [see --stats] and its
+    paired comparison records [see --paired] (the worker's are lost with it)
+    """
+    num_records = len(stats.runs) if stats is not None else 0
+    num_paired_records = len(paired.runs) if paired is not None else 0
+    rows = evaluate_runfile(runfile)
+    return rows, stats.runs[num_records:] if stats is not None else [], \
+        paired.runs[num_paired_records:] if paired is not None else []
+
+
+def argument_parser():
     ap = argparse.ArgumentParser(description="computes MSU for systems while presenting a ranked order of updates at each user session")
     ap.add_argument("track", choices=["ts13", "ts14", "mb15", "rts16"])
     ap.add_argument("-m", "--matchesFile", help="the qrel file (for tweets) or the matches file (for updates)")
@@ -169,6 +392,8 @@ if __name__ == '__main__':
     ap.add_argument("--poolFile", help="needed for the TS tracks for tracking duplicates and if --restrict_runs_to_pool is active ") 
     ap.add_argument("-t", "--track_topics_file") # to set time to begin at 0 seconds   
     ap.add_argument("-l", "--update_lengths_folder", help="should contain \"<qid>*.len\" files containing (qid, updid, charlen, wordlen) columns per line") # update lengths are required for each update    
+    ap.add_argument("--judgments", help="judgments bundle compiled by compile-qrels.py, in place of -m -n --poolFile -t --tweetEpochFile")
+    ap.add_argument("--update_lengths_index", help="index file of the update lengths: saved after reading the --update_lengths_folder files, and loaded instead of them later (as long as they do not change)")
     ap.add_argument("--tweetEpochFile", help="tweet2dayepoch file needed for emit times of tweet ")
     ap.add_argument("-u", "--num_users", type=int, default=1)    
     ap.add_argument("-Apop", "--time_away_population_params", nargs=2, type=float, help="population time away mean and stddev", default=[10800.0, 5400.0])
@@ -184,77 +409,93 @@ if __name__ == '__main__':
     
     ap.add_argument("--restrict_runs_to_pool", action="store_true", help="the runs are restricted to their pool contributions")
     ap.add_argument("--ignore_verbosity", action="store_true", help="ignore verbosity computations i.e. user reading speed does not affect reading of updates", default=False)
+    ap.add_argument("--workers", type=int, default=1, help="number of processes evaluating run files in parallel (judgments are loaded once and shared with the workers)")
+    ap.add_argument("--topic_workers", type=int, default=1, help="number of processes computing the topics of a run in parallel")
+    ap.add_argument("--threads", type=int, default=1, help="number of threads evaluating the users of a topic in parallel (needs cython_computations built with OpenMP)")
+    ap.add_argument("--rng", choices=["legacy", "keyed"], default="legacy", help="legacy: users drawn from the global numpy random state (reproduces earlier scores); keyed: each user drawn from its own stream keyed by (seed, topic, user)")
+    ap.add_argument("--run_cache", help="folder caching the gain-attached runs; runs loaded before with the same judgment files are memory-mapped from here instead of being parsed")
+    ap.add_argument("--stats", help="json file for the stage times and simulation counts of every run and topic [see evaluation_stats.py]")
+    ap.add_argument("--profile", help="pstats file for a cProfile profile of the evaluation (the Cython kernels too, when built with MSU_CYTHON_PROFILE=1; with --threads 1 for all of their calls) [see profiling.py]")
+    ap.add_argument("--adaptive_tolerance", type=float, help="simulate users in batches until the standard errors of every topic's mean gain and pain are within this tolerance (at most -u users per topic; needs --rng keyed) [see adaptive_sampling.py]")
+    ap.add_argument("--batch_users", type=int, default=50, help="users simulated between the convergence checks of --adaptive_tolerance")
+    ap.add_argument("--paired", help="tsv file for the per-user gain and pain differences (mean, variance, standard error) of every pair of runs, per topic and for the AVG (needs --rng keyed) [see paired_comparison.py]")
 
     # NOTE: population reading speed parameters drawn from [Time Well Spent,
     # Clarke and Smucker, 2014]
+    return ap
 
-    args = ap.parse_args()
-    print >> sys.stderr, args
-        
-    if args.track in ['ts13', 'ts14']:
+
+def load_judgments(args):
+    """
+    reads in the judgments of args.track
+    :return: query_durns, pool, matches, nuggets, updlens, judgment_tables,
+      judgment_files (pool and updlens are None for the microblog tracks;
+      judgment_tables are the run_loader.JudgmentTables of the judgments;
+      judgment_files are the files that gain-attached runs depend on)
+    """
+    updlens = None
+    if args.judgments:
+        if args.track in ['ts13', 'ts14'] and args.update_lengths_folder is None:
+            logger.error('argument -l is needed with track {}'.format(args.track))
+            sys.exit()
+        logger.warning('loading the judgments bundle ' + args.judgments)
+        query_durns, pool, matches, nuggets = judgment_bundle.load_bundle(args.judgments, args.track)
+    elif args.track in ['ts13', 'ts14']:
         if None in [args.nuggetsFile, args.matchesFile, args.poolFile, args.update_lengths_folder, args.track_topics_file]:
             logger.error('arguments -n -m --poolFile -t -l  are needed with track {}'.format(args.track))
             sys.exit()
+        # query durations (timestamps start from 0), pool, matches with the
+        # duplicates of the pool and nuggets with their timestamp and importance
+        logger.warning('reading in topic query durations, pool, matches (tracking duplicates) and nuggets')
+        query_durns, pool, matches, nuggets = judgment_bundle.read_judgments(args.track,
+            args.matchesFile, args.nuggetsFile, args.poolFile, args.track_topics_file)
+    elif args.track in ['mb15', 'rts16']:
+        if None in [args.nuggetsFile, args.matchesFile, args.tweetEpochFile]:
+            logger.error('arguments -n -m --tweetEpochFile are needed with track {}'.format(args.track))
+            sys.exit()
+        # qrels, tweet emit times (epoch) and clusters with their earliest timestamp
+        logger.warning('reading in qrels, tweet emit times and clusters')
+        query_durns, pool, matches, nuggets = judgment_bundle.read_judgments(args.track,
+            args.matchesFile, args.nuggetsFile, tweet_epoch_file=args.tweetEpochFile)
 
-        # load query durations.
-        # this helps to start every duration with 0                
-        logger.warning('getting topic query durations')
-        query_durns = utils.get_topic_query_durations(args.track_topics_file, args.track)    
+    if args.track in ['ts13', 'ts14']:
         for topic, durn in query_durns.iteritems():
             print >> sys.stderr, topic, float(durn[1] - durn[0])
-        #sys.exit()
-            
-        logger.warning('identify duplicate updates from the pool')
-        # all duplicates have the same relevance judgement.
-        pool, duplicates = utils.read_in_pool_file(args.poolFile)
-                    
-        # ignored topics in the pool
-        if args.track == "ts13":
-            duplicates['7'] = {} 
-            duplicates['9911'] = {} 
-                        
-        # note relevant updates (and their duplicates)
-        # keep track of nuggets present in each relevant update 
-        logger.warning('reading in matches, tracking duplicates')
-        matches = utils.read_in_matches_track_duplicates(args.matchesFile, duplicates)
 
         if args.track == 'ts13':
             matches.pop('11', None)
             matches.pop('9911', None)
             matches.pop('7', None)
-        
-        logger.warning('load nuggets and their timestamp and importance')
-        nuggets = utils.read_in_nuggets(args.nuggetsFile, query_durns)    
-        
-        logger.warning('reading in update lengths')
-        updlens = utils.read_in_update_lengths(args.update_lengths_folder, args.track)    
-    
-    if args.track in ['mb15', 'rts16']:
-        if None in [args.nuggetsFile, args.matchesFile, args.tweetEpochFile]:
-            logger.error('arguments -n -m --tweetEpochFile are needed with track {}'.format(args.track))
-            sys.exit()
 
-        # read in qrels
-        logger.warning('reading in qrels')
-        matches = utils.microblog_read_in_qrels(args.matchesFile)
-
-        logger.warning('set topic query durations')
-        query_durns = utils.microblog_set_topic_query_durations(matches.keys(), args.track)    
+        logger.warning('reading in update lengths')
+        updlens = update_lengths.load_update_lengths(args.update_lengths_folder, args.track,
+            args.workers, args.update_lengths_index)
 
-        logger.warning('reading in tweet emit times (epoch)')
-        tweet_emit_times = utils.microblog_read_int_tweet_epochs(args.tweetEpochFile)
-                    
-        logger.warning('load clusters and get their earliest timestamp ')
-        nuggets = utils.microblog_read_in_clusters(args.nuggetsFile, query_durns, matches, tweet_emit_times, args.track)    
-        
+    if args.track in ['mb15', 'rts16']:
         logger.warning('reading in update lengths --> Not Applicable for this track')
-        # updlens = utils.read_in_update_lengths(args.update_lengths_folder, args.track)    
-        
         args.push_threshold = 0.0
 
+    # nugget tables shared by the topics of every run (built here, once,
+    # so that forked workers inherit them)
+    judgment_tables = run_loader.JudgmentTables(pool, matches, nuggets)
+
+    # files that the gain-attached runs depend on [see run_cache.py]
+    if args.judgments:
+        judgment_files = [f for f in [args.judgments, args.update_lengths_folder] if f is not None]
+    else:
+        judgment_files = [f for f in [args.matchesFile, args.nuggetsFile, args.poolFile, args.track_topics_file,
+            args.update_lengths_folder, args.tweetEpochFile] if f is not None]
+
     logger.warning('track {}. number of keys {}'.format(args.track, len(matches.keys())))
     #logger.warning('track {}. number of nuggets for topics \n{}'.format(args.track, '\n'.join(['{}\t{}'.format(qid, len(nuggets)) for qid, nuggets in nuggets.items()])))
-    
+
+    return query_durns, pool, matches, nuggets, updlens, judgment_tables, judgment_files
+
+
+def msu_evaluator(args):
+    """
+    :return: the MSUPushRankedOrder evaluator for the given arguments
+    """
     Apop_mean, Apop_stdev = args.time_away_population_params
     
     MSU = MSUPushRankedOrder(args.num_users,
@@ -266,63 +507,69 @@ if __name__ == '__main__':
             args.user_time_away_mean,
             args.user_reading_mean, 
             args.push_threshold,
-            args.interaction_mode)
+            args.interaction_mode,
+            args.rng)
 
     MSU.track = args.track
     MSU.ignore_verbosity = args.ignore_verbosity
-    
-    run = {}
-    for runfile in args.runfiles:
-        run.clear()
-        run = {}
-        gc.collect()   
-        if args.track == 'rts16' and os.path.splitext(os.path.basename(runfile))[0] in ['iitbhu-15']:
-            logger.warning('ignoring bad run {}. See TREC-RTS-Tracks/2016/scenarioA/eval-scripts/README.txt'.format(runfile))
-            continue
-        if args.track == 'mb15' and  os.path.splitext(os.path.basename(runfile))[0] in ['DALTRECAA1', 'DALTRECMA1', 'DALTRECMA2']:
-            logger.warning('ignoring bad run {}. Run has too many tweets --> bad for analysis'.format(runfile))
-            continue
-
-        logger.warning('loading runfile ' + runfile )
-        try:            
-            run = None
-            if args.track in ['ts13', 'ts14']:
-                run = MSU.load_run_and_attach_gain(runfile, updlens, nuggets, matches, True, args.track, query_durns, pool, args.restrict_runs_to_pool) 
-            elif args.track in ['mb15', 'rts16']:
-                run = MSU.microblog_load_run_and_attach_gain(runfile, nuggets, matches, args.track, query_durns)
-            
-            logger.warning('run total updates {} in {} topics'.format(sum([len(v) for v in run.values()]), len(run)))
-            ignored_qid = "7" if args.track == "ts13" else ""
-            if ignored_qid in run:
-                run.pop(ignored_qid)
-        except Exception, e:
-            logger.error('ERROR: could not load runfile ' + runfile)
-            logger.error('EXCEPTION: ' + str(e))
-            exit(0)
+    MSU.topic_workers = args.topic_workers
+    MSU.threads = args.threads
+    MSU.stats = stats
+    if args.adaptive_tolerance is not None:
+        if args.rng != 'keyed':
+            logger.error('--adaptive_tolerance needs --rng keyed (batches of users are drawn from their own streams)')
+            sys.exit()
+        MSU.adaptive = adaptive_sampling.AdaptiveSampling(args.adaptive_tolerance, args.batch_users, args.num_users)
+    MSU.paired = paired
 
-               
-        logger.warning('computing MSU... for {} topics'.format(len(matches.keys())))
-        run_msu, run_pain = MSU.compute_population_MSU(run, query_durns, len(matches.keys()))
-        # TODO: keep track of all the nuggets found
-        
-        printkeys = None
-        if args.track in ["ts13", "mb15"]:
-            # print in sorted qid order when topic ids are numeric
-            keys = filter(lambda x: x.isdigit(), run_msu.keys())
-            printkeys = map(str,sorted(map(int, keys))) + ["AVG"]
-        elif args.track in ['ts14', 'rts16']:
-            # print in sorted qid order when topic ids are strings
-            keys = filter(lambda x: x != 'AVG' , run_msu.keys())
-            printkeys = sorted(keys, key=lambda x: int(re.findall(r'\d+', x)[0]) ) + ['AVG']
-        
+    return MSU
+
+
+if __name__ == '__main__':
+
+    ap = argument_parser()
+    args = ap.parse_args()
+    print >> sys.stderr, args
+    if args.profile:
+        profiling.start_profile(args.profile)
+
+    if args.workers > 1 and args.topic_workers > 1:
+        logger.error('--workers and --topic_workers cannot be combined (worker processes cannot fork workers of their own)')
+        sys.exit()
         
-        for topic in printkeys:
-            msu = run_msu[topic]
-            pain = run_pain[topic]
-            runname = os.path.basename(runfile)
-            if args.track == 'ts13':
-                runname = runname.replace("input.", '')
-            if args.track in ['mb15', 'rts16']:
-                runname = os.path.splitext(runname)[0]
-                
-            print '{}\t{}\t{:.3f}\t{:.3f}'.format(runname, topic, msu, pain)
+    query_durns, pool, matches, nuggets, updlens, judgment_tables, judgment_files = load_judgments(args)
+    if args.stats:
+        stats = evaluation_stats.EvaluationStats()
+    if args.paired:
+        if args.rng != 'keyed' or args.adaptive_tolerance is not None:
+            logger.error('--paired needs the same users for every run (--rng keyed, without --adaptive_tolerance)')
+            sys.exit()
+        paired = paired_comparison.PairedComparison()
+    MSU = msu_evaluator(args)
+    
+    if args.workers > 1:
+        # runs are independent once the judgments are loaded: forked workers
+        # inherit them (copy-on-write) and rows are printed in run order
+        workers = multiprocessing.Pool(args.workers)
+        run_rows = workers.imap(evaluate_forked_runfile, args.runfiles)
+    else:
+        run_rows = itertools.imap(lambda runfile: (evaluate_runfile(runfile), [], []), args.runfiles)
+
+    for rows, forked_run_stats, forked_paired_runs in run_rows:
+        if rows is None:
+            # run could not be loaded
+            exit(0)
+        for row in rows:
+            print row
+        if stats is not None:
+            stats.runs.extend(forked_run_stats)
+            stats.write(args.stats)
+        if paired is not None:
+            paired.runs.extend(forked_paired_runs)
+
+    if args.workers > 1:
+        workers.close()
+        workers.join()
+
+    if paired is not None:
+        paired.write(args.paired)
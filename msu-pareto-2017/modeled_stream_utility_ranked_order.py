@@ -9,6 +9,7 @@ from collections import defaultdict
 import operator
 import heapq
 import array
+import numpy as np
 
 from cython_computations import _compute_ranked_user_MSU
 
@@ -20,7 +21,11 @@ from user_interface_model import RankedInterfaceMixin
 
 from modeled_stream_utility import ModeledStreamUtility
 
-import utils
+import update_lengths
+import judgment_bundle
+import run_loader
+import evaluation_stats
+import profiling
 
 # logging setup
 import logging
@@ -52,7 +57,7 @@ class MSURankedOrder(ModeledStreamUtility, RankedInterfaceMixin):
 
     def __init__(self, num_users, RBP_persistence_params, \
         population_time_away_mean, population_time_away_stddev, \
-        pop_lateness_decay, window_size, fix_persistence):
+        pop_lateness_decay, window_size, fix_persistence, rng_mode='legacy'):
 
         super(MSURankedOrder, self).__init__(num_users)
 
@@ -60,7 +65,8 @@ class MSURankedOrder(ModeledStreamUtility, RankedInterfaceMixin):
                                 population_time_away_mean, \
                                 population_time_away_stddev, \
                                 RBP_persistence_params, \
-                                pop_lateness_decay, )
+                                pop_lateness_decay, \
+                                rng_mode)
 
         self.sampled_users = []
         self.update_emit_times = []
@@ -72,19 +78,22 @@ class MSURankedOrder(ModeledStreamUtility, RankedInterfaceMixin):
 
     def normalize_confidences(self):
         #logger.warning(self.update_confidences)
-        maxconf = max(self.update_confidences)
-        minconf = min(self.update_confidences)
-        self.update_confidences = array.array('d', map(lambda x: (x - minconf)/(maxconf - minconf), self.update_confidences))
+        maxconf = self.update_confidences.max()
+        minconf = self.update_confidences.min()
+        if maxconf == minconf:
+            maxconf = 1.0
+            minconf = 0.0
+        self.update_confidences = (self.update_confidences - minconf)/(maxconf - minconf)
         #logger.warning(self.update_confidences)
 
     def initialize_structures_for_topic(self, topic_updates):
         self.presort_updates(topic_updates)
-        self.update_emit_times = array.array('d', [ upd.time for upd in topic_updates ])
-        self.update_confidences = array.array('d', [ upd.conf for upd in topic_updates ] )
+        self.update_emit_times = topic_updates.times
+        self.update_confidences = topic_updates.confs
         self.normalize_confidences()
-        self.update_lengths = array.array('d', [upd.wlen for upd in topic_updates])
+        self.update_lengths = topic_updates.wlens
 
-    def sample_users_from_population(self, query_duration):
+    def sample_users_from_population(self, query_duration, qid=None, users=None):
         if self.sampled_users:
             self.sampled_users = []
 
@@ -94,11 +103,13 @@ class MSURankedOrder(ModeledStreamUtility, RankedInterfaceMixin):
         # generated every time this function is called
         self.population_model.reset_random_seed()
 
-        for ui in xrange(self.num_users):
-            A, P, V, L = self.population_model.generate_user_params()
+        for ui in (users if users is not None else xrange(self.num_users)):
+            random_state = self.population_model.user_random_state(qid, ui)
+            A, P, V, L = self.population_model.generate_user_params(random_state=random_state)
             if self.fix_persistence:
                 P = self.fix_persistence
-            self.sampled_users.append(LognormalAwayRBPPersistenceUserModel(A, P, V, L))
+            self.sampled_users.append(LognormalAwayRBPPersistenceUserModel(A, P, V, L, random_state,
+                self.population_model.random_streams.mode == 'keyed'))
 
     
     def _compute_user_MSU(self, user_instance, updates):
@@ -117,22 +128,21 @@ class MSURankedOrder(ModeledStreamUtility, RankedInterfaceMixin):
         #if self.user_counter == 23:
             #logger.setLevel(logging.DEBUG)
 
-        user_trail = user_instance.generate_user_trail(self.query_duration)
-        # logger.debug('user_trail {}'.format(user_trail))        
-        window_starts = array.array('d', map(lambda x: x[0] - self.window_size if x[0] - self.window_size >= 0.0 else 0.0, user_trail))
+        ssn_starts, ssn_reads = user_instance.generate_user_trail(self.query_duration)
+        ssn_reads = ssn_reads.astype(np.intc)
+        # logger.debug('ssn_starts {} ssn_reads {}'.format(ssn_starts, ssn_reads))
         if self.window_size == -1:
-            window_starts = array.array('d', [0.0]*len(user_trail)) 
+            window_starts = np.zeros(len(ssn_starts))
+        else:
+            window_starts = np.maximum(ssn_starts - self.window_size, 0.0)
         # logger.debug('window_starts {}'.format(str(window_starts)))
-        ssn_starts = array.array('d', [s for s,r in user_trail])
-        # logger.debug('ssn_starts {}'.format(str(ssn_starts)))
-        num_sessions = len(user_trail)
 
         
         # logger.debug('----------- user {} {}-------------------'.format(self.user_counter, user_instance))
         
-        user_topic_msu = _compute_ranked_user_MSU(user_trail, window_starts, ssn_starts, 
+        user_topic_msu = _compute_ranked_user_MSU(ssn_reads, window_starts, ssn_starts, 
             self.update_emit_times, self.update_confidences, self.update_lengths, updates,
-            user_instance.V, user_instance.L, self.query_duration)
+            user_instance.V, user_instance.L, self.query_duration, self.topic_counts)
         # logger.debug(' user {} done'.format(self.user_counter))
         
         return user_topic_msu
@@ -157,41 +167,30 @@ if __name__ == '__main__':
     ap.add_argument("--window_size", type=int, default=86400, help="updates older than window_size from current session will not be shown to user (window_size = -1 --> all updates since start of query duration will be shown)")
     ap.add_argument("runfiles", nargs="+")
     ap.add_argument("--fix_persistence", type=float)
+    ap.add_argument("--stats", help="json file for the stage times and simulation counts of every run and topic [see evaluation_stats.py]")
+    ap.add_argument("--profile", help="pstats file for a cProfile profile of the evaluation (the Cython kernels too, when built with MSU_CYTHON_PROFILE=1) [see profiling.py]")
 
     # NOTE: population reading speed parameters drawn from [Time Well Spent,
     # Clarke and Smucker, 2014]
 
     args = ap.parse_args()
     print >> sys.stderr, args
+    if args.profile:
+        profiling.start_profile(args.profile)
     
 
-    # load query durations.
-    # this helps to start every duration with 0                
-    logger.warning('getting topic query durations')
-    query_durns = utils.get_topic_query_durations(args.track_topics_xml, args.track)
+    # query durations (timestamps start from 0), pool, matches with the
+    # duplicates of the pool and nuggets with their timestamp and importance
+    logger.warning('reading in topic query durations, pool, matches (tracking duplicates) and nuggets')
+    query_durns, pool, matches, nuggets = judgment_bundle.read_judgments(args.track,
+        args.matches, args.nuggets, args.pool, args.track_topics_xml)
     for topic, durn in query_durns.iteritems():
         print >> sys.stderr, topic, float(durn[1] - durn[0])
-    #sys.exit()
-        
-    logger.warning('identify duplicate updates from the pool')
-    # all duplicates have the same relevance judgement.
-    duplicates = utils.read_in_pool_file(args.pool)
-    
-    # ignored topics in the pool
-    if args.track == "ts13":
-        duplicates['7'] = {} 
-        duplicates['9911'] = {} 
-                    
-    # note relevant updates (and their duplicates)
-    # keep track of nuggets present in each relevant update 
-    logger.warning('reading in matches, tracking duplicates')
-    matches = utils.read_in_matches_track_duplicates(args.matches, duplicates)
-    
-    logger.warning('load nuggets and their timestamp and importance')
-    nuggets = utils.read_in_nuggets(args.nuggets, query_durns)    
        
     logger.warning('reading in update lengths')
-    updlens = utils.read_in_update_lengths(args.update_lengths_folder, args.track)    
+    updlens = update_lengths.load_update_lengths(args.update_lengths_folder, args.track)    
+    # judgment tables shared by all the runs
+    judgment_tables = run_loader.JudgmentTables(pool, matches, nuggets)
     
     MSU = MSURankedOrder(args.num_users,
             args.RBP_persistence,
@@ -199,6 +198,9 @@ if __name__ == '__main__':
             args.lateness_decay,
             args.window_size,
             args.fix_persistence)
+    stats = None
+    if args.stats:
+        stats = MSU.stats = evaluation_stats.EvaluationStats()
     
     run = {}
     for runfile in args.runfiles:
@@ -206,8 +208,12 @@ if __name__ == '__main__':
         run = {}
         gc.collect()        
         logger.warning('loading runfile ' + runfile )
+        if stats is not None:
+            stats.start_run(runfile)
         try: 
-            run = MSU.load_run_and_attach_gain(runfile, updlens, nuggets, matches, True, args.track, query_durns) #args.useAverageLengths)
+            with evaluation_stats.timed(stats, 'load'):
+                run = MSU.load_run_and_attach_gain(runfile, updlens, nuggets, matches, True, args.track, query_durns, pool,
+                    judgment_tables=judgment_tables) #args.useAverageLengths)
             ignored_qid = "7" if args.track == "ts13" else ""
             if ignored_qid in run:
                 run.pop(ignored_qid)
@@ -217,7 +223,7 @@ if __name__ == '__main__':
             exit(0)
 
         logger.warning('computing MSU...')
-        run_msu = MSU.compute_population_MSU(run, query_durns)
+        run_msu, run_pain = MSU.compute_population_MSU(run, query_durns, len(matches.keys()))
         # TODO: keep track of all the nuggets found
         
         printkeys = None
@@ -230,4 +236,9 @@ if __name__ == '__main__':
         
         for topic in printkeys:
             msu = run_msu[topic]
-            print '%s\t%s\t%s' % (os.path.basename(runfile), str(topic), str(msu))
+            pain = run_pain[topic]
+            print '%s\t%s\t%s\t%s' % (os.path.basename(runfile), str(topic), str(msu), str(pain))
+
+        if stats is not None:
+            stats.finish_run()
+            stats.write(args.stats)
@@ -0,0 +1,111 @@
+# Paired comparison of runs (--paired pairs.tsv): every run is evaluated by the
+# same sampled users (common random numbers), so the gain and pain of two runs
+# can be compared user by user. The variance of the per-user differences
+# leaves out the variation between users that two independent estimates
+# carry, and differences between runs are significant with far fewer users.
+# The ranked engines simulate the same users across runs with --rng keyed:
+# user i of a topic draws from the same stream for every run, and pull
+# sessions are shared through the pull trail cache [see
+# MSUPushRankedOrder.cached_pull_trail]; push sessions differ only where the
+# runs push different updates. The sessions of the reverse chronological
+# engines are sampled before the simulation, so their users are the same with
+# either random stream mode.
+#
+# one row per pair of runs (in run order) and topic, and for the AVG:
+#   run_a, run_b, topic, users,
+#   gain_diff, gain_diff_var, gain_diff_se, pain_diff, pain_diff_var, pain_diff_se
+# where *_diff is the mean of the per-user differences (run_a - run_b), *_var
+# their sample variance and *_se the standard error of the mean difference.
+# A topic that a run has no updates for counts as 0 gain and pain, as in the
+# run's AVG.
+
+import re
+import itertools
+import numpy as np
+
+import utils
+
+
+class PairedComparison(object):
+    """
+    gain and pain of every (user, topic) of the evaluated runs, one record
+    per run: (run, qids, msu_user_topic, pain_user_topic) where column t of
+    the user x topic arrays is topic qids[t] [see compute_population_MSU()]
+    """
+
+    def __init__(self):
+        self.runs = []
+        self.current = None
+
+    def start_run(self, run):
+        self.current = run
+
+    def add_user_scores(self, qids, msu_user_topic, pain_user_topic):
+        """
+        records the gain and pain of every (user, topic) of the current run
+        """
+        self.runs.append((self.current, list(qids), msu_user_topic, pain_user_topic))
+
+    def finish_run(self):
+        self.current = None
+
+    @staticmethod
+    def _topic_column(record, qid):
+        """
+        :return: gain and pain of every user for topic qid of a run record
+        (zeros when the run has no updates for it)
+        """
+        _, qids, msu_user_topic, pain_user_topic = record
+        if qid not in qids:
+            return np.zeros(len(msu_user_topic)), np.zeros(len(pain_user_topic))
+        return msu_user_topic[:, qids.index(qid)], pain_user_topic[:, qids.index(qid)]
+
+    @staticmethod
+    def _topic_order(qid):
+        # numeric order of topic ids (as the score rows)
+        numbers = re.findall(r'\d+', qid)
+        return int(numbers[-1]) if numbers else qid
+
+    def user_differences(self, record_a, record_b):
+        """
+        :return: list of (topic, gain differences, pain differences) per user of
+        two run records, for every topic of either run and the AVG
+        """
+        num_users = len(record_a[2])
+        if len(record_b[2]) != num_users:
+            raise ValueError('runs {} and {} were not evaluated by the same users'.format(record_a[0], record_b[0]))
+        differences = []
+        for qid in sorted(set(record_a[1]) | set(record_b[1]), key=self._topic_order):
+            gain_a, pain_a = self._topic_column(record_a, qid)
+            gain_b, pain_b = self._topic_column(record_b, qid)
+            differences.append((qid, gain_a - gain_b, pain_a - pain_b))
+        # the user's AVG is the mean over all the topics of the judgments
+        differences.append(('AVG', np.mean(record_a[2], dtype=float, axis=1) - np.mean(record_b[2], dtype=float, axis=1),
+            np.mean(record_a[3], dtype=float, axis=1) - np.mean(record_b[3], dtype=float, axis=1)))
+        return differences
+
+    def rows(self):
+        """
+        :return: tab-separated rows of every pair of runs (see above)
+        """
+        rows = []
+        for record_a, record_b in itertools.combinations(self.runs, 2):
+            for topic, gain_diffs, pain_diffs in self.user_differences(record_a, record_b):
+                num_users = len(gain_diffs)
+                row = [record_a[0], record_b[0], topic, num_users]
+                for diffs in [gain_diffs, pain_diffs]:
+                    var = np.var(diffs, ddof=1) if num_users > 1 else float('nan')
+                    row += ['{:.6f}'.format(np.mean(diffs)), '{:.6f}'.format(var),
+                        '{:.6f}'.format(np.sqrt(var / num_users))]
+                rows.append('\t'.join(map(str, row)))
+        return rows
+
+    def write(self, path):
+        """
+        writes the rows of every pair of the runs recorded so far to path
+        """
+        with utils.replaced_file(path) as pf:
+            print >> pf, '\t'.join(['run_a', 'run_b', 'topic', 'users', 'gain_diff', 'gain_diff_var',
+                'gain_diff_se', 'pain_diff', 'pain_diff_var', 'pain_diff_se'])
+            for row in self.rows():
+                print >> pf, row
@@ -0,0 +1,151 @@
+# Evaluates runs over a grid of user model parameters (persistence x mean
+# time away) in a single process. The judgments and runs are loaded once and
+# shared by all grid cells, instead of starting one
+# modeled_stream_utility_push-ranked_order.py process per cell (see
+# run-evaluation.sh). Each cell is written to
+#   <output_folder>/p-<persistence>_A-<mode>.<time away>_L-<latency>_V-<reading speed>_gmp.tsv
+# as expected by pareto-frontiers.py
+
+import sys
+import os
+import json
+import importlib
+import itertools
+import multiprocessing
+
+push_ranked = importlib.import_module('modeled_stream_utility_push-ranked_order')
+import evaluation_stats
+import profiling
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+
+# (persistence, mean time away in seconds) grids of run-evaluation.sh
+default_grids = {
+    'only.push': ([0.1, 0.3, 0.5, 0.7, 0.9], [6*60*60]),
+    'only.pull': ([0.1, 0.5, 0.9], [away*60 for away in [5, 10, 20, 30, 60, 120, 180, 360]]),
+    'push.pull': ([0.1, 0.5, 0.9], [away*60 for away in [5, 10, 20, 30, 60, 120, 180, 360]]),
+}
+
+# [(runfile, run)] loaded once in __main__; forked workers inherit them
+loaded_runs = []
+
+def evaluate_loaded_run(run_index):
+    """
+    :return: the run's output rows for the current grid cell, and its stats
+    records [see --stats] (sent back from forked workers)
+    """
+    runfile, run = loaded_runs[run_index]
+    stats = push_ranked.stats
+    if stats is None:
+        return push_ranked.evaluate_run(runfile, run), []
+    stats.start_run(runfile, persistence=push_ranked.args.user_persistence,
+        time_away=push_ranked.args.user_time_away_mean)
+    rows = push_ranked.evaluate_run(runfile, run)
+    stats.finish_run()
+    return rows, [stats.runs.pop()]
+
+
+def sweep_grid(args):
+    """
+    :return: persistence and time away grids, from the command line, the
+    --grid_config file, or the defaults for the interaction mode (in that
+    order of preference)
+    """
+    persistence_grid, time_away_grid = default_grids[args.interaction_mode]
+    if args.grid_config:
+        with open(args.grid_config) as gf:
+            grid = json.load(gf)
+        persistence_grid = grid.get('persistence', persistence_grid)
+        time_away_grid = grid.get('time_away', time_away_grid)
+    if args.persistence_grid:
+        persistence_grid = args.persistence_grid
+    if args.time_away_grid:
+        time_away_grid = args.time_away_grid
+    return persistence_grid, time_away_grid
+
+
+if __name__ == '__main__':
+
+    ap = push_ranked.argument_parser()
+    ap.description = "computes MSU (push-ranked order) of runs for every cell of a grid of user persistence and mean time away values"
+    ap.add_argument("--output_folder", required=True, help="folder for the p-*_A-*_L-*_V-*_gmp.tsv files of the grid cells")
+    ap.add_argument("--persistence_grid", nargs="+", type=float, help="user persistence values (overrides --user_persistence)")
+    ap.add_argument("--time_away_grid", nargs="+", type=int, help="user mean time away values in seconds (overrides --user_time_away_mean)")
+    ap.add_argument("--grid_config", help="json file with \"persistence\" and/or \"time_away\" lists of grid values")
+    # as in run-evaluation.sh
+    ap.set_defaults(user_reading_mean=4.25)
+
+    args = ap.parse_args()
+    print >> sys.stderr, args
+    if args.profile:
+        profiling.start_profile(args.profile)
+
+    if args.workers > 1 and args.topic_workers > 1:
+        logger.error('--workers and --topic_workers cannot be combined (worker processes cannot fork workers of their own)')
+        sys.exit()
+    if args.paired:
+        logger.error('--paired compares the runs of a single evaluation (modeled_stream_utility_push-ranked_order.py)')
+        sys.exit()
+
+    persistence_grid, time_away_grid = sweep_grid(args)
+    if not os.path.isdir(args.output_folder):
+        os.makedirs(args.output_folder)
+
+    # judgments and runs are shared by all grid cells
+    push_ranked.args = args
+    if args.stats:
+        push_ranked.stats = evaluation_stats.EvaluationStats()
+    stats = push_ranked.stats
+    push_ranked.query_durns, push_ranked.pool, push_ranked.matches, push_ranked.nuggets, \
+        push_ranked.updlens, push_ranked.judgment_tables, push_ranked.judgment_files = push_ranked.load_judgments(args)
+
+    for runfile in args.runfiles:
+        if push_ranked.ignored_runfile(runfile):
+            continue
+        if stats is not None:
+            stats.start_run(runfile)
+        run = push_ranked.load_runfile(runfile)
+        if run is None:
+            # run could not be loaded
+            exit(0)
+        loaded_runs.append((runfile, run))
+        if stats is not None:
+            stats.finish_run()
+
+    for persistence, time_away in itertools.product(persistence_grid, time_away_grid):
+        args.user_persistence = persistence
+        args.user_time_away_mean = time_away
+        push_ranked.MSU = push_ranked.msu_evaluator(args)
+
+        outfile = os.path.join(args.output_folder, 'p-{}_A-{}.{}_L-{}_V-{}_gmp.tsv'.format(
+            persistence, args.interaction_mode, time_away, args.user_latency, args.user_reading_mean))
+        logger.warning('persistence {} time away {} --> {}'.format(persistence, time_away, outfile))
+
+        if args.workers > 1:
+            workers = multiprocessing.Pool(args.workers)
+            run_rows = workers.imap(evaluate_loaded_run, xrange(len(loaded_runs)))
+        else:
+            run_rows = itertools.imap(evaluate_loaded_run, xrange(len(loaded_runs)))
+
+        with open(outfile, 'w') as of:
+            for rows, run_stats in run_rows:
+                for row in rows:
+                    print >> of, row
+                if stats is not None:
+                    stats.runs.extend(run_stats)
+        if stats is not None:
+            stats.write(args.stats)
+
+        if args.workers > 1:
+            workers.close()
+            workers.join()
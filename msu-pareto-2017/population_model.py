@@ -30,6 +30,7 @@ import numpy
 from exceptions import NotImplementedError
 from probability_distributions import Lognormal
 from probability_distributions import Beta
+from probability_distributions import RandomStreams
 
 class PopulationModel(object):
     """
@@ -40,17 +41,28 @@ class PopulationModel(object):
     normal, power law, other distributions
     """
 
-    def __init__(self, random_seed):
+    def __init__(self, random_seed, rng_mode='legacy'):
         """
         A population model must set the seed for random number generation.
         This ensures repeatability of user population when evaluating multiple
         systems
+        rng_mode: 'legacy' draws all users from the global numpy.random state;
+        'keyed' draws each user from its own stream keyed by (seed, topic, user)
+        [see RandomStreams]
         """
         self.random_seed = random_seed
+        self.random_streams = RandomStreams(random_seed, rng_mode)
         self.reset_random_seed()
         
     def reset_random_seed(self):
-        numpy.random.seed(self.random_seed)
+        self.random_streams.reset()
+
+    def user_random_state(self, qid, user_index):
+        """
+        returns the random number generator that user_index of topic qid is
+        sampled and simulated with
+        """
+        return self.random_streams.stream(qid, user_index)
 
     def generate_user_params(self):
         """
@@ -70,9 +82,10 @@ class LognormalAwayPersistenceSessionsPopulationModel(PopulationModel):
         time_away_duration_mean_M_A, \
         time_away_duration_stddev_S_A, \
         RBP_persistence_parameters, \
-        lateness_decay_L ):
+        lateness_decay_L, \
+        rng_mode='legacy'):
 
-        super(LognormalAwayPersistenceSessionsPopulationModel, self).__init__(random_seed)
+        super(LognormalAwayPersistenceSessionsPopulationModel, self).__init__(random_seed, rng_mode)
 
         self.M_A = time_away_duration_mean_M_A
         self.S_A = time_away_duration_stddev_S_A
@@ -88,17 +101,17 @@ class LognormalAwayPersistenceSessionsPopulationModel(PopulationModel):
         self.lnorm_reading.mean_mu = 1.29
         self.lnorm_reading.stddev_sigma = 0.558
 
-    def generate_user_params(self, num_users=0):
+    def generate_user_params(self, num_users=0, random_state=numpy.random):
         if num_users == 0:
-            A = self.lnorm_away.get_random_sample()
-            P = self.beta_persistence.get_random_sample()
-            V = self.lnorm_reading.get_random_sample()
+            A = self.lnorm_away.get_random_sample(random_state)
+            P = self.beta_persistence.get_random_sample(random_state)
+            V = self.lnorm_reading.get_random_sample(random_state)
             L = self.L
             return A, P, V, L
         else:
-            As = self.lnorm_away.get_random_samples(num_users)
-            Ps = self.beta_persistence.get_random_samples(num_users)
-            Vs = self.lnorm_reading.get_random_samples(num_users)
+            As = self.lnorm_away.get_random_samples(num_users, random_state)
+            Ps = self.beta_persistence.get_random_samples(num_users, random_state)
+            Vs = self.lnorm_reading.get_random_samples(num_users, random_state)
             Ls = [self.L]*num_users
             return zip(As, Ps, Vs, Ls)
 
@@ -114,9 +127,10 @@ class LognormalPopulationModel(PopulationModel):
         time_away_duration_stddev_S_A, \
         session_duration_mean_M_D, \
         session_duration_stddev_S_D, \
-        lateness_decay_L):
+        lateness_decay_L, \
+        rng_mode='legacy'):
 
-        super(LognormalPopulationModel, self).__init__(random_seed)
+        super(LognormalPopulationModel, self).__init__(random_seed, rng_mode)
         
         self.M_A = time_away_duration_mean_M_A
         self.S_A = time_away_duration_stddev_S_A
@@ -133,17 +147,17 @@ class LognormalPopulationModel(PopulationModel):
         self.lnorm_reading.mean_mu = 1.29
         self.lnorm_reading.stddev_sigma = 0.558
 
-    def generate_user_params(self, num_users = 0):
+    def generate_user_params(self, num_users = 0, random_state=numpy.random):
         if num_users == 0:
-            A = self.lnorm_away.get_random_sample()
-            D = self.lnorm_session.get_random_sample()
-            V = self.lnorm_reading.get_random_sample()
+            A = self.lnorm_away.get_random_sample(random_state)
+            D = self.lnorm_session.get_random_sample(random_state)
+            V = self.lnorm_reading.get_random_sample(random_state)
             L = self.L
             return A, D, V, L
         else:
-            As = self.lnorm_away.get_random_samples(num_users)
-            Ds = self.lnorm_session.get_random_samples(num_users)
-            Vs = self.lnorm_reading.get_random_samples(num_users)
+            As = self.lnorm_away.get_random_samples(num_users, random_state)
+            Ds = self.lnorm_session.get_random_samples(num_users, random_state)
+            Vs = self.lnorm_reading.get_random_samples(num_users, random_state)
             Ls = [self.L] * num_users
             return zip(As, Ds, Vs, Ls)
 
@@ -2,9 +2,52 @@
  
 import argparse
 import sys
+import zlib
 
 import numpy 
 
+
+class RandomStreams(object):
+    """
+    Reproducible random number streams for a seed.
+    - 'legacy' mode: a single stream, the global numpy.random state reseeded
+      with the seed. This reproduces the scores of earlier versions, but draws
+      must happen in the same order in a single process.
+    - 'keyed' mode: every key, e.g. (topic, user), gets its own
+      numpy.random.RandomState seeded with (seed, key). Streams are
+      independent of each other, so users can be generated in any order or
+      process and still be identical.
+    """
+
+    def __init__(self, seed, mode='legacy'):
+        if mode not in ['legacy', 'keyed']:
+            raise ValueError('unknown random stream mode ' + str(mode))
+        self.seed = seed
+        self.mode = mode
+
+    def reset(self):
+        """
+        restarts the legacy stream (keyed streams always start afresh)
+        """
+        if self.mode == 'legacy':
+            numpy.random.seed(self.seed)
+
+    @staticmethod
+    def key_to_int(key):
+        if isinstance(key, basestring):
+            return zlib.crc32(key) & 0xffffffff
+        return int(key) & 0xffffffff
+
+    def stream(self, *keys):
+        """
+        return: the random number generator for the given keys; an object with
+        the numpy.random sampling functions
+        """
+        if self.mode == 'legacy':
+            return numpy.random
+        return numpy.random.RandomState([self.seed] + [self.key_to_int(k) for k in keys])
+
+
 class Exponential(object):
     """
     Random samples from an Exponential probability distribution parameterized
@@ -15,20 +58,20 @@ class Exponential(object):
     def __init__(self, param_lambda):
         self.scale_param_lambda = float(param_lambda)
 
-    def get_random_sample(self):
+    def get_random_sample(self, random_state=numpy.random):
         """
         return: a single random sample from this exponential distribution
         """
         #return self.get_random_samples(1)[0]
-        return numpy.random.exponential(size=None, scale=self.scale_param_lambda)
+        return random_state.exponential(size=None, scale=self.scale_param_lambda)
 
-    def get_random_samples(self, num_samples):
+    def get_random_samples(self, num_samples, random_state=numpy.random):
         """
         return: a list of num_samples random samples from this exponential
         distribution
         """
         #return expon.rvs(size=num_samples, scale=self.scale_param_lambda)
-        return numpy.random.exponential(size=num_samples, scale=self.scale_param_lambda)
+        return random_state.exponential(size=num_samples, scale=self.scale_param_lambda)
 
 
 class Beta(object):
@@ -42,20 +85,20 @@ class Beta(object):
         self.shape_param_alpha = float(alpha)
         self.shape_param_beta = float(beta)
 
-    def get_random_sample(self):
+    def get_random_sample(self, random_state=numpy.random):
         """
         return: a single random sample from this beta distribution
         """
         
-        return numpy.random.beta(self.shape_param_alpha, self.shape_param_beta, size=None)
+        return random_state.beta(self.shape_param_alpha, self.shape_param_beta, size=None)
 
-    def get_random_samples(self, num_samples):
+    def get_random_samples(self, num_samples, random_state=numpy.random):
         """
         return: a list of num_samples random samples from this beta
         distribution
         """
         
-        return numpy.random.beta(self.shape_param_alpha, self.shape_param_beta, size=num_samples)
+        return random_state.beta(self.shape_param_alpha, self.shape_param_beta, size=num_samples)
 
 
 class Lognormal(object):
@@ -85,19 +128,19 @@ class Lognormal(object):
         return mu, sigma
 
 
-    def get_random_sample(self):
+    def get_random_sample(self, random_state=numpy.random):
         """
         return: a single random sample from this lognormal distribution
         """
-        return self.get_random_samples(1)[0]
+        return self.get_random_samples(1, random_state)[0]
 
-    def get_random_samples(self, num_samples):
+    def get_random_samples(self, num_samples, random_state=numpy.random):
         """
         return: a list of num_samples random samples from this lognormal
         distribution
         """
         #return lognorm.rvs(size=num_samples, scale=self.mean_mu, s=self.stddev_sigma)
-        return numpy.random.lognormal(mean=self.mean_mu, \
+        return random_state.lognormal(mean=self.mean_mu, \
             sigma=self.stddev_sigma, size=num_samples)
 
 
@@ -0,0 +1,27 @@
+# Profiling of an evaluation (--profile out.prof): the evaluation is run under
+# cProfile and its stats are written as a pstats file when the script exits
+# (read it with python -m pstats, or any pstats viewer). With
+# cython_computations built as the profiling variant (MSU_CYTHON_PROFILE=1
+# [see setup.py]) the Cython kernels show up next to the python frames.
+# Only the main process is profiled: forked workers (--workers,
+# --topic_workers) exit without writing their stats.
+
+import sys
+import atexit
+import cProfile
+
+
+def start_profile(profile_file):
+    """
+    profiles the rest of the script; the stats are written to profile_file at exit
+    """
+    profiler = cProfile.Profile()
+    atexit.register(_write_profile, profiler, profile_file)
+    profiler.enable()
+    return profiler
+
+
+def _write_profile(profiler, profile_file):
+    profiler.disable()
+    profiler.dump_stats(profile_file)
+    print >> sys.stderr, 'profile written to', profile_file
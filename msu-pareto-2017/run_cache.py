@@ -0,0 +1,84 @@
+# On-disk cache of gain-attached runs.
+# Loading a run (parsing the run file and attaching nuggets and update lengths
+# from the judgments) gives the same TopicUpdates every time the run is
+# evaluated with the same judgments. The first load of a run saves its topics
+# as .npy columns; later loads memory-map these columns instead of parsing.
+
+import os
+import json
+import hashlib
+
+from update import TopicUpdates
+import utils
+
+# bump when the saved format (or what is loaded into it) changes
+CACHE_VERSION = 1
+
+
+def _file_signature(path):
+    """
+    (path, size, mtime) of a file; for a directory, of every file in it
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        return [_file_signature(os.path.join(path, f)) for f in sorted(os.listdir(path))]
+    st = os.stat(path)
+    return [path, st.st_size, st.st_mtime]
+
+
+def run_cache_key(runfile, judgment_files, options):
+    """
+    key of a run loaded with the given judgment files (or folders) and
+    loading options (e.g. track); the key changes when any of the files change
+    """
+    key = json.dumps([CACHE_VERSION, _file_signature(runfile),
+        [_file_signature(f) for f in judgment_files], options])
+    return hashlib.sha1(key).hexdigest()
+
+
+def save_run(run, path):
+    """
+    saves run (qid --> TopicUpdates) into the directory path (one directory
+    of columns per topic)
+    """
+    # a run is never loaded from a partially written cache entry (nor from
+    # one saved concurrently by another process)
+    with utils.replaced_directory(path) as tmp_path:
+        for qid, topic in run.iteritems():
+            topic_path = os.path.join(tmp_path, qid)
+            os.mkdir(topic_path)
+            topic.save(topic_path)
+        with open(os.path.join(tmp_path, 'topics.json'), 'w') as tf:
+            json.dump(sorted(run.keys()), tf)
+
+
+def load_run(path, mmap_mode='r'):
+    """
+    loads a run saved with save_run()
+    :return: dictionary of qid --> TopicUpdates (with memory-mapped columns)
+    """
+    with open(os.path.join(path, 'topics.json')) as tf:
+        qids = [str(qid) for qid in json.load(tf)]
+    return dict( (qid, TopicUpdates.load(qid, os.path.join(path, qid), mmap_mode)) for qid in qids )
+
+
+def load_cached_run(cache_dir, runfile, judgment_files, options, load_run_and_attach_gain):
+    """
+    returns the run loaded by load_run_and_attach_gain() (a function without
+    arguments returning a dictionary of qid --> TopicUpdates). The run is
+    loaded from cache_dir if it was loaded before with the same judgment
+    files and options; otherwise it is loaded and saved into cache_dir.
+    """
+    path = os.path.join(cache_dir, run_cache_key(runfile, judgment_files, options))
+    if os.path.exists(path):
+        return load_run(path)
+
+    run = load_run_and_attach_gain()
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # created concurrently by another process
+            pass
+    save_run(run, path)
+    return run
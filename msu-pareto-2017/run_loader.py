@@ -0,0 +1,202 @@
+# Streaming loader of TREC Temporal Summarization run files.
+# A run file is read in large chunks of lines; each chunk is split into its 7
+# columns at once, update ids are mapped to int keys interned per topic from
+# the judgments (pool, nugget matches), and nuggets are attached to all the
+# updates of a chunk with numpy gathers over the judgment tables of these keys
+# (word lengths with a binary search of the topic's TopicUpdateLengths). Topics are returned as TopicUpdates built
+# directly from the loaded columns [see TopicUpdates.from_columns()].
+
+import itertools
+import numpy as np
+
+import utils
+
+from update import TopicUpdates, TopicNuggets, judgment_topic_nuggets
+from update_lengths import AVERAGE_LENGTH_KEY
+
+RUN_COLUMNS = 7
+# bytes read from the run file at a time
+CHUNK_SIZE = 1 << 24
+# word length of updates without a judged length (unless average lengths are used)
+DEFAULT_UPDATE_LENGTH = 30
+
+
+class TopicJudgments(object):
+    """
+    Judgment-side tables of a topic's updates, indexed by int keys interned
+    for the update ids of the pool and the matches (key_of). Every table has
+    one extra entry at the end, for the key -1 of the other update ids.
+    - in_pool: whether the update is in the pool
+    - ngt_offsets, ngt_indices: CSR-style nuggets of the update, as dense ids
+      of the topic's TopicNuggets (in the order of the matches, without the
+      nuggets missing from the judgment nuggets)
+    """
+
+    def __init__(self, qid, topic_pool, topic_matches, topic_nuggets):
+        self.qid = qid
+        self.topic_nuggets = topic_nuggets
+
+        key_of = {}
+        for updids in (topic_pool, topic_matches):
+            for updid in updids:
+                if updid not in key_of:
+                    key_of[updid] = len(key_of)
+        self.key_of = key_of
+        num_keys = len(key_of)
+
+        self.in_pool = np.zeros(num_keys + 1, dtype=bool)
+        self.in_pool[[key_of[updid] for updid in topic_pool]] = True
+
+        dense_ids = topic_nuggets.ngt_dense_ids
+        ngt_counts = np.zeros(num_keys + 1, dtype=np.int64)
+        ngt_indices = []
+        matched = sorted( (key_of[updid], updid) for updid in topic_matches )
+        for key, updid in matched:
+            upd_ngts = [dense_ids[ngtid] for ngtid in topic_matches[updid] if ngtid in dense_ids]
+            ngt_counts[key] = len(upd_ngts)
+            ngt_indices.extend(upd_ngts)
+        self.ngt_counts = ngt_counts
+        self.ngt_offsets = np.zeros(num_keys + 2, dtype=np.int64)
+        np.cumsum(ngt_counts, out=self.ngt_offsets[1:])
+        self.ngt_indices = np.array(ngt_indices, dtype=np.int64)
+
+    def keys(self, updids):
+        """
+        :return: int keys of the update ids (-1 for update ids not judged)
+        """
+        return np.fromiter(itertools.imap(self.key_of.get, updids, itertools.repeat(-1)),
+            dtype=np.int64, count=len(updids))
+
+    def gather_nuggets(self, keys):
+        """
+        :return: (ngt_offsets, ngt_indices) of the updates with the given keys
+        """
+        counts = self.ngt_counts[keys]
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        positions = np.repeat(self.ngt_offsets[keys] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return offsets, self.ngt_indices[positions]
+
+
+class JudgmentTables(object):
+    """
+    Tables of the judgments (pool, matches, nuggets) shared by every run
+    loaded with them: the TopicNuggets of every topic (topic_nuggets), and
+    the TopicJudgments of the topics runs were loaded for [see
+    topic_judgments()]. Built once by the evaluation scripts after reading the
+    judgments, and passed to the run loaders.
+    """
+
+    def __init__(self, pool, matches, nuggets):
+        self.pool = pool
+        self.matches = matches
+        self.nuggets = nuggets
+        self.topic_nuggets = judgment_topic_nuggets(nuggets)
+        self._topic_judgments = {}
+
+    def topic_judgments(self, qid):
+        """
+        :return: TopicJudgments of topic qid (built on first use)
+        """
+        if qid not in self._topic_judgments:
+            topic_matches = self.matches[qid]
+            topic_nuggets = self.topic_nuggets.get(qid)
+            if topic_nuggets is None:
+                if topic_matches:
+                    # the gain of the matched updates would silently be lost
+                    raise KeyError('topic {} has matches but no nuggets in the judgments'.format(qid))
+                topic_nuggets = TopicNuggets(qid, {})
+            self._topic_judgments[qid] = TopicJudgments(qid, self.pool[qid], topic_matches, topic_nuggets)
+        return self._topic_judgments[qid]
+
+
+def _run_chunks(runfile, chunk_size):
+    """
+    yields the columns of the run file, a chunk of whole lines at a time
+    """
+    with open(runfile) as rf:
+        tail = ''
+        while True:
+            chunk = rf.read(chunk_size)
+            if not chunk:
+                break
+            chunk = tail + chunk
+            end = chunk.rfind('\n') + 1
+            tail = chunk[end:]
+            columns = utils.split_columns(chunk[:end], RUN_COLUMNS)
+            if columns is not None:
+                yield columns
+        columns = utils.split_columns(tail, RUN_COLUMNS)
+        if columns is not None:
+            yield columns
+
+
+def load_run(runfile, updlens, nuggets, matches, useAverageLengths, track, query_durns, pool,
+        restrict_to_pool=False, chunk_size=CHUNK_SIZE, judgment_tables=None):
+    """
+    loads a run file and attaches gain (nuggets) and word lengths to its
+    updates [see ModeledStreamUtility.load_run_and_attach_gain]
+    - updlens: dictionary of qid --> TopicUpdateLengths [see update_lengths.py]
+    - updates of topics not in the pool are skipped, and so are updates not in
+      the pool of their topic if restrict_to_pool
+    - updates keep the order of the run file within every topic
+    - judgment_tables: JudgmentTables of pool, matches and nuggets (built for
+      this run without it)
+    :return: dictionary of qid --> TopicUpdates
+    """
+    if judgment_tables is None:
+        judgment_tables = JudgmentTables(pool, matches, nuggets)
+    topic_chunks = {}
+    for columns in _run_chunks(runfile, chunk_size):
+        qids, teamids, runids, docids, sentids, updtimes, confidences = columns
+        if track == 'ts14':
+            qids = map('TS14.'.__add__, qids)
+        updids = np.array(map('-'.join, itertools.izip(docids, sentids)), dtype=object)
+        updtimes = np.array(map(float, updtimes), dtype=float)
+        confidences = np.array(map(float, confidences), dtype=float)
+
+        # topics numbered in order of appearance in the chunk
+        topic_numbers = {}
+        chunk_topics = np.fromiter(
+            (topic_numbers.setdefault(qid, len(topic_numbers)) for qid in qids),
+            dtype=np.int64, count=len(qids))
+        for qid, t in topic_numbers.iteritems():
+            if qid not in pool:
+                continue
+            rows = np.flatnonzero(chunk_topics == t)
+            judgments = judgment_tables.topic_judgments(qid)
+            topic_updids = updids[rows].tolist()
+            keys = judgments.keys(topic_updids)
+            if restrict_to_pool:
+                kept = judgments.in_pool[keys]
+                if not kept.all():
+                    rows, keys = rows[kept], keys[kept]
+                    topic_updids = updids[rows].tolist()
+                if len(rows) == 0:
+                    continue
+
+            # timestamps to start from 0
+            times = updtimes[rows] - query_durns[qid][0]
+            default_length = DEFAULT_UPDATE_LENGTH if not useAverageLengths \
+                else updlens[qid][AVERAGE_LENGTH_KEY]
+            has_length, lengths = updlens[qid].lookup(topic_updids)
+            wlens = np.where(has_length, lengths, int(default_length)).astype(float)
+            ngt_offsets, ngt_indices = judgments.gather_nuggets(keys)
+            topic_chunks.setdefault(qid, []).append(
+                (topic_updids, times, confidences[rows], wlens, ngt_offsets, ngt_indices))
+
+    run = {}
+    for qid, chunks in topic_chunks.iteritems():
+        updids = list(itertools.chain.from_iterable(chunk[0] for chunk in chunks))
+        # nugget offsets of every chunk continue from the nuggets of the previous chunks
+        ngt_bases = np.cumsum([0] + [chunk[4][-1] for chunk in chunks])
+        ngt_offsets = np.concatenate([[0]] + [chunk[4][1:] + base for chunk, base in zip(chunks, ngt_bases)])
+        run[qid] = TopicUpdates.from_columns(qid,
+            judgment_tables.topic_judgments(qid).topic_nuggets,
+            updids,
+            np.concatenate([chunk[1] for chunk in chunks]),
+            np.concatenate([chunk[2] for chunk in chunks]),
+            np.concatenate([chunk[3] for chunk in chunks]),
+            ngt_offsets.astype(np.int64),
+            np.concatenate([chunk[5] for chunk in chunks]))
+    return run
@@ -1,9 +1,92 @@
+import os
+import shutil
+import tempfile
 from distutils.core import setup
+from distutils.extension import Extension
+from distutils.command.build_ext import build_ext
+from distutils.ccompiler import new_compiler
+from distutils.errors import CompileError, LinkError
+from distutils.sysconfig import customize_compiler
 from Cython.Build import cythonize
 
+
+def openmp_flags():
+    """
+    compiler/linker flags for OpenMP; empty if the compiler does not support
+    it (the prange over users of cython_computations then runs serially)
+    """
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmp_dir, 'omp_check.c')
+        with open(source, 'w') as sf:
+            sf.write('#include <omp.h>\nint main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }\n')
+        try:
+            objects = compiler.compile([source], output_dir=tmp_dir, extra_postargs=['-fopenmp'])
+            compiler.link_executable(objects, os.path.join(tmp_dir, 'omp_check'), extra_postargs=['-fopenmp'])
+        except (CompileError, LinkError):
+            print 'OpenMP is not available: users are evaluated serially'
+            return []
+        return ['-fopenmp']
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def profile_build():
+    """
+    True for the profiling variant (MSU_CYTHON_PROFILE=1): the functions of
+    cython_computations show up in cProfile (--profile) and their lines can be
+    traced, at a cost in speed. Its C++ source is generated into build/profile
+    """
+    return os.environ.get('MSU_CYTHON_PROFILE', '0') not in ['', '0']
+
+
+# variant (profile or regular) of the last build of cython_computations
+VARIANT_STAMP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build', 'cython_computations.variant')
+
+class variant_build_ext(build_ext):
+    """
+    build_ext that rebuilds (as with --force) when the variant asked for is
+    not the one built last, so that a regular build never leaves the slower
+    profiling kernels in place (nor the other way around)
+    """
+
+    def run(self):
+        variant = 'profile' if profile_build() else 'regular'
+        built_variant = None
+        if os.path.exists(VARIANT_STAMP):
+            with open(VARIANT_STAMP) as vf:
+                built_variant = vf.read().strip()
+        if built_variant != variant:
+            self.force = True
+        build_ext.run(self)
+        if not os.path.isdir(os.path.dirname(VARIANT_STAMP)):
+            os.makedirs(os.path.dirname(VARIANT_STAMP))
+        with open(VARIANT_STAMP, 'w') as vf:
+            print >> vf, variant
+
+
+omp_flags = openmp_flags()
+directives = {}
+macros = []
+build_dir = None
+if profile_build():
+    print 'building the profiling variant of cython_computations'
+    directives = {'profile': True, 'linetrace': True, 'binding': True}
+    macros = [('CYTHON_TRACE', '1'), ('CYTHON_TRACE_NOGIL', '1')]
+    build_dir = os.path.join('build', 'profile')
+
 setup(
         name = 'cython msu computations',
+        cmdclass = {'build_ext': variant_build_ext},
         ext_modules = cythonize(
-                'cython_computations.pyx',
-                language='c++')
+                Extension('cython_computations',
+                        ['cython_computations.pyx'],
+                        define_macros=macros,
+                        extra_compile_args=omp_flags,
+                        extra_link_args=omp_flags),
+                language='c++',
+                compiler_directives=directives,
+                build_dir=build_dir)
 )
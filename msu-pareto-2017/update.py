@@ -1,5 +1,9 @@
 # Update class for encapsulating update data
 
+import os
+import array
+import numpy as np
+
 from nugget import Nugget
 
 class Update:
@@ -19,3 +23,223 @@ class Update:
         return str( (self.qid, self.updid, self.time, self.conf,
             self.wlen, self.numngts, [str(n) for n in self.nuggets]))
 
+
+
+class TopicNuggets(object):
+    """
+    Judgment-side nugget columns of a topic: dense ints for the nugget ids
+    (ngt_dense_ids), and the nugget columns ngt_ids, ngt_gains, ngt_times
+    indexed by them. Built once from the judgments and shared by the
+    TopicUpdates of every run evaluated on the topic [see
+    run_loader.JudgmentTables]
+    """
+
+    def __init__(self, qid, nuggets):
+        """
+        :param nuggets: dictionary of ngtid --> (gain, time) for the topic
+        """
+        self.qid = qid
+        ngtids = sorted(nuggets.keys())
+        self.ngt_dense_ids = dict( (ngtid, i) for i, ngtid in enumerate(ngtids) )
+        self.ngt_ids = np.array(ngtids, dtype=str)
+        self.ngt_gains = np.array([nuggets[ngtid][0] for ngtid in ngtids], dtype=float)
+        self.ngt_times = np.array([nuggets[ngtid][1] for ngtid in ngtids], dtype=float)
+        self.ngt_time_order = np.argsort(self.ngt_times, kind='mergesort')
+
+
+def judgment_topic_nuggets(nuggets):
+    """
+    :param nuggets: judgment nuggets, qid --> ngtid --> (gain, time)
+    :return: dictionary of qid --> TopicNuggets
+    """
+    return dict( (qid, TopicNuggets(qid, topic_nuggets)) for qid, topic_nuggets in nuggets.iteritems() )
+
+
+class TopicUpdates(object):
+    """
+    Columnar storage of the updates submitted for a topic, one entry per
+    update in each of the columns
+    - updids, times, confs, wlens
+    - ngt_offsets: CSR-style nuggets per update, i.e. the nuggets of update i
+      are ngt_indices[ngt_offsets[i]:ngt_offsets[i+1]]
+    Nuggets are identified by dense ints that index into the nugget columns
+    ngt_ids, ngt_gains, ngt_times. These are either built from the nuggets
+    appended with the updates, or shared with the judgments' TopicNuggets.
+    Columns are grown as array.array while loading (append()); presort()
+    orders the updates and turns the columns into numpy arrays, which can be
+    saved to and (memory-mapped) loaded from a directory of .npy files.
+    Indexing returns an UpdateView with the attributes of an Update.
+    """
+
+    columns = ('updids', 'times', 'confs', 'wlens', 'ngt_offsets', 'ngt_indices',
+        'ngt_ids', 'ngt_gains', 'ngt_times')
+
+    def __init__(self, qid, topic_nuggets=None):
+        """
+        :param topic_nuggets: TopicNuggets of the judgments; the nuggets of
+        the appended updates must be in it
+        """
+        self.qid = qid
+        self.updids = []
+        self.times = array.array('d')
+        self.confs = array.array('d')
+        self.wlens = array.array('d')
+        self.ngt_offsets = array.array('l', [0])
+        self.ngt_indices = array.array('l')
+        self.topic_nuggets = topic_nuggets
+        if topic_nuggets is None:
+            self.ngt_ids = []
+            self.ngt_gains = array.array('d')
+            self.ngt_times = array.array('d')
+            self.ngt_dense_ids = {}
+            self.ngt_time_order = None
+        else:
+            self.ngt_ids = topic_nuggets.ngt_ids
+            self.ngt_gains = topic_nuggets.ngt_gains
+            self.ngt_times = topic_nuggets.ngt_times
+            self.ngt_dense_ids = topic_nuggets.ngt_dense_ids
+            self.ngt_time_order = topic_nuggets.ngt_time_order
+        self.presorted = False
+
+    @classmethod
+    def from_columns(cls, qid, topic_nuggets, updids, times, confs, wlens, ngt_offsets, ngt_indices):
+        """
+        builds the topic from whole (not yet presorted) columns, with nuggets
+        as dense ids of topic_nuggets; updates cannot be appended to it
+        """
+        topic = cls(qid, topic_nuggets)
+        topic.updids = updids
+        topic.times = times
+        topic.confs = confs
+        topic.wlens = wlens
+        topic.ngt_offsets = ngt_offsets
+        topic.ngt_indices = ngt_indices
+        return topic
+
+    def append(self, updid, updtime, updconf, updlen, nuggets=()):
+        """
+        appends an update with the given (ngtid, gain, time) nuggets
+        """
+        self.updids.append(updid)
+        self.times.append(float(updtime))
+        self.confs.append(float(updconf))
+        self.wlens.append(int(updlen))
+        if self.topic_nuggets is not None:
+            for ngtid, gain, time in nuggets:
+                self.ngt_indices.append(self.ngt_dense_ids[ngtid])
+            self.ngt_offsets.append(len(self.ngt_indices))
+            return
+        for ngtid, gain, time in nuggets:
+            if ngtid not in self.ngt_dense_ids:
+                self.ngt_dense_ids[ngtid] = len(self.ngt_ids)
+                self.ngt_ids.append(ngtid)
+                self.ngt_gains.append(int(gain))
+                self.ngt_times.append(float(time))
+            self.ngt_indices.append(self.ngt_dense_ids[ngtid])
+        self.ngt_offsets.append(len(self.ngt_indices))
+
+    def presort(self):
+        """
+        sorts updates by time, then confidence, then update id (updates that
+        tie on all three keep their order)
+        """
+        if self.presorted:
+            return
+        times = np.array(self.times, dtype=float)
+        confs = np.array(self.confs, dtype=float)
+        ngt_offsets = np.array(self.ngt_offsets, dtype=np.int64)
+        ngt_indices = np.array(self.ngt_indices, dtype=np.int64)
+        order = np.lexsort((np.array(self.updids, dtype=str), confs, times))
+
+        ngt_counts = (ngt_offsets[1:] - ngt_offsets[:-1])[order]
+        self.ngt_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(ngt_counts, out=self.ngt_offsets[1:])
+        self.ngt_indices = ngt_indices[np.repeat(ngt_offsets[:-1][order] - self.ngt_offsets[:-1],
+            ngt_counts) + np.arange(self.ngt_offsets[-1])]
+
+        self.updids = np.array(self.updids, dtype=str)[order]
+        self.times = times[order]
+        self.confs = confs[order]
+        self.wlens = np.array(self.wlens, dtype=float)[order]
+        if self.topic_nuggets is None:
+            self.ngt_gains = np.array(self.ngt_gains, dtype=float)
+            self.ngt_ids = np.array(self.ngt_ids, dtype=str)
+            self.ngt_times = np.array(self.ngt_times, dtype=float)
+            self.ngt_dense_ids = None
+        self.presorted = True
+
+    def save(self, directory):
+        """
+        saves the presorted columns as .npy files in directory
+        """
+        self.presort()
+        for column in TopicUpdates.columns:
+            np.save(os.path.join(directory, column + '.npy'), getattr(self, column))
+
+    @classmethod
+    def load(cls, qid, directory, mmap_mode=None):
+        """
+        loads presorted columns saved in directory [see save()]
+        mmap_mode='r' memory-maps the (read-only) columns
+        """
+        topic = cls(qid)
+        for column in cls.columns:
+            setattr(topic, column, np.load(os.path.join(directory, column + '.npy'), mmap_mode=mmap_mode))
+        topic.ngt_dense_ids = None
+        topic.presorted = True
+        return topic
+
+    def nugget_time_order(self):
+        """
+        :return: nugget indices in order of nugget time (computed once per topic)
+        """
+        if self.ngt_time_order is None:
+            self.ngt_time_order = np.argsort(self.ngt_times, kind='mergesort')
+        return self.ngt_time_order
+
+    def num_nuggets(self, i):
+        return self.ngt_offsets[i+1] - self.ngt_offsets[i]
+
+    def __len__(self):
+        return len(self.updids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [UpdateView(self, j) for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('update index out of range')
+        return UpdateView(self, i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield UpdateView(self, i)
+
+
+class UpdateView(object):
+    """
+    Update i of a TopicUpdates, with the attributes of an Update
+    """
+    __slots__ = ('topic', 'index')
+
+    def __init__(self, topic, index):
+        self.topic = topic
+        self.index = index
+
+    qid = property(lambda self: self.topic.qid)
+    updid = property(lambda self: self.topic.updids[self.index])
+    time = property(lambda self: float(self.topic.times[self.index]))
+    conf = property(lambda self: float(self.topic.confs[self.index]))
+    wlen = property(lambda self: int(self.topic.wlens[self.index]))
+    numngts = property(lambda self: int(self.topic.num_nuggets(self.index)))
+
+    @property
+    def nuggets(self):
+        topic = self.topic
+        return [Nugget(topic.ngt_ids[ni], topic.ngt_gains[ni], topic.ngt_times[ni])
+            for ni in topic.ngt_indices[topic.ngt_offsets[self.index]:topic.ngt_offsets[self.index+1]]]
+
+    def __repr__(self): 
+        return str( (self.qid, self.updid, self.time, self.conf,
+            self.wlen, self.numngts, [str(n) for n in self.nuggets]))
@@ -0,0 +1,191 @@
+# Word lengths of the updates (sentences) of the TS tracks.
+# The lengths of a topic are kept as a sorted array of update ids with an
+# int32 array of lengths (looked up by binary search) instead of a dictionary
+# of python ints. The *.len files of a lengths folder can be read by parallel
+# processes, and the lengths of all topics can be saved to (and loaded from) a
+# single .npz index file, which is used as long as the *.len files and the
+# track do not change.
+
+import os
+import sys
+import json
+import collections
+import multiprocessing
+import numpy as np
+
+import utils
+
+# bump when the index format (or what is read into it) changes
+INDEX_VERSION = 1
+AVERAGE_LENGTH_KEY = "topic.avg.update.length"
+# columns of the *.len files
+LENGTH_FILE_COLUMNS = {'ts13': 4, 'ts14': 3}
+
+
+class TopicUpdateLengths(collections.Mapping):
+    """
+    Word lengths of a topic's updates: updids (sorted) and lengths (int32).
+    Reads as the dictionary of updid --> length of the original loader,
+    including its "topic.avg.update.length" key (the average length).
+    """
+
+    def __init__(self, qid, updids, lengths):
+        self.qid = qid
+        self.updids = updids
+        self.lengths = lengths
+        # the exact sum of the lengths, as math.fsum of the lengths gives
+        self.average = float(lengths.sum(dtype=np.int64))
+        self.average /= len(lengths)
+
+    @classmethod
+    def from_file_order(cls, qid, updids, lengths):
+        """
+        builds the lengths from (updid, length) columns in file order; the
+        last length read for an updid is kept
+        """
+        order = np.argsort(updids, kind='mergesort')
+        updids, lengths = updids[order], lengths[order]
+        last = np.ones(len(updids), dtype=bool)
+        last[:-1] = updids[1:] != updids[:-1]
+        return cls(qid, updids[last], lengths[last])
+
+    def lookup(self, updids):
+        """
+        :return: (found, lengths) arrays for a sequence of updids; lengths are
+        0 where not found
+        """
+        updids = np.array(updids, dtype=str)
+        found = np.zeros(len(updids), dtype=bool)
+        lengths = np.zeros(len(updids), dtype=np.int32)
+        if len(self.updids) == 0:
+            return found, lengths
+        positions = np.minimum(np.searchsorted(self.updids, updids), len(self.updids) - 1)
+        found = self.updids[positions] == updids
+        lengths[found] = self.lengths[positions[found]]
+        return found, lengths
+
+    def __getitem__(self, updid):
+        if updid == AVERAGE_LENGTH_KEY:
+            return self.average
+        i = np.searchsorted(self.updids, updid)
+        if i < len(self.updids) and self.updids[i] == updid:
+            return int(self.lengths[i])
+        raise KeyError(updid)
+
+    def __iter__(self):
+        for updid in self.updids:
+            yield str(updid)
+        yield AVERAGE_LENGTH_KEY
+
+    def __len__(self):
+        return len(self.updids) + 1
+
+
+def _read_length_file(path_track):
+    """
+    :return: dictionary of qid --> (updids, lengths) arrays of a *.len file, in file order
+    """
+    path, track = path_track
+    with open(path) as lf:
+        columns = utils.split_columns(lf.read(), LENGTH_FILE_COLUMNS[track])
+    if columns is None:
+        return {}
+    if track == 'ts13':
+        tids, updids, clens, wlens = columns
+    elif track == 'ts14':
+        tids, updids, wlens = columns
+        tids = map('TS14.'.__add__, tids)
+    updids = np.array(updids, dtype=str)
+    wlens = np.array(map(int, wlens), dtype=np.int32)
+    if len(set(tids)) == 1:
+        # the usual one topic per file
+        return {tids[0]: (updids, wlens)}
+    topic_numbers = {}
+    file_topics = np.fromiter(
+        (topic_numbers.setdefault(tid, len(topic_numbers)) for tid in tids),
+        dtype=np.int64, count=len(tids))
+    return dict( (tid, (updids[file_topics == t], wlens[file_topics == t]))
+        for tid, t in topic_numbers.iteritems() )
+
+
+def read_update_lengths(update_lengths_folder, track="ts13", workers=1):
+    """
+    reads the *.len files of update_lengths_folder, with workers processes
+    :return: dictionary of qid --> TopicUpdateLengths
+    """
+    paths = [(os.path.join(update_lengths_folder, lenfile), track)
+        for lenfile in os.listdir(update_lengths_folder) if lenfile.endswith(".len")]
+    if workers > 1:
+        processes = multiprocessing.Pool(workers)
+        file_columns = processes.map(_read_length_file, paths)
+        processes.close()
+        processes.join()
+    else:
+        file_columns = map(_read_length_file, paths)
+
+    # topics may span files; files are merged in listing order
+    topic_columns = collections.OrderedDict()
+    for columns in file_columns:
+        for tid, topic_file_columns in columns.iteritems():
+            topic_columns.setdefault(tid, []).append(topic_file_columns)
+
+    updlens = {}
+    for qid, columns in topic_columns.iteritems():
+        updlens[qid] = TopicUpdateLengths.from_file_order(qid,
+            np.concatenate([updids for updids, wlens in columns]),
+            np.concatenate([wlens for updids, wlens in columns]))
+        print >> sys.stderr, qid, updlens[qid].average
+    return updlens
+
+
+def _index_signature(update_lengths_folder, track):
+    lenfiles = sorted(f for f in os.listdir(update_lengths_folder) if f.endswith(".len"))
+    signature = []
+    for lenfile in lenfiles:
+        st = os.stat(os.path.join(update_lengths_folder, lenfile))
+        signature.append([lenfile, st.st_size, st.st_mtime])
+    return json.dumps([INDEX_VERSION, os.path.abspath(update_lengths_folder), track, signature])
+
+
+def save_index(updlens, signature, index_file):
+    """
+    saves the lengths of all topics into a single .npz file
+    """
+    arrays = {'signature': np.array(signature)}
+    for qid, topic_lengths in updlens.iteritems():
+        arrays['updids.' + qid] = topic_lengths.updids
+        arrays['lengths.' + qid] = topic_lengths.lengths
+    # a partially written index is never loaded
+    with utils.replaced_file(index_file, 'wb') as tf:
+        np.savez(tf, **arrays)
+
+
+def load_index(index_file, signature=None):
+    """
+    :return: dictionary of qid --> TopicUpdateLengths saved with save_index();
+    None if signature is given and the index was saved with another signature
+    """
+    with np.load(index_file) as index:
+        if signature is not None and str(index['signature']) != signature:
+            return None
+        qids = [name.split('.', 1)[1] for name in index.files if name.startswith('updids.')]
+        return dict( (qid, TopicUpdateLengths(qid, index['updids.' + qid], index['lengths.' + qid]))
+            for qid in qids )
+
+
+def load_update_lengths(update_lengths_folder, track="ts13", workers=1, index_file=None):
+    """
+    :return: dictionary of qid --> TopicUpdateLengths of update_lengths_folder,
+    loaded from index_file if it was saved for the current *.len files (and
+    track); otherwise the *.len files are read, and saved into index_file
+    """
+    if index_file is None:
+        return read_update_lengths(update_lengths_folder, track, workers)
+    signature = _index_signature(update_lengths_folder, track)
+    if os.path.exists(index_file):
+        updlens = load_index(index_file, signature)
+        if updlens is not None:
+            return updlens
+    updlens = read_update_lengths(update_lengths_folder, track, workers)
+    save_index(updlens, signature, index_file)
+    return updlens
@@ -24,11 +24,9 @@ class UserInterfaceMixin(object):
 
     def presort_updates(self, updates):
         """
-        presort updates 
+        presort updates (a TopicUpdates) by time, confidence and update id
         """
-        updates.sort(key=lambda t: t.updid)
-        updates.sort(key=lambda t: t.conf)
-        updates.sort(key=lambda t: t.time)
+        updates.presort()
 
     def update_presentation_order(self, u, v, updates):
         """
@@ -201,40 +199,40 @@ class PushRankedInterfaceMixin(RankedInterfaceMixin):
         # TODO: this is a legacy function. code needs refactoring
         pass
 
-    def generate_user_trail(self, user_instance, update_confs, update_times, query_duration, push_threshold, interaction_mode):
+    def generate_user_trail(self, user_instance, update_confs, update_times, query_duration, push_threshold, interaction_mode, pull_trail=None):
         """
         generates a trail of user behaviour given system actions (e.g. push notifications)
         push_threshold == 0.0 explicitly pushes each update
+        pull_trail: (session starts, reads) of the user's regular sessions, if
+        already generated [see user_instance.generate_user_trail()]
+        :return: session starts, number of updates read and whether the
+        session is a push notification, as arrays ordered by session start
         """
-                
-        sessions = []       
-        current_time = 0.0
-        ui = 0
-        
+        ssn_starts = [np.zeros(0)]
+        ssn_reads = [np.zeros(0, dtype=int)]
+        ssn_is_push = [np.zeros(0, dtype=bool)]
+
         if interaction_mode == 'only.pull' or interaction_mode == 'push.pull' :
             # regular sessions
-            while current_time < query_duration:
-                # read one update
-                num_read = 1
-
-                while np.random.random() < user_instance.P:
-                    num_read += 1
-
-                sessions.append( (current_time, num_read, 0) )
-                time_away = user_instance.get_next_time_away_duration(current_time, query_duration)
-                current_time += time_away 
+            if pull_trail is None:
+                pull_trail = user_instance.generate_user_trail(query_duration)
+            pull_starts, pull_reads = pull_trail
+            ssn_starts.append(pull_starts)
+            ssn_reads.append(pull_reads)
+            ssn_is_push.append(np.zeros(len(pull_starts), dtype=bool))
 
         if interaction_mode == 'only.push' or interaction_mode =='push.pull':
             # push notification sessions
-            for ui in xrange(len(update_confs)):
-                if update_confs[ui] >= push_threshold:
-                    num_read = 0
-                    while np.random.random() < user_instance.P:  
-                        num_read += 1
-                    sessions.append((update_times[ui], num_read, 1))
-        
-        sessions.sort(key=lambda x: x[0])
-        return sessions
+            pushed = np.flatnonzero(np.asarray(update_confs) >= push_threshold)
+            ssn_starts.append(np.asarray(update_times)[pushed])
+            ssn_reads.append(user_instance.generate_num_reads(len(pushed), 0))
+            ssn_is_push.append(np.ones(len(pushed), dtype=bool))
+
+        ssn_starts = np.concatenate(ssn_starts)
+        order = np.argsort(ssn_starts, kind='mergesort')
+        return ssn_starts[order], \
+            np.concatenate(ssn_reads)[order].astype(np.intc), \
+            np.concatenate(ssn_is_push)[order]
 
 
 if __name__ == "__main__":
@@ -19,20 +19,24 @@ class UserModel(object):
     Given A, D, V, L we can simulate a user browsing a stream of updates.
     We can also determine which updates are read depending on the user
     interface used (see UserInterface)
+    The user's behavior is drawn from random_state (global numpy.random state
+    by default; see PopulationModel.user_random_state)
     """
 
     def __init__(self, mean_time_away_A, mean_session_duration_D, \
-        reading_speed_V, lateness_decay_L):
+        reading_speed_V, lateness_decay_L, random_state=numpy.random):
         self.A = float(mean_time_away_A)
         self.D = float(mean_session_duration_D)
         self.V = float(reading_speed_V)
         self.L = float(lateness_decay_L)
+        self.random_state = random_state
 
         # scale = 1/rate 
         self.A_exp = Exponential(self.A)
         self.D_exp = Exponential(self.D)
         
-        self.session_away_durations = []
+        self.session_durations = numpy.zeros(0)
+        self.away_durations = numpy.zeros(0)
 
     def __repr__(self):
         return str ({
@@ -53,7 +57,7 @@ class UserModel(object):
         else
             a single duration is returned
         """
-        duration = self.D_exp.get_random_sample()
+        duration = self.D_exp.get_random_sample(self.random_state)
         if current_time and query_duration:
             current_time = float(current_time)
             query_duration = float(query_duration)
@@ -69,7 +73,7 @@ class UserModel(object):
         else
             a single duration is returned
         """
-        duration = self.A_exp.get_random_sample()
+        duration = self.A_exp.get_random_sample(self.random_state)
         if current_time and query_duration:
             current_time = float(current_time)
             query_duration = float(query_duration)
@@ -79,43 +83,82 @@ class UserModel(object):
 
     def generate_session_away_lengths(self, query_duration, save=False):
         """
-        returns (generates) list of (session, away) durations that fit into the given
-        query duration.
-        save, if true, saves the generated sessions in self.session_away_durations
+        returns (generates) arrays of session durations and away durations
+        that fit into the given query duration; they are also kept in
+        self.session_durations and self.away_durations.
+        Durations are drawn in blocks of (session, away) pairs, but only the
+        draws of the sessions kept are consumed from self.random_state, i.e.
+        the durations (and any later draws) are the same as when drawing one
+        duration at a time.
         """
-        sa = []
-        current_time = 0.0
         query_duration = float(query_duration)
-        
-        #logger.error('in func')
+        random_state = self.random_state
+        initial_state = random_state.get_state()
+        num_consumed = 0 # draws used by the generated sessions
+        num_drawn = 0 # draws taken from random_state
+        ssn_blocks = []
+        away_blocks = []
+        current_time = 0.0
+
+        # expected number of sessions, with some slack
+        block_size = int(1.25 * query_duration / (self.A + self.D)) + 8
 
         while current_time < query_duration:
-            session = self.D_exp.get_random_sample()
-            if session + current_time > query_duration:
+            if num_drawn != num_consumed:
+                random_state.set_state(initial_state)
+                random_state.standard_exponential(num_consumed)
+                num_drawn = num_consumed
+
+            # exponential(scale) samples are scale * standard_exponential()
+            draws = random_state.standard_exponential(2 * block_size)
+            num_drawn += 2 * block_size
+            sessions = draws[0::2] * self.D
+            aways = draws[1::2] * self.A
+
+            # current_time after each session and each time away; summed
+            # sequentially as current_time += session; current_time += away
+            steps = numpy.empty(2 * block_size + 1)
+            steps[0] = current_time
+            steps[1::2] = sessions
+            steps[2::2] = aways
+            ends = numpy.cumsum(steps)[1:]
+
+            # the first session that does not fit, or whose time away needs
+            # truncation
+            last = (ends[0::2] > query_duration) | (ends[1::2] >= query_duration)
+            num_full = int(numpy.argmax(last)) if last.any() else block_size
+            ssn_blocks.append(sessions[:num_full])
+            away_blocks.append(aways[:num_full])
+            num_consumed += 2 * num_full
+            if num_full == block_size:
+                current_time = ends[-1]
+                continue
+
+            num_consumed += 1
+            if ends[2*num_full] > query_duration:
                 # there is no time for a full session.
-                break 
+                break
                 # NOTE: truncating the last session is a _different_ user
                 # model than the original R code used for the MSU paper (the
                 # break above)
-                ## session = query_duration - current_time
-            current_time += session
-
-            away = self.A_exp.get_random_sample()
-            if away + current_time >= query_duration: 
-                away = query_duration - current_time
-                assert(away >= 0) 
-                # the user may get one last session in before the
-                # query_duration ends
-            #logger.error('something')
-            #if not save:
-            #    yield (session, away)
-            #else:
-            #    logger.error(str(session))
-            self.session_away_durations.append((session, away))
-            #sa.append( (session, away) )
+            current_time = ends[2*num_full]
+
+            num_consumed += 1
+            away = query_duration - current_time
+            assert(away >= 0)
+            # the user may get one last session in before the
+            # query_duration ends
+            ssn_blocks.append(sessions[num_full:num_full+1])
+            away_blocks.append(numpy.array([away]))
             current_time += away
 
-        return self.session_away_durations
+        if num_drawn != num_consumed:
+            random_state.set_state(initial_state)
+            random_state.standard_exponential(num_consumed)
+
+        self.session_durations = numpy.concatenate([self.session_durations] + ssn_blocks)
+        self.away_durations = numpy.concatenate([self.away_durations] + away_blocks)
+        return self.session_durations, self.away_durations
 
 
 
@@ -138,13 +181,23 @@ class LognormalAwayRBPPersistenceUserModel(object):
       critical information is desired earlier rather than later.)
     Given A, P, V, L we can simulate a user browsing a stream of updates when updates are
     presented in a ranked order at every session.
+    The user's behavior is drawn from random_state (global numpy.random state
+    by default; see PopulationModel.user_random_state)
+    With bulk_sampling, the times away and the number of updates read at
+    sessions are drawn in blocks (the number of updates read from the
+    equivalent geometric distribution) rather than one random number at a
+    time. This draws differently from random_state and is meant for users
+    with their own random streams (rng_mode 'keyed').
     """
 
-    def __init__ (self, mean_time_away_A, persistence_P, reading_speed_V, lateness_decay_L):
+    def __init__ (self, mean_time_away_A, persistence_P, reading_speed_V, lateness_decay_L, random_state=numpy.random,
+        bulk_sampling=False):
         self.A = float(mean_time_away_A)
         self.P = float(persistence_P)
         self.V = float(reading_speed_V)
         self.L = float(lateness_decay_L)
+        self.random_state = random_state
+        self.bulk_sampling = bulk_sampling
 
         self.A_exp = Exponential(self.A)
 
@@ -164,7 +217,7 @@ class LognormalAwayRBPPersistenceUserModel(object):
         else
             a single duration is returned
         """
-        duration = self.A_exp.get_random_sample()
+        duration = self.A_exp.get_random_sample(self.random_state)
         if current_time and query_duration:
             current_time = float(current_time)
             query_duration = float(query_duration)
@@ -172,25 +225,104 @@ class LognormalAwayRBPPersistenceUserModel(object):
                 duration = query_duration - current_time
         return duration
 
+    def generate_num_reads(self, num_sessions, min_reads=1):
+        """
+        returns an array of the number of updates read at each of num_sessions
+        sessions: min_reads updates, and one more for as long as the user
+        persists (with probability P)
+        """
+        if self.bulk_sampling:
+            # number of trials up to (and including) the first time the user
+            # does not persist
+            return self.random_state.geometric(1.0 - self.P, num_sessions) - 1 + min_reads
+
+        num_reads = numpy.empty(num_sessions, dtype=int)
+        for si in xrange(num_sessions):
+            num_read = min_reads
+            while self.random_state.random_sample() < self.P:
+                num_read += 1
+            num_reads[si] = num_read
+        return num_reads
+
+    def generate_session_starts(self, query_duration):
+        """
+        returns an array of the start times of sessions (the first at 0.0)
+        separated by times away, until query_duration
+        """
+        query_duration = float(query_duration)
+        if query_duration <= 0.0:
+            return numpy.zeros(0)
+        ssn_blocks = [numpy.zeros(1)]
+        current_time = 0.0
+        # expected number of sessions, with some slack
+        block_size = int(1.25 * query_duration / self.A) + 8
+        while True:
+            steps = numpy.empty(block_size + 1)
+            steps[0] = current_time
+            steps[1:] = self.random_state.exponential(self.A, block_size)
+            ssn_starts = numpy.cumsum(steps)[1:]
+            num_starts = numpy.searchsorted(ssn_starts, query_duration, side='left')
+            ssn_blocks.append(ssn_starts[:num_starts])
+            if num_starts < block_size:
+                break
+            current_time = ssn_starts[-1]
+        return numpy.concatenate(ssn_blocks)
+
     # TODO: this function needs to be moved to the user interface module
     def generate_user_trail(self, query_duration):
         """
-        return [(session_start, num_read),] tuples based on user model parameters
-        """ 
-        sessions = []       
+        returns arrays of session starts and the number of updates read at
+        each session, based on user model parameters
+        """
+        if self.bulk_sampling:
+            ssn_starts = self.generate_session_starts(query_duration)
+            return ssn_starts, self.generate_num_reads(len(ssn_starts))
+
+        ssn_starts = []
+        num_reads = []
         current_time = 0.0
         while current_time < query_duration:
             # read one update
             num_read = 1
 
-            while numpy.random.random() < self.P:
+            while self.random_state.random_sample() < self.P:
                 num_read += 1
 
-            sessions.append( (current_time, num_read) )
+            ssn_starts.append(current_time)
+            num_reads.append(num_read)
             time_away = self.get_next_time_away_duration(current_time, query_duration)
             current_time += time_away
         
-        return sessions
+        return numpy.array(ssn_starts, dtype=float), numpy.array(num_reads, dtype=int)
+
+
+class UserPopulationArrays(object):
+    """
+    Structure-of-arrays view of a population of sampled users, for evaluating
+    all users of a topic in one call.
+    - A, V, L, and D or P (as present on the user models) hold one entry per user
+    - the (session, away) durations generated for the users are concatenated;
+      user i's sessions are
+      ssn_durations[trail_offsets[i]:trail_offsets[i+1]] (likewise away_durations)
+    """
+
+    def __init__(self, users):
+        self.num_users = len(users)
+        self.A = numpy.array([user.A for user in users], dtype=float)
+        self.V = numpy.array([user.V for user in users], dtype=float)
+        self.L = numpy.array([user.L for user in users], dtype=float)
+        if users and hasattr(users[0], 'D'):
+            self.D = numpy.array([user.D for user in users], dtype=float)
+        if users and hasattr(users[0], 'P'):
+            self.P = numpy.array([user.P for user in users], dtype=float)
+
+        no_trail = numpy.zeros(0)
+        ssn_trails = [getattr(user, 'session_durations', no_trail) for user in users]
+        away_trails = [getattr(user, 'away_durations', no_trail) for user in users]
+        self.trail_offsets = numpy.zeros(self.num_users + 1, dtype=numpy.int64)
+        numpy.cumsum([len(trail) for trail in ssn_trails], out=self.trail_offsets[1:])
+        self.ssn_durations = numpy.concatenate([no_trail] + ssn_trails)
+        self.away_durations = numpy.concatenate([no_trail] + away_trails)
 
 
 if __name__ == "__main__":
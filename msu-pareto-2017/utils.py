@@ -5,10 +5,85 @@ import time
 import math
 import xml.etree.ElementTree as ET
 import sys
+import gc
+import itertools
+import shutil
+import tempfile
+import contextlib
 
 from collections import defaultdict
 import json
 
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+@contextlib.contextmanager
+def replaced_file(path, mode='w'):
+    """
+    yields a temporary file (open in mode) next to path, which replaces path
+    once the block completes, so that a partially written file is never read.
+    The file gets the permissions a file written in place would have.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tmp_path, 0666 & ~_umask())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def replaced_directory(path):
+    """
+    yields the path of a temporary directory next to path, which is renamed
+    to path once the block completes (likewise replaced_file()). The
+    temporary directory is dropped if path was created in the meantime (e.g.
+    by another process).
+    """
+    tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        yield tmp_path
+        os.chmod(tmp_path, 0777 & ~_umask())
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def split_columns(text, num_columns):
+    """
+    :return: the num_columns columns (lists of strings) of the non-blank
+    whitespace-separated lines of text; None if there are none
+    """
+    # the rows are not garbage, so collections while building them are wasted
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        rows = map(str.split, text.split('\n'))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    if not set(itertools.imap(len, rows)) <= set([0, num_columns]):
+        bad = next(row for row in rows if len(row) not in (0, num_columns))
+        raise ValueError('expected {} columns in line: {}'.format(num_columns, ' '.join(bad)))
+    # every row has all the columns, so the fields can be sliced column-wise
+    fields = list(itertools.chain.from_iterable(rows))
+    if not fields:
+        return None
+    return [fields[c::num_columns] for c in xrange(num_columns)]
+
+
 def read_in_pool_file(pool_file):
     pool = {}
     duplicates = {}
@@ -0,0 +1,172 @@
+# numpy computations of MSU over per-topic columns of updates.
+# These are the array counterparts of the per-update python loops in
+# modeled_stream_utility.py: instead of walking updates one at a time, every
+# user is simulated with batched numpy operations over the columns (times, word
+# lengths, nugget offsets) of a topic's updates [see update.TopicUpdates].
+
+import numpy as np
+
+
+def _segmented_cumsum(values, offsets):
+    """
+    cumulative sums of values that restart at every segment
+    values[offsets[i]:offsets[i+1]]. Each segment is summed sequentially, i.e.
+    exactly as a python loop accumulating it from 0.0 would.
+    """
+    counts = offsets[1:] - offsets[:-1]
+    if len(values) == 0:
+        return np.zeros(0, dtype=float)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    cols = np.arange(len(values)) - np.repeat(offsets[:-1], counts)
+    padded = np.zeros((len(counts), counts.max()), dtype=float)
+    padded[rows, cols] = values
+    np.cumsum(padded, axis=1, out=padded)
+    return padded[rows, cols]
+
+
+def _segmented_count_le(values, offsets, query_segments, queries):
+    """
+    for each query, the number of values in segment
+    values[offsets[seg]:offsets[seg+1]] that are <= the query, where seg is the
+    query's segment (i.e. bisect.bisect on that segment)
+    - values must be sorted within every segment
+    """
+    num_values = len(values)
+    value_segments = np.repeat(np.arange(len(offsets) - 1), offsets[1:] - offsets[:-1])
+    # merge values and queries; values go before queries on ties
+    merged_segments = np.concatenate((value_segments, query_segments))
+    merged = np.concatenate((values, queries))
+    is_query = np.concatenate((np.zeros(num_values, dtype=np.int8), np.ones(len(queries), dtype=np.int8)))
+    order = np.lexsort((is_query, merged, merged_segments))
+    values_upto = np.cumsum(is_query[order] == 0)
+    query_positions = np.empty(len(queries), dtype=np.int64)
+    query_positions[order[order >= num_values] - num_values] = np.flatnonzero(order >= num_values)
+    return values_upto[query_positions] - offsets[query_segments]
+
+
+def _compute_reverse_chrono_population_MSU(trail_offsets, ssn_durations, away_durations,
+            user_reading_speeds, user_latency_tolerances,
+            update_times, update_lengths, ngt_offsets, ngt_indices, ngt_times, counts=None):
+    """
+    MSU (gain, pain) of every user of a population reading updates in reverse
+    chronological order at every session [see MSUReverseChronoOrder._compute_user_MSU]
+    - the session trails of all users are concatenated; user i's sessions are
+      ssn_durations[trail_offsets[i]:trail_offsets[i+1]] (likewise away_durations)
+    - at each session a user reads a contiguous block of updates backwards
+      from the latest update, stopping at the first update that does not fit
+      in the remaining session time or was made available in an earlier session
+    - pain is the number of updates read that do not contain any nugget
+    - the work done by the simulations is added to counts, if given (as the
+      loop over updates would count it) [see evaluation_stats.SIMULATION_COUNTERS]
+    :return: gain and pain arrays, one entry per user
+    """
+    num_users = len(user_reading_speeds)
+    num_updates = len(update_times)
+    user_topic_msus = np.zeros(num_users, dtype=float)
+    user_topic_pains = np.zeros(num_users, dtype=float)
+    if num_updates == 0 or len(ssn_durations) == 0:
+        return user_topic_msus, user_topic_pains
+
+    ssn_counts = trail_offsets[1:] - trail_offsets[:-1]
+    ssn_user = np.repeat(np.arange(num_users), ssn_counts)
+    ssn_index = np.arange(len(ssn_durations)) - trail_offsets[ssn_user]
+    first_ssn = ssn_index == 0
+
+    # session starts: current_time += session; current_time += away
+    steps = np.empty(2*len(ssn_durations), dtype=float)
+    steps[0::2] = ssn_durations
+    steps[1::2] = away_durations
+    elapsed = _segmented_cumsum(steps, 2*trail_offsets)
+    ssn_starts = np.where(first_ssn, 0.0, elapsed[2*np.arange(len(ssn_durations)) - 1])
+
+    # latest update available at each session start
+    latest = np.searchsorted(update_times, ssn_starts, side='right') - 1
+
+    # cumulative word counts: updates[i:latest+1] fit into a session iff
+    # words[latest+1] - words[i] <= session duration * reading speed
+    words = np.zeros(num_updates + 1, dtype=float)
+    np.cumsum(update_lengths, out=words[1:])
+    first_fit = np.searchsorted(words,
+        words[latest+1] - ssn_durations * user_reading_speeds[ssn_user], side='left')
+
+    # a session reads if the latest update fits into it and the latest update
+    # was not available to a previous reading session of the same user.
+    can_read = (latest >= 0) & (first_fit <= latest)
+    user_shift = ssn_user * (num_updates + 1)
+    prev_latest = np.maximum.accumulate(np.where(can_read, latest, -1) + user_shift) - user_shift
+    prev_latest = np.concatenate(([-1], prev_latest[:-1]))
+    prev_latest[first_ssn] = -1
+    reads = can_read & (latest > prev_latest)
+    if counts is not None:
+        # the loop stops simulating a user after the session that reads the
+        # last update
+        ssns_simulated = ssn_counts.copy()
+        last_read = np.flatnonzero(reads & (latest == num_updates - 1))
+        ssns_simulated[ssn_user[last_read]] = ssn_index[last_read] + 1
+        counts[0] += ssns_simulated.sum()
+    if not reads.any():
+        return user_topic_msus, user_topic_pains
+
+    read_ssns = np.flatnonzero(reads)
+    read_first = np.maximum(prev_latest[read_ssns] + 1, first_fit[read_ssns])
+    read_counts = latest[read_ssns] - read_first + 1
+    if counts is not None:
+        counts[1] += read_counts.sum()
+
+    # indices of all updates read, in reading order (backwards within every
+    # session)
+    read_offsets = np.cumsum(read_counts) - read_counts
+    read_session = np.repeat(read_ssns, read_counts)
+    read_upds = np.repeat(latest[read_ssns] + read_offsets, read_counts) \
+        - np.arange(read_counts.sum())
+    read_user = ssn_user[read_session]
+
+    upd_num_ngts = (ngt_offsets[1:] - ngt_offsets[:-1])[read_upds]
+    user_topic_pains += np.bincount(read_user, weights=(upd_num_ngts == 0), minlength=num_users)
+    if not upd_num_ngts.any():
+        return user_topic_msus, user_topic_pains
+
+    # nuggets of the updates read, each credited when a user first reads it
+    ngt_read_offsets = np.cumsum(upd_num_ngts) - upd_num_ngts
+    ngt_positions = np.repeat(ngt_offsets[read_upds] - ngt_read_offsets,
+        upd_num_ngts) + np.arange(upd_num_ngts.sum())
+    ngts_read = ngt_indices[ngt_positions]
+    ngts_session = np.repeat(read_session, upd_num_ngts)
+    ngts_user = ssn_user[ngts_session]
+    _, first_read = np.unique(ngts_user * len(ngt_times) + ngts_read, return_index=True)
+    if counts is not None:
+        counts[3] += len(first_read)
+
+    credited_user = ngts_user[first_read]
+    ngt_after = _segmented_count_le(ssn_starts, trail_offsets,
+        credited_user, ngt_times[ngts_read[first_read]])
+    alpha = np.maximum(ssn_index[ngts_session[first_read]] - ngt_after, 0)
+    ngt_msu = np.zeros(len(ngts_read), dtype=float)
+    ngt_msu[first_read] = user_latency_tolerances[credited_user] ** alpha
+
+    # accumulate per update and then over updates, in reading order, as the
+    # loop over updates does
+    relevant = upd_num_ngts > 0
+    update_msu = np.add.reduceat(ngt_msu, ngt_read_offsets[relevant])
+    relevant_counts = np.bincount(read_user[relevant], minlength=num_users)
+    relevant_offsets = np.concatenate(([0], np.cumsum(relevant_counts)))
+    msu_upto = _segmented_cumsum(update_msu, relevant_offsets)
+    readers = relevant_counts > 0
+    user_topic_msus[readers] = msu_upto[relevant_offsets[1:][readers] - 1]
+
+    return user_topic_msus, user_topic_pains
+
+
+def _compute_reverse_chrono_user_MSU(ssn_durations, away_durations,
+            update_times, update_lengths, ngt_offsets, ngt_indices, ngt_times,
+            user_reading_speed, user_latency_tolerance):
+    """
+    MSU (gain, pain) of a single user reading updates in reverse chronological
+    order [see _compute_reverse_chrono_population_MSU]
+    """
+    user_topic_msus, user_topic_pains = _compute_reverse_chrono_population_MSU(
+        np.array([0, len(ssn_durations)]),
+        np.asarray(ssn_durations, dtype=float), np.asarray(away_durations, dtype=float),
+        np.array([user_reading_speed], dtype=float), np.array([user_latency_tolerance], dtype=float),
+        update_times, update_lengths, ngt_offsets, ngt_indices, ngt_times)
+    return float(user_topic_msus[0]), float(user_topic_pains[0])
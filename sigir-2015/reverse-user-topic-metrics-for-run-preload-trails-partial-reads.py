@@ -28,6 +28,7 @@ class Nugget:
         #self.gain = int(gain)
         self.time = float(time)
         self.alpha = 0
+        self.tidx = 0 # position of time among the topic's nugget times
         
     def __str__(self):
         return str( (self.ngtid, self.gain, self.time, self.alpha) )
@@ -80,9 +81,18 @@ def load_user_sessions(outfnamepre, uid, sessions, ssn_starts):
 def computeMetrics(run, user_sessions, user_ssn_starts, user_speed, runname, discounts, outuserperf, outmeanperf, outfnamepre):
     
     topic_upd_times = {}  #NOTE: this requires run_gain_file to be sorted appropriately
+    topic_ngt_times = {}
     for qid in run.keys():
         topic_upd_times[qid] = [ upd.time for upd in run[qid] ]
         #print len(topic_upd_times[qid])
+        # distinct nugget times of the topic, in order; every nugget keeps
+        # the position (tidx) of its time for the lateness lookups below
+        ngt_times = sorted(set( ngt.time for upd in run[qid] for ngt in upd.nuggets ))
+        tidx = dict( (t, i) for i, t in enumerate(ngt_times) )
+        for upd in run[qid]:
+            for ngt in upd.nuggets:
+                ngt.tidx = tidx[ngt.time]
+        topic_ngt_times[qid] = np.array(ngt_times, dtype=float)
         
     num_discounts = len(discounts)
     mean_avg_MSU = np.zeros(num_discounts, dtype=float) 
@@ -95,7 +105,9 @@ def computeMetrics(run, user_sessions, user_ssn_starts, user_speed, runname, dis
         #keep arrivals separately for alpha computation
         
         sessions = user_sessions[uid]
-        ssn_starts = user_ssn_starts[uid] #[ ssn.start for ssn in sessions ]        
+        ssn_starts = np.array(user_ssn_starts[uid], dtype=float) #[ ssn.start for ssn in sessions ]        
+        # discounts[d] ** alpha for alpha = 0 .. len(sessions)-1
+        discount_powers = [ (float(discount) ** np.arange(len(sessions), dtype=float)).tolist() for discount in discounts ]
         #ttfile = outfnamepre + "time-trails/time-trail-user-" + str(uid)
         ##print ttfile
         #current_time = 0.0
@@ -137,6 +149,10 @@ def computeMetrics(run, user_sessions, user_ssn_starts, user_speed, runname, dis
             #write out already seen nuggets.
             # will be usefull for graded comparisons later. 
             already_seen_ngts = {}
+
+            # number of sessions started at each nugget time of the topic
+            # (bisect.bisect(ssn_starts, ngt.time) for every nugget)
+            ngt_sessions = np.searchsorted(ssn_starts, topic_ngt_times[qid], side='right').tolist()
             
             last_read_upd_idx = -1
             for sno in xrange(len(sessions)):
@@ -170,14 +186,14 @@ def computeMetrics(run, user_sessions, user_ssn_starts, user_speed, runname, dis
                     #print (upd.wlen / user_speed[uid])
                     for ngt in upd.nuggets:
                         if ngt.ngtid in already_seen_ngts: continue
-                        ngt_after = bisect.bisect(ssn_starts, ngt.time)
+                        ngt_after = ngt_sessions[ngt.tidx]
                         alpha = sno - ngt_after 
                         #logger.debug('alpha {} = {} - {}'.format(alpha, sno, ngt_after)) 
                         already_seen_ngts[ngt.ngtid] = alpha                        
                         alpha = 0 if alpha < 0 else alpha
                         #print qid, ngt, alpha
                         for d in xrange(num_discounts):
-                            MSU[d] += (discounts[d] ** alpha)              
+                            MSU[d] += discount_powers[d][alpha]
                     #logger.debug('msu = {}'.format(MSU[d]))      
                     i -= 1
                 